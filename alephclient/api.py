@@ -1,26 +1,57 @@
 import importlib.metadata
+import io
 import json
 import mimetypes
 import uuid
 import logging
+import threading
+import time
+import weakref
+from collections import deque
+from copy import deepcopy
+from concurrent.futures import Future, ThreadPoolExecutor
 from itertools import count
 from pathlib import Path
 from urllib.parse import urlencode, urljoin
 from banal import ensure_dict, ensure_list
 from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 from requests_toolbelt import MultipartEncoder  # type: ignore
-from typing import Dict, Mapping, Iterable, Iterator, List, Optional, Any
+from typing import BinaryIO, Callable, Deque, Dict, Mapping, Iterable, Iterator, List
+from typing import Optional, Tuple, Union, Any, cast
 
 from alephclient import settings
+from alephclient.cache import CollectionCache, MatchCache, ResponseCache
 from alephclient.errors import AlephException
-from alephclient.util import backoff, prop_push
+from alephclient.util import backoff, prop_push, RateLimiter, ThrottledFile
 
 log = logging.getLogger(__name__)
 MIME = "application/octet-stream"
+# Resumable upload parts must be a multiple of this size, except the last.
+RESUMABLE_QUANTUM = 256 * 1024
 VERSION = importlib.metadata.version("alephclient")
 
 
+def _flat_properties(entity: Dict) -> Dict[str, List]:
+    """The properties of an entity as returned by the API, with the entities
+    it nests in place of references replaced by their ids again."""
+    properties: Dict[str, List] = {}
+    for prop, values in entity.get("properties", {}).items():
+        properties[prop] = [
+            value.get("id") if isinstance(value, dict) else value
+            for value in ensure_list(values)
+        ]
+    return properties
+
+
+class _LocalSession(object):
+    """Holds the session of one thread in thread-local storage."""
+
+    def __init__(self, session: Session):
+        self.session = session
+
+
 class APIResultSet(object):
     def __init__(self, api: "AlephAPI", url: str):
         self.api = api
@@ -87,17 +118,135 @@ class AlephAPI(object):
         api_key: Optional[str] = settings.API_KEY,
         session_id: Optional[str] = None,
         retries: int = settings.MAX_TRIES,
+        pool_size: int = settings.POOL_SIZE,
+        thread_sessions: bool = False,
+        collection_cache_ttl: float = settings.COLLECTION_CACHE_TTL,
     ):
         if not host:
             raise AlephException("No host environment variable found")
         self.base_url = urljoin(host, "/api/2/")
         self.retries = retries
-        session_id = session_id or str(uuid.uuid4())
-        self.session: Session = Session()
-        self.session.headers["X-Aleph-Session"] = session_id
-        self.session.headers["User-Agent"] = "alephclient/%s" % VERSION
-        if api_key is not None:
-            self.session.headers["Authorization"] = "ApiKey %s" % api_key
+        self.api_key = api_key
+        self.session_id = session_id or str(uuid.uuid4())
+        self.pool_size = max(1, pool_size)
+        self.thread_sessions = thread_sessions
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions: List[Session] = []
+        self._closed_stats = {"sessions": 0, "requests": 0, "connections": 0}
+        self._session = self._make_session()
+        # Shared by all threads: caps the rate at which file content is sent,
+        # and is told how many bytes were sent.
+        self.upload_limiter: Optional[RateLimiter] = None
+        self.upload_callback: Optional[Callable[[int], None]] = None
+        # Collections by foreign_id, shared with other client processes.
+        self.collection_cache: Optional[CollectionCache] = None
+        if collection_cache_ttl > 0:
+            path = Path(settings.CACHE_DIR, CollectionCache.FILE_NAME)
+            self.collection_cache = CollectionCache(path, collection_cache_ttl)
+        self._cache_scope = CollectionCache.scope(self.base_url, api_key)
+        self.response_cache: Optional[ResponseCache] = None
+        if settings.HTTP_CACHE_SIZE > 0:
+            self.response_cache = ResponseCache(
+                size=settings.HTTP_CACHE_SIZE,
+                path=Path(settings.CACHE_DIR, "responses")
+                if settings.HTTP_CACHE_DISK
+                else None,
+                ttls=settings.HTTP_CACHE_TTLS,
+                scope=self._cache_scope,
+            )
+
+    def _make_session(self) -> Session:
+        """Create a session with the client headers and a connection pool
+        sized to hold `pool_size` keep-alive connections per host."""
+        session = Session()
+        session.headers["X-Aleph-Session"] = self.session_id
+        session.headers["User-Agent"] = "alephclient/%s" % VERSION
+        if self.api_key is not None:
+            session.headers["Authorization"] = "ApiKey %s" % self.api_key
+        self._mount_adapters(session)
+        with self._lock:
+            self._sessions.append(session)
+        return session
+
+    def _mount_adapters(self, session: Session):
+        for prefix in ("http://", "https://"):
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size, pool_maxsize=self.pool_size
+            )
+            session.mount(prefix, adapter)
+
+    @property
+    def session(self) -> Session:
+        """The session used by the calling thread. Unless `thread_sessions`
+        is enabled, all threads share one session (and its pool). A thread's
+        own session is closed when the thread ends."""
+        if not self.thread_sessions:
+            return self._session
+        local = getattr(self._local, "session", None)
+        if local is None:
+            if threading.current_thread() is threading.main_thread():
+                local = _LocalSession(self._session)
+            else:
+                local = _LocalSession(self._make_session())
+                # Thread-local storage is dropped when the thread ends.
+                weakref.finalize(local, self._close_session, local.session)
+            self._local.session = local
+        return local.session
+
+    @session.setter
+    def session(self, session: Session):
+        self._session = session
+
+    def _close_session(self, session: Session):
+        with self._lock:
+            if session not in self._sessions:
+                return
+            self._sessions.remove(session)
+            for key, value in self._session_stats(session).items():
+                self._closed_stats[key] += value
+        session.close()
+
+    def resize_pool(self, pool_size: int):
+        """Grow the connection pools so that `pool_size` threads can keep
+        their connections alive instead of discarding them after each
+        request. Pools are never shrunk."""
+        if pool_size <= self.pool_size:
+            return
+        self.pool_size = pool_size
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            for adapter in session.adapters.values():
+                adapter.close()
+            self._mount_adapters(session)
+
+    def _session_stats(self, session: Session) -> Dict[str, int]:
+        stats = {"sessions": 1, "requests": 0, "connections": 0}
+        for adapter in session.adapters.values():
+            pools = getattr(adapter, "poolmanager", None)
+            if pools is None:
+                continue
+            for key in pools.pools.keys():
+                pool = pools.pools.get(key)
+                if pool is None:
+                    continue
+                stats["requests"] += pool.num_requests
+                stats["connections"] += pool.num_connections
+        return stats
+
+    def connection_stats(self) -> Dict[str, int]:
+        """Count the requests sent and connections opened across all
+        sessions, including closed ones, to check whether keep-alive
+        connections are reused."""
+        with self._lock:
+            stats = dict(self._closed_stats)
+            sessions = list(self._sessions)
+        for session in sessions:
+            for key, value in self._session_stats(session).items():
+                stats[key] += value
+        stats["reused"] = max(0, stats["requests"] - stats["connections"])
+        return stats
 
     def _make_url(
         self,
@@ -121,6 +270,14 @@ class AlephAPI(object):
             url = url + "?" + urlencode(params_filter)
         return url
 
+    def _upload_stream(self, fh: BinaryIO) -> BinaryIO:
+        """Wrap a file handle so that uploading it is rate limited and
+        reported, if either is configured."""
+        if self.upload_limiter is None and self.upload_callback is None:
+            return fh
+        stream = ThrottledFile(fh, self.upload_limiter, self.upload_callback)
+        return cast(BinaryIO, stream)
+
     def _patch_entity(
         self, entity: Dict, publisher: bool, collection: Optional[Dict] = None
     ):
@@ -156,12 +313,42 @@ class AlephAPI(object):
         successful and failed responses and possibly manage session etc
         conviniently in a single place.
         """
+        cache = self.response_cache
+        if cache is not None and method == "GET" and not kwargs:
+            return self._cached_request(cache, url)
         try:
             response = self.session.request(method=method, url=url, **kwargs)
             response.raise_for_status()
         except (RequestException, HTTPError) as exc:
             raise AlephException(exc) from exc
+        finally:
+            if cache is not None and method != "GET":
+                cache.invalidate(url)
+
+        if len(response.text):
+            return response.json()
+        return {}
 
+    def _cached_request(self, cache: ResponseCache, url: str) -> Dict:
+        """A GET through the response cache: fresh entries are used as they
+        are, stale ones revalidated with a conditional request."""
+        entry = cache.get(url)
+        if entry is not None and entry["expires"] > time.time():
+            cache.count("hits")
+            return json.loads(entry["body"]) if entry["body"] else {}
+        headers = cache.validators(entry) if entry is not None else {}
+        try:
+            response = self.session.request(method="GET", url=url, headers=headers)
+            if entry is not None and response.status_code == 304:
+                cache.count("revalidated")
+                cache.refresh(url, entry, cache.ttl(self.base_url, url))
+                return json.loads(entry["body"]) if entry["body"] else {}
+            response.raise_for_status()
+        except (RequestException, HTTPError) as exc:
+            raise AlephException(exc) from exc
+        cache.count("misses")
+        ttl = cache.ttl(self.base_url, url)
+        cache.put(url, response.text, response.headers, ttl)
         if len(response.text):
             return response.json()
         return {}
@@ -212,6 +399,7 @@ class AlephAPI(object):
         """Delete a collection by ID"""
         params = {"sync": sync}
         url = self._make_url(f"collections/{collection_id}", params=params)
+        self.invalidate_collection_cache(collection_id=collection_id)
         return self._request("DELETE", url)
 
     def flush_collection(self, collection_id: str, sync: bool = False):
@@ -231,20 +419,156 @@ class AlephAPI(object):
         entity = self._request("GET", url)
         return self._patch_entity(entity, publisher)
 
+    def get_entities(
+        self,
+        entity_ids: Iterable[str],
+        publisher: bool = False,
+        batch_size: int = 50,
+        parallel: int = 4,
+    ) -> List[Optional[Dict]]:
+        """Get many entities by ID, in the order given, with None for the
+        ones which do not exist or cannot be seen.
+
+        params
+        ------
+        entity_ids: IDs of the entities
+        publisher: add the publisher of each entity, as `get_entity` does
+        batch_size: IDs looked up with each search request
+        parallel: number of requests made at the same time
+        """
+        ids = list(entity_ids)
+        found = self._fetch_entities(ids, batch_size=batch_size, parallel=parallel)
+        return [
+            self._patch_entity(deepcopy(found[i]), publisher) if i in found else None
+            for i in ids
+        ]
+
+    def _fetch_entities(
+        self, entity_ids: List[str], batch_size: int = 50, parallel: int = 4
+    ) -> Dict[str, Dict]:
+        """Entities by ID as the API returns them, leaving out missing ones."""
+        found: Dict[str, Dict] = {}
+        unique = list(dict.fromkeys(entity_ids))
+        batches = [
+            unique[i : i + batch_size] for i in range(0, len(unique), batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            for result in executor.map(self._search_ids, batches):
+                found.update(result)
+            # Search may not cover every schema, so look up the rest one by one.
+            rest = [i for i in unique if i not in found]
+            for entity_id, entity in zip(rest, executor.map(self._get_or_none, rest)):
+                if entity is not None:
+                    found[entity_id] = entity
+        missing = [i for i in unique if i not in found]
+        if missing:
+            log.warning(
+                "%d of %d entities not found: %s",
+                len(missing),
+                len(unique),
+                ", ".join(missing[:10]),
+            )
+        return found
+
+    def _search_ids(self, entity_ids: List[str]) -> Dict[str, Dict]:
+        filters = [("id", entity_id) for entity_id in entity_ids]
+        params = {"limit": len(entity_ids)}
+        url = self._make_url("entities", filters=filters, params=params)
+        result = self._request("GET", url)
+        return {e["id"]: e for e in result.get("results", []) if e.get("id")}
+
+    def _get_or_none(self, entity_id: str) -> Optional[Dict]:
+        url = self._make_url(f"entities/{entity_id}")
+        try:
+            return self._request("GET", url)
+        except AlephException as ae:
+            if ae.status in (403, 404):
+                return None
+            raise
+
     def delete_entity(self, entity_id: str) -> Dict:
         """Delete a single entity by ID."""
         url = self._make_url(f"entities/{entity_id}")
         return self._request("DELETE", url)
 
+    def delete_entities(
+        self,
+        entity_ids: Iterable[str],
+        parallel: int = 8,
+        callback: Optional[Callable[[str, Optional[AlephException]], None]] = None,
+    ) -> List[Tuple[str, AlephException]]:
+        """Delete many entities by ID, returning those which failed with
+        their errors. Entities which are already gone count as deleted.
+
+        params
+        ------
+        entity_ids: IDs of the entities, read as they are needed
+        parallel: number of delete requests sent at the same time
+        callback: called with each ID, and its error if the delete failed
+        """
+        failures: List[Tuple[str, AlephException]] = []
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(max(1, parallel) * 2)
+
+        def delete(entity_id: str):
+            error: Optional[AlephException] = None
+            try:
+                for attempt in count(1):
+                    try:
+                        self.delete_entity(entity_id)
+                        break
+                    except AlephException as ae:
+                        if ae.status == 404:
+                            break
+                        if not ae.transient or attempt > self.retries:
+                            raise
+                        backoff(ae, attempt)
+            except Exception as exc:
+                # Anything raised here would be lost with the future.
+                if isinstance(exc, AlephException):
+                    error = exc
+                else:
+                    log.exception("Failed to delete: %s", entity_id)
+                    error = AlephException(exc)
+                with lock:
+                    failures.append((entity_id, error))
+            finally:
+                slots.release()
+            if callback is not None:
+                callback(entity_id, error)
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            for entity_id in entity_ids:
+                slots.acquire()
+                executor.submit(delete, entity_id)
+        return failures
+
     def get_collection_by_foreign_id(self, foreign_id: str) -> Optional[Dict]:
         """Get a dict representing a collection based on its foreign ID."""
         if foreign_id is None:
             return None
+        if self.collection_cache is not None:
+            cached = self.collection_cache.get(self._cache_scope, foreign_id)
+            if cached is not None:
+                return cached
         filters = [("foreign_id", foreign_id)]
         for coll in self.filter_collections(filters=filters):
+            if self.collection_cache is not None:
+                self.collection_cache.set(self._cache_scope, foreign_id, coll)
             return coll
         return None
 
+    def invalidate_collection_cache(
+        self, foreign_id: Optional[str] = None, collection_id: Optional[str] = None
+    ) -> int:
+        """Forget cached collections by foreign_id or collection id, or all
+        the collections cached for this host and API key."""
+        if self.collection_cache is None:
+            return 0
+        return self.collection_cache.invalidate(
+            self._cache_scope, foreign_id=foreign_id, collection_id=collection_id
+        )
+
     def load_collection_by_foreign_id(
         self, foreign_id: str, config: Optional[Dict] = None
     ) -> Dict:
@@ -292,7 +616,11 @@ class AlephAPI(object):
         for more details.
         """
         url = self._make_url("collections")
-        return self._request("POST", url, json=data)
+        collection = self._request("POST", url, json=data)
+        if self.collection_cache is not None and collection.get("foreign_id"):
+            foreign_id = collection["foreign_id"]
+            self.collection_cache.set(self._cache_scope, foreign_id, collection)
+        return collection
 
     def update_collection(
         self, collection_id: str, data: Dict, sync: bool = False
@@ -307,6 +635,7 @@ class AlephAPI(object):
         """
         params = {"sync": sync}
         url = self._make_url(f"collections/{collection_id}", params=params)
+        self.invalidate_collection_cache(collection_id=collection_id)
         return self._request("PUT", url, json=data)
 
     def stream_entities(
@@ -348,7 +677,9 @@ class AlephAPI(object):
         force: bool = False,
         unsafe: bool = False,
         cleaned: bool = False,
-    ):
+    ) -> bool:
+        """Write a chunk of entities, returning whether it was written. With
+        `force`, a failed chunk is logged rather than raised."""
         for attempt in count(1):
             url = self._make_url(f"collections/{collection_id}/_bulk")
             params = {"entityset_id": entityset_id}
@@ -359,15 +690,16 @@ class AlephAPI(object):
             try:
                 response = self.session.post(url, json=chunk, params=params)
                 response.raise_for_status()
-                return
+                return True
             except (RequestException, HTTPError) as exc:
                 ae = AlephException(exc)
                 if not ae.transient or attempt > self.retries:
                     if not force:
                         raise ae from exc
                     log.error(ae)
-                    return
+                    return False
                 backoff(ae, attempt)
+        return False
 
     def write_entity(
         self, collection_id: str, entity: Dict, entity_id: Optional[str] = None, **kw
@@ -429,10 +761,10 @@ class AlephAPI(object):
     def match(
         self,
         entity: Dict,
-        collection_ids: Optional[str] = None,
+        collection_ids: Optional[Union[str, List[str]]] = None,
         url: Optional[str] = None,
         publisher: bool = False,
-    ) -> Iterator[List]:
+    ) -> Iterator[Dict]:
         """Find similar entities given a sample entity."""
         params = {"collection_ids": ensure_list(collection_ids)}
         if url is None:
@@ -445,6 +777,87 @@ class AlephAPI(object):
         except (RequestException, HTTPError) as exc:
             raise AlephException(exc) from exc
 
+    def match_many(
+        self,
+        entities: Iterable[Dict],
+        collection_ids: Optional[List[str]] = None,
+        publisher: bool = False,
+        parallel: int = 8,
+        cache: Optional[MatchCache] = None,
+    ) -> Iterator[Dict]:
+        """Match many entities, yielding `{"query": entity, "results": [...]}`
+        in the order of the input, or `{"query": entity, "error": "..."}` for
+        queries which failed.
+
+        params
+        ------
+        entities: the sample entities to match
+        collection_ids: ids of the collections to match in
+        publisher: add the publisher of each result
+        parallel: number of queries sent at the same time
+        cache: results of earlier queries; identical queries are sent once
+        """
+        cache = cache if cache is not None else MatchCache()
+        pending: Dict[str, Future] = {}
+        window: Deque[Tuple[Dict, str, Future]] = deque()
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            for entity in entities:
+                key = MatchCache.key(entity, sorted(collection_ids or []), publisher)
+                future = pending.get(key)
+                if future is None:
+                    future = executor.submit(
+                        self._match_cached,
+                        cache,
+                        key,
+                        entity,
+                        collection_ids,
+                        publisher,
+                    )
+                    pending[key] = future
+                window.append((entity, key, future))
+                # Bound the number of queries waiting to be written out.
+                while len(window) > parallel * 4:
+                    yield self._match_result(window.popleft(), pending)
+            while window:
+                yield self._match_result(window.popleft(), pending)
+
+    def _match_cached(
+        self,
+        cache: MatchCache,
+        key: str,
+        entity: Dict,
+        collection_ids: Optional[List[str]],
+        publisher: bool,
+    ) -> List[Dict]:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        results: List[Dict] = []
+        for attempt in count(1):
+            try:
+                results = list(self.match(entity, collection_ids, publisher=publisher))
+                break
+            except AlephException as ae:
+                if not ae.transient or attempt > self.retries:
+                    raise
+                backoff(ae, attempt)
+        cache.set(key, results)
+        return results
+
+    def _match_result(
+        self, item: Tuple[Dict, str, Future], pending: Dict[str, Future]
+    ) -> Dict:
+        entity, key, future = item
+        try:
+            return {"query": entity, "results": future.result()}
+        except AlephException as ae:
+            log.warning("Match failed [%s]: %s", entity.get("id"), ae)
+            return {"query": entity, "error": str(ae)}
+        finally:
+            # Later duplicates will find the result in the cache.
+            if pending.get(key) is future:
+                del pending[key]
+
     def entitysets(
         self,
         collection_id: Optional[str] = None,
@@ -499,7 +912,7 @@ class AlephAPI(object):
                     m = MultipartEncoder(
                         fields={
                             "meta": json.dumps(metadata),
-                            "file": (file_path.name, fh, MIME),
+                            "file": (file_path.name, self._upload_stream(fh), MIME),
                         }
                     )
                     headers = {"Content-Type": m.content_type}
@@ -510,12 +923,166 @@ class AlephAPI(object):
                 backoff(ae, attempt)
         return {}
 
+    def request_upload_url(self) -> Dict:
+        """Request a signed URL to upload a file to (Aleph Pro only).
+
+        Returns a dict with the signed `url` and the `id` of the upload."""
+        url = self._make_url("file/uploadUrl")
+        try:
+            result = self._request("POST", url)
+        except AlephException as ae:
+            if ae.status == 404:
+                raise AlephException(
+                    "Upload endpoint not found. Is this an Aleph Pro instance?"
+                ) from ae
+            raise
+        if "url" not in result or "id" not in result:
+            raise AlephException("Invalid upload URL response")
+        return result
+
+    def start_resumable_upload(self, signed_url: str) -> str:
+        """Open a resumable upload session on a signed URL, as object stores
+        such as Google Cloud Storage support them, returning the session URL
+        to which the file content is then sent in order."""
+        headers = {"Content-Type": MIME, "x-goog-resumable": "start"}
+        try:
+            response = self.session.post(signed_url, headers=headers)
+            response.raise_for_status()
+        except (RequestException, HTTPError) as exc:
+            raise AlephException(exc) from exc
+        location = response.headers.get("Location")
+        if not location:
+            raise AlephException("Upload URL does not support resumable uploads")
+        return location
+
+    def _put_resumable(
+        self, session_url: str, total: int, data: Optional[bytes] = None, start: int = 0
+    ) -> int:
+        """Send a part of a resumable upload, or only ask for its status if
+        there is no data, returning the number of bytes the store has."""
+        if data is None:
+            headers = {"Content-Range": f"bytes */{total}"}
+            body: Optional[BinaryIO] = None
+        else:
+            end = start + len(data) - 1
+            headers = {"Content-Range": f"bytes {start}-{end}/{total}"}
+            body = self._upload_stream(io.BytesIO(data))
+        try:
+            response = self.session.put(
+                session_url, data=body, headers=headers, allow_redirects=False
+            )
+            if response.status_code != 308:
+                response.raise_for_status()
+                return total
+        except (RequestException, HTTPError) as exc:
+            raise AlephException(exc) from exc
+        # 308 Resume Incomplete: the range says how much has been persisted.
+        received = response.headers.get("Range", "")
+        if not received.startswith("bytes=0-"):
+            return 0
+        return int(received[len("bytes=0-") :]) + 1
+
+    def put_upload(
+        self,
+        signed_url: str,
+        file_path: Path,
+        chunk_size: Optional[int] = None,
+        resume: Optional[Dict] = None,
+    ):
+        """Send the content of a file to a signed upload URL.
+
+        params
+        ------
+        signed_url: the url returned by `request_upload_url`
+        file_path: path of the file to upload
+        chunk_size: if set, send files larger than this through a resumable
+        upload session, in parts of this many bytes (rounded up to a multiple
+        of 256 KiB), one after the other. If the signed URL cannot start such
+        a session, e.g. because it is only signed for a PUT, the file is
+        sent whole instead.
+        resume: dict holding the state of a resumable upload. It is updated
+        as parts are sent, so that passing it to a later call continues the
+        upload where the store left off instead of starting over.
+        """
+        total = file_path.stat().st_size
+        state = resume if resume is not None else {}
+        if chunk_size and total > chunk_size:
+            if "url" in state:
+                # A failed part may have been persisted in full, in part or
+                # not at all, so ask the store where to continue.
+                state["offset"] = self._put_resumable(state["url"], total)
+            else:
+                try:
+                    state["url"] = self.start_resumable_upload(signed_url)
+                except AlephException as ae:
+                    if ae.transient:
+                        raise
+                    log.warning(
+                        "No resumable upload [%s], sending it whole: %s",
+                        file_path.name,
+                        ae.message,
+                    )
+                    chunk_size = None
+        if not chunk_size or total <= chunk_size:
+            try:
+                with file_path.open("rb") as fh:
+                    response = self.session.put(
+                        signed_url,
+                        data=self._upload_stream(fh),
+                        headers={"Content-Type": MIME},
+                    )
+                    response.raise_for_status()
+            except (RequestException, HTTPError) as exc:
+                raise AlephException(exc) from exc
+            return
+
+        size = -(-chunk_size // RESUMABLE_QUANTUM) * RESUMABLE_QUANTUM
+        offset = state.get("offset", 0)
+        log.debug(
+            "Upload parts [%s]: %d of %d",
+            file_path.name,
+            -(-(total - offset) // size),
+            -(-total // size),
+        )
+        with file_path.open("rb") as fh:
+            while offset < total:
+                fh.seek(offset)
+                data = fh.read(size)
+                received = self._put_resumable(state["url"], total, data, offset)
+                if received <= offset:
+                    raise AlephException("Upload stalled at byte %d" % offset)
+                offset = state["offset"] = received
+
+    def create_document(
+        self,
+        collection_id: str,
+        upload_id: str,
+        metadata: Optional[Dict] = None,
+        index: bool = True,
+    ) -> Dict:
+        """Create a document from a file sent to a signed upload URL."""
+        url = self._make_url(
+            f"collections/{collection_id}/document", params={"index": index}
+        )
+        payload = {"upload_id": upload_id, "Meta": metadata or {}}
+        result = self._request("POST", url, json=payload)
+        if not result:
+            return {"id": upload_id, "status": "ok"}
+        return result
+
+    def _document_meta(self, file_path: Path, metadata: Optional[Dict]) -> Dict:
+        meta = dict(metadata or {})
+        meta["file_name"] = file_path.name
+        meta["mime_type"] = mimetypes.guess_type(file_path.name)[0] or MIME
+        return meta
+
     def signed_url_upload(
         self,
         collection_id: str,
         file_path: Optional[Path] = None,
         metadata: Optional[Dict] = None,
         index: bool = True,
+        chunk_size: Optional[int] = None,
     ) -> Dict:
         """
         Upload a document using the signed URL workflow.
@@ -528,60 +1095,49 @@ class AlephAPI(object):
         2. PUT file content to the signed url
         3. POST /collections/{id}/document with the upload_id and metadata
 
+        When a step fails with a transient error, the retry resumes from that
+        step: the signed URL is kept, and in chunked mode the upload session
+        continues from the last byte the store has persisted.
+
         params
         ------
         collection_id: id of the collection to upload to
         file_path: path of the file to upload. None while creating folders
         metadata: dict containing metadata for the file or folders
         index: whether to index the document after creation
+        chunk_size: upload files larger than this many bytes in parts, through
+        a resumable upload session (see `put_upload`)
         """
         if not file_path or file_path.is_dir():
             return self.ingest_upload(
                 collection_id, file_path, metadata=metadata, index=index
             )
 
-        mime_type = mimetypes.guess_type(file_path.name)[0] or MIME
-        meta = dict(metadata or {})
-        meta["file_name"] = file_path.name
-        meta["mime_type"] = mime_type
-
+        meta = self._document_meta(file_path, metadata)
+        upload: Optional[Dict] = None
+        resume: Dict = {}
+        uploaded = False
         for attempt in count(1):
             try:
                 # Step 1: request a signed upload URL
-                upload_url = self._make_url("file/uploadUrl")
-                try:
-                    result = self._request("POST", upload_url)
-                except AlephException as ae:
-                    if ae.status == 404:
-                        raise AlephException(
-                            "Upload endpoint not found. Is this an Aleph Pro instance?"
-                        ) from ae
-                    raise
-                signed_url = result["url"]
-                upload_id = result["id"]
-                log.info("Signed URL id [%s]: %s", upload_id, file_path.name)
-                log.debug("Signed URL id [%s]", upload_id)
+                if upload is None:
+                    upload = self.request_upload_url()
+                    log.info("Signed URL id [%s]: %s", upload["id"], file_path.name)
 
                 # Step 2: PUT file content to the signed URL
-                try:
-                    with file_path.open("rb") as fh:
-                        response = self.session.put(
-                            signed_url,
-                            data=fh,
-                            headers={"Content-Type": "application/octet-stream"},
-                        )
-                        response.raise_for_status()
-                except (RequestException, HTTPError) as exc:
-                    raise AlephException(exc) from exc
+                if not uploaded:
+                    self.put_upload(
+                        upload["url"],
+                        file_path,
+                        chunk_size=chunk_size,
+                        resume=resume,
+                    )
+                    uploaded = True
 
                 # Step 3: create the document record
-                doc_url_path = f"collections/{collection_id}/document"
-                doc_url = self._make_url(doc_url_path, params={"index": index})
-                payload = {"upload_id": upload_id, "Meta": meta}
-                result = self._request("POST", doc_url, json=payload)
-                if not result:
-                    return {"id": upload_id, "status": "ok"}
-                return result
+                return self.create_document(
+                    collection_id, upload["id"], metadata=meta, index=index
+                )
             except AlephException as ae:
                 if not ae.transient or attempt > self.retries:
                     raise ae from ae
@@ -602,6 +1158,104 @@ class AlephAPI(object):
         }
         return self._request("POST", url, data=data)
 
+    def get_entityset(self, entityset_id: str) -> Dict:
+        """Get a single EntitySet by id"""
+        url = self._make_url(f"entitysets/{entityset_id}")
+        return self._request("GET", url)
+
+    def add_to_entityset(
+        self,
+        entityset_id: str,
+        items: Iterable[Union[str, Dict]],
+        chunk_size: int = 1000,
+        parallel: int = 4,
+        force: bool = False,
+        callback: Optional[Callable[[int], None]] = None,
+    ) -> Dict[str, int]:
+        """Add entities to an EntitySet in bulk, writing them to its
+        collection in chunks which are sent `parallel` at a time.
+
+        params
+        ------
+        entityset_id: id of the EntitySet
+        items: entities, or the ids of entities in the collection of the
+        EntitySet, which are fetched first. Entities of other collections
+        are skipped, since writing them would copy them.
+        chunk_size: number of entities sent with each request
+        force: log failed chunks rather than raising, and count their
+        entities as failed
+        callback: called with the number of entities in each chunk written
+        """
+        entityset = self.get_entityset(entityset_id)
+        collection_id = entityset.get("collection_id")
+        if collection_id is None:
+            collection_id = entityset.get("collection", {}).get("id")
+        collection_id = str(collection_id)
+        stats = {"written": 0, "failed": 0, "missing": 0, "skipped": 0}
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(max(1, parallel))
+        futures: List[Future] = []
+
+        def write(chunk: List[Dict]):
+            try:
+                written = self._bulk_chunk(
+                    collection_id, chunk, entityset_id=entityset_id, force=force
+                )
+            finally:
+                slots.release()
+            with lock:
+                stats["written" if written else "failed"] += len(chunk)
+            if written and callback is not None:
+                callback(len(chunk))
+
+        def resolve(ids: List[str]) -> List[Dict]:
+            found = self._fetch_entities(ids, parallel=parallel)
+            entities = []
+            for entity in found.values():
+                owner = entity.get("collection", {}).get("id")
+                owner = owner or entity.get("collection_id")
+                if owner is not None and str(owner) != collection_id:
+                    stats["skipped"] += 1
+                    continue
+                entities.append(
+                    {
+                        "id": entity["id"],
+                        "schema": entity.get("schema"),
+                        "properties": _flat_properties(entity),
+                    }
+                )
+            stats["missing"] += len(set(ids)) - len(found)
+            return entities
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+
+            def submit(chunk: List[Dict]):
+                slots.acquire()
+                futures.append(executor.submit(write, chunk))
+
+            chunk: List[Dict] = []
+            ids: List[str] = []
+            for item in items:
+                if isinstance(item, dict) and "properties" not in item:
+                    item = item["id"]
+                if isinstance(item, str):
+                    ids.append(item)
+                    if len(ids) >= chunk_size:
+                        chunk.extend(resolve(ids))
+                        ids = []
+                else:
+                    chunk.append(item)
+                while len(chunk) >= chunk_size:
+                    submit(chunk[:chunk_size])
+                    chunk = chunk[chunk_size:]
+            if ids:
+                chunk.extend(resolve(ids))
+            for start in range(0, len(chunk), chunk_size):
+                submit(chunk[start : start + chunk_size])
+            for future in futures:
+                future.result()
+        return stats
+
     def delete_entityset(self, entityset_id: str, sync: bool = False):
         """Delete an EntitySet by id"""
         url = self._make_url(f"entitysets/{entityset_id}", params={"sync": sync})
@@ -0,0 +1,348 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+
+class CollectionCache(object):
+    """Collections looked up by foreign_id, kept in a JSON file so they are
+    shared by short-lived client processes. Entries expire after `ttl`
+    seconds. Every write replaces the file atomically; if two processes
+    write at once, one of their entries is lost, which only costs a lookup.
+
+    Entries are kept apart per Aleph host and API key, since the same
+    foreign_id can be a different collection, or invisible, for another
+    user."""
+
+    FILE_NAME = "collections.json"
+
+    def __init__(self, path: Path, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    @classmethod
+    def scope(cls, base_url: str, api_key: Optional[str]) -> str:
+        key = hashlib.sha1((api_key or "").encode("utf-8")).hexdigest()[:16]
+        return "%s#%s" % (base_url, key)
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, "r") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning("Ignoring invalid cache: %s", self.path)
+            return {}
+
+    def _save(self, entries: Dict[str, Dict]):
+        now = time.time()
+        entries = {k: v for k, v in entries.items() if v.get("expires", 0) > now}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name("%s.%d.tmp" % (self.path.name, os.getpid()))
+        with open(tmp, "w") as fh:
+            json.dump(entries, fh)
+        os.replace(tmp, self.path)
+
+    def get(self, scope: str, foreign_id: str) -> Optional[Dict]:
+        with self.lock:
+            entry = self._load().get("%s|%s" % (scope, foreign_id))
+        if entry is None or entry.get("expires", 0) <= time.time():
+            return None
+        return entry.get("collection")
+
+    def set(self, scope: str, foreign_id: str, collection: Dict):
+        entry = {"collection": collection, "expires": time.time() + self.ttl}
+        with self.lock:
+            entries = self._load()
+            entries["%s|%s" % (scope, foreign_id)] = entry
+            self._save(entries)
+
+    def invalidate(
+        self,
+        scope: Optional[str] = None,
+        foreign_id: Optional[str] = None,
+        collection_id: Optional[str] = None,
+    ) -> int:
+        """Drop the entries for a foreign_id or a collection id, or all of
+        them (within `scope`, if given). Returns the number dropped."""
+        with self.lock:
+            entries = self._load()
+            dropped = 0
+            for key in list(entries.keys()):
+                key_scope, _, key_foreign_id = key.partition("|")
+                if scope is not None and key_scope != scope:
+                    continue
+                if foreign_id is not None and key_foreign_id != foreign_id:
+                    continue
+                collection = entries[key].get("collection", {})
+                if collection_id is not None:
+                    if str(collection.get("id")) != str(collection_id):
+                        continue
+                del entries[key]
+                dropped += 1
+            if dropped:
+                self._save(entries)
+        return dropped
+
+
+class ResponseCache(object):
+    """Bodies of GET responses, for `AlephAPI._request`. The most recent
+    `size` entries are kept in memory, and optionally all of them in files
+    under `path`.
+
+    An entry is served without asking the server for the TTL of its
+    endpoint: the longest key of `ttls` that the URL path (relative to the
+    API base) starts with, e.g. `entities` or `collections`. Once stale, it
+    is revalidated with If-None-Match/If-Modified-Since if the server sent
+    an ETag or Last-Modified. Entries with neither and no TTL are not kept."""
+
+    def __init__(
+        self,
+        size: int = 1024,
+        path: Optional[Path] = None,
+        ttls: Optional[Mapping[str, float]] = None,
+        scope: str = "",
+    ):
+        self.size = max(1, size)
+        self.path = path
+        self.ttls = dict(ttls or {})
+        self.scope = scope
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def ttl(self, base_url: str, url: str) -> float:
+        path = url[len(base_url) :] if url.startswith(base_url) else url
+        path = urlparse(path).path
+        best = None
+        for prefix in self.ttls:
+            if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return self.ttls[best] if best is not None else 0.0
+
+    def _file(self, url: str) -> Optional[Path]:
+        if self.path is None:
+            return None
+        key = hashlib.sha1((self.scope + url).encode("utf-8")).hexdigest()
+        return self.path.joinpath(key[:2], key + ".json")
+
+    def get(self, url: str) -> Optional[Dict]:
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                return entry
+        file_path = self._file(url)
+        if file_path is None:
+            return None
+        try:
+            with open(file_path, "r") as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        self._remember(url, entry)
+        return entry
+
+    def _remember(self, url: str, entry: Dict):
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def put(self, url: str, body: str, headers: Mapping[str, str], ttl: float):
+        if "no-store" in headers.get("Cache-Control", ""):
+            return
+        etag = headers.get("ETag")
+        modified = headers.get("Last-Modified")
+        if etag is None and modified is None and ttl <= 0:
+            return
+        entry = {
+            "url": url,
+            "body": body,
+            "etag": etag,
+            "last_modified": modified,
+            "expires": time.time() + ttl,
+        }
+        self._remember(url, entry)
+        self._store(url, entry)
+
+    def refresh(self, url: str, entry: Dict, ttl: float):
+        """Extend an entry the server confirmed to be unchanged."""
+        entry["expires"] = time.time() + ttl
+        self._remember(url, entry)
+        self._store(url, entry)
+
+    def _store(self, url: str, entry: Dict):
+        file_path = self._file(url)
+        if file_path is None:
+            return
+        try:
+            file_path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+            tmp = file_path.with_name(
+                "%s.%d.%d.tmp" % (file_path.name, os.getpid(), threading.get_ident())
+            )
+            with open(tmp, "w") as fh:
+                json.dump(entry, fh)
+            os.replace(tmp, file_path)
+        except OSError as exc:
+            log.warning("Cannot write to cache: %s", exc)
+
+    def validators(self, entry: Dict) -> Dict[str, str]:
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def invalidate(self, url: str):
+        """Forget the entries for a resource and everything below it, e.g.
+        after it was changed by a PUT, POST or DELETE. Search results which
+        include the resource are not found this way, and stay cached."""
+        prefix = urlparse(url)._replace(query="").geturl().rstrip("/")
+        with self.lock:
+            urls = [u for u in self.entries if u.split("?", 1)[0].startswith(prefix)]
+            for cached in urls:
+                del self.entries[cached]
+        for cached in urls + [prefix]:
+            file_path = self._file(cached)
+            if file_path is not None and file_path.exists():
+                file_path.unlink()
+
+    def count(self, outcome: str):
+        """Count a `hits`, `revalidated` or `misses` outcome."""
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "entries": len(self.entries),
+            }
+
+
+class MatchCache(object):
+    """Results of match queries, by a key of the query. The `size` most
+    recently used are kept in memory. With a `path`, results are also kept
+    in a SQLite file, which is trimmed to the `disk_size` most recently used
+    entries; entries older than `ttl` seconds are not used."""
+
+    def __init__(
+        self,
+        size: int = 10000,
+        path: Optional[Path] = None,
+        disk_size: int = 1000000,
+        ttl: Optional[float] = None,
+    ):
+        self.size = max(1, size)
+        self.path = path
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.conn: Optional[sqlite3.Connection] = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(path), check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS matches "
+                "(key TEXT PRIMARY KEY, results TEXT, stored REAL, used REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS matches_used ON matches (used)"
+            )
+
+    @classmethod
+    def key(cls, entity: Dict, *context) -> str:
+        """A key for the query entity, ignoring its id, and any context
+        which changes the results, such as the collections to match in."""
+        query = {
+            "schema": entity.get("schema"),
+            "properties": entity.get("properties", {}),
+            "context": context,
+        }
+        data = json.dumps(query, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, results: List[Dict]):
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        with self.lock:
+            results = self.entries.get(key)
+            if results is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return results
+            if self.conn is not None:
+                now = time.time()
+                row = self.conn.execute(
+                    "SELECT results, stored FROM matches WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and (self.ttl is None or row[1] > now - self.ttl):
+                    self.conn.execute(
+                        "UPDATE matches SET used = ? WHERE key = ?", (now, key)
+                    )
+                    results = json.loads(row[0])
+                    self._remember(key, results)
+                    self.hits += 1
+                    return results
+            self.misses += 1
+            return None
+
+    def set(self, key: str, results: List[Dict]):
+        with self.lock:
+            self._remember(key, results)
+            if self.conn is None:
+                return
+            now = time.time()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO matches (key, results, stored, used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(results), now, now),
+            )
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                self._trim()
+                self.conn.commit()
+
+    def _trim(self):
+        assert self.conn is not None
+        self.conn.execute(
+            "DELETE FROM matches WHERE key NOT IN "
+            "(SELECT key FROM matches ORDER BY used DESC LIMIT ?)",
+            (self.disk_size,),
+        )
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self._trim()
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
@@ -2,13 +2,25 @@ import json
 import click
 import logging
 import sys
+from pathlib import Path
 
 from alephclient import settings
 from alephclient.api import AlephAPI
+from alephclient.cache import CollectionCache, MatchCache
 from alephclient.errors import AlephException
 from alephclient.crawldir import crawl_dir
-from alephclient.fetchdir import fetch_collection, fetch_entity
-from alephclient.exports import list_exports, format_exports_table, download_export
+from alephclient.crawlplan import plan_dir
+from alephclient.entitysets import dump_entitysets
+from alephclient.mirror import EntityMirror, mirror_collection, mirror_path
+from alephclient.progress import Progress
+from alephclient.fetchdir import FetchFilter, fetch_collection, fetch_entity
+from alephclient.exports import (
+    list_exports,
+    format_exports_table,
+    download_export,
+    extract_export,
+    stream_export_entities,
+)
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +32,12 @@ def _get_id_from_foreign_key(api, foreign_id):
     return collection.get("id")
 
 
+def _read_json(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
 def _write_result(stream, result):
     for data in result:
         stream.write(json.dumps(data))
@@ -43,8 +61,15 @@ def _write_result(stream, result):
     default=settings.MAX_TRIES,
     help="retries upon server failure",
 )
+@click.option(
+    "--pool-size",
+    type=click.IntRange(1),
+    default=settings.POOL_SIZE,
+    show_default=True,
+    help="keep-alive connections per host",
+)
 @click.pass_context
-def cli(ctx, host, api_key, retries):
+def cli(ctx, host, api_key, retries, pool_size):
     """API client for Aleph API"""
     logging.basicConfig(level=logging.DEBUG)
     logging.getLogger("requests").setLevel(logging.WARNING)
@@ -54,7 +79,7 @@ def cli(ctx, host, api_key, retries):
         raise click.BadParameter("Missing Aleph host URL")
     if ctx.obj is None:
         ctx.obj = {}
-    ctx.obj["api"] = AlephAPI(host, api_key, retries=retries)
+    ctx.obj["api"] = AlephAPI(host, api_key, retries=retries, pool_size=pool_size)
 
 
 @cli.command()
@@ -94,6 +119,83 @@ def cli(ctx, host, api_key, retries):
     default=False,
     help="use signed URL workflow for file uploads",
 )
+@click.option(
+    "--thread-sessions",
+    is_flag=True,
+    default=False,
+    help="use a separate HTTP session for each upload thread",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(0),
+    default=0,
+    help="with --signed-url, upload files larger than this many MB in parts, "
+    "through a resumable upload session",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    default=False,
+    help="with --signed-url, request upload URLs ahead and create documents "
+    "in the background",
+)
+@click.option(
+    "--pack-threshold",
+    type=click.IntRange(1),
+    default=None,
+    help="zip files smaller than this many KB into bundles before uploading",
+)
+@click.option(
+    "--pack-size",
+    type=click.IntRange(1),
+    default=16,
+    show_default=True,
+    help="maximum size of a bundle of small files, in MB",
+)
+@click.option(
+    "--pack-manifest",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="NDJSON file recording which bundle each small file went into",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    default=False,
+    help="after the crawl, keep uploading new and changed files until stopped",
+)
+@click.option(
+    "--debounce",
+    type=click.FloatRange(0),
+    default=2.0,
+    show_default=True,
+    help="with --watch, seconds a file must stay unchanged before upload",
+)
+@click.option(
+    "--max-rate",
+    type=click.FloatRange(0, min_open=True),
+    default=None,
+    help="maximum upload bandwidth of all threads together, in MB/s",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="show files and bytes uploaded, throughput and ETA",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="only scan the directory and report what the crawl would upload",
+)
+@click.option(
+    "--plan-sample",
+    type=click.IntRange(0),
+    default=0,
+    help="with --plan, also estimate how long the crawl would take by uploading "
+    "this many files to a scratch collection, which is deleted afterwards",
+)
 @click.argument("path", type=click.Path(exists=True))
 @click.pass_context
 def crawldir(
@@ -106,12 +208,37 @@ def crawldir(
     nojunk=False,
     parallel=1,
     signed_url=False,
+    thread_sessions=False,
+    chunk_size=0,
+    pipeline=False,
+    pack_threshold=None,
+    pack_size=16,
+    pack_manifest=None,
+    watch=False,
+    debounce=2.0,
+    max_rate=None,
+    progress=False,
+    plan=False,
+    plan_sample=0,
 ):
     """Crawl a directory recursively and upload the documents in it to a
     collection."""
     try:
         config = {"languages": language, "casefile": casefile}
         api = ctx.obj["api"]
+        max_rate = max_rate * 1024 * 1024 if max_rate else None
+        if plan:
+            crawl_plan = plan_dir(
+                api,
+                path,
+                foreign_id,
+                nojunk=nojunk,
+                sample=plan_sample,
+                signed_url=signed_url,
+                chunk_size=chunk_size * 1024 * 1024 or None,
+            )
+            click.echo(crawl_plan.format(max_rate=max_rate))
+            return
         crawl_dir(
             api,
             path,
@@ -121,6 +248,16 @@ def crawldir(
             nojunk=nojunk,
             parallel=parallel,
             signed_url=signed_url,
+            thread_sessions=thread_sessions,
+            chunk_size=chunk_size * 1024 * 1024 or None,
+            pipeline=pipeline,
+            pack_threshold=pack_threshold * 1024 if pack_threshold else None,
+            pack_size=pack_size * 1024 * 1024,
+            pack_manifest=pack_manifest,
+            watch=watch,
+            debounce=debounce,
+            max_rate=max_rate,
+            progress=progress,
         )
     except AlephException as exc:
         raise click.ClickException(str(exc))
@@ -141,16 +278,115 @@ def crawldir(
     default=False,
     help="overwrite existing files",
 )
+@click.option(
+    "--parallel",
+    default=1,
+    show_default=True,
+    type=click.IntRange(1),
+    help="maximum number of parallel downloads",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="show files and bytes downloaded, throughput and ETA",
+)
+@click.option(
+    "--tree",
+    is_flag=True,
+    default=False,
+    help="list the whole collection in one stream instead of one search per folder",
+)
+@click.option(
+    "--sync",
+    is_flag=True,
+    default=False,
+    help="compare existing files by content hash instead of size",
+)
+@click.option(
+    "--prune",
+    is_flag=True,
+    default=False,
+    help="delete local files under --prefix which are not in the collection "
+    "(implies --sync, requires --prefix)",
+)
+@click.option(
+    "--schema",
+    "schemata",
+    multiple=True,
+    help="only fetch files of this schema, e.g. Pdf (repeatable)",
+)
+@click.option(
+    "--mime-type",
+    "mime_types",
+    multiple=True,
+    help="only fetch files of this MIME type, e.g. image/* (repeatable)",
+)
+@click.option(
+    "--min-size",
+    type=click.FloatRange(0),
+    help="only fetch files of at least this size in MB",
+)
+@click.option(
+    "--max-size",
+    type=click.FloatRange(0),
+    help="only fetch files of at most this size in MB",
+)
+@click.option(
+    "--glob",
+    "globs",
+    multiple=True,
+    help="only fetch files whose relative path matches, e.g. '*.pdf' (repeatable)",
+)
 @click.pass_context
-def fetchdir(ctx, foreign_id, prefix=None, entity_id=None, overwrite=False):
+def fetchdir(
+    ctx,
+    foreign_id,
+    prefix=None,
+    entity_id=None,
+    overwrite=False,
+    parallel=1,
+    progress=False,
+    tree=False,
+    sync=False,
+    prune=False,
+    schemata=(),
+    mime_types=(),
+    min_size=None,
+    max_size=None,
+    globs=(),
+):
     """Recursively download the contents of an Aleph entity or collection and rebuild
     them as a folder tree."""
     try:
         api = ctx.obj["api"]
+        api.resize_pool(parallel + 4)
+        selection = None
+        if schemata or mime_types or globs or min_size or max_size is not None:
+            selection = FetchFilter(
+                schemata=schemata,
+                mime_types=mime_types,
+                min_size=int(min_size * 1024 * 1024) if min_size else None,
+                max_size=int(max_size * 1024 * 1024) if max_size is not None else None,
+                globs=globs,
+            )
+        options = {
+            "overwrite": overwrite,
+            "parallel": parallel,
+            "progress": progress,
+            "tree": tree,
+            "sync": sync or prune,
+            "selection": selection,
+        }
         if entity_id is not None:
-            fetch_entity(api, prefix, entity_id, overwrite=overwrite)
+            if prune:
+                raise click.BadParameter("--prune needs a whole collection")
+            fetch_entity(api, prefix, entity_id, **options)
         elif foreign_id is not None:
-            fetch_collection(api, prefix, foreign_id, overwrite=overwrite)
+            if prune and prefix is None:
+                # Never prune the working directory by default.
+                raise click.BadParameter("--prune needs an explicit --prefix")
+            fetch_collection(api, prefix, foreign_id, prune=prune, **options)
         else:
             msg = "Please specify either a foreign_id or entity_id"
             raise click.ClickException(msg)
@@ -272,6 +508,63 @@ def delete_entity(ctx, entity_id):
         raise click.ClickException(exc.message)
 
 
+@cli.command("delete-entities")
+@click.option(
+    "-i",
+    "--infile",
+    type=click.File("r"),
+    default="-",
+    help="file with one entity id per line (the first word of each line)",
+)
+@click.option(
+    "--parallel",
+    default=8,
+    show_default=True,
+    type=click.IntRange(1),
+    help="number of deletes sent at the same time",
+)
+@click.option(
+    "--failures",
+    type=click.File("w"),
+    help="write the ids which could not be deleted, with the errors, to this file",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="show entities deleted, rate and ETA",
+)
+@click.pass_context
+def delete_entities(ctx, infile, parallel, failures=None, progress=False):
+    """Delete many entities, reading their ids from standard input."""
+    api = ctx.obj["api"]
+    entity_ids = []
+    for line in infile:
+        words = line.split()
+        if words:
+            entity_ids.append(words[0])
+    entity_ids = list(dict.fromkeys(entity_ids))
+    tracker = Progress("delete", unit="entities") if progress else None
+    if tracker is not None:
+        tracker.add_total(files=len(entity_ids))
+
+    def deleted(entity_id, error):
+        if tracker is not None:
+            tracker.update(files=1, failed=1 if error else 0)
+
+    api.resize_pool(parallel)
+    failed = api.delete_entities(entity_ids, parallel=parallel, callback=deleted)
+    if tracker is not None:
+        tracker.close()
+    if failures is not None:
+        for entity_id, error in failed:
+            failures.write("%s\t%s\n" % (entity_id, error))
+    if failed:
+        raise click.ClickException(
+            "%d of %d entities could not be deleted" % (len(failed), len(entity_ids))
+        )
+
+
 @cli.command("write-entities")
 @click.option("-i", "--infile", type=click.File("r"), default="-")
 @click.option("-f", "--foreign-id", required=True, help="foreign_id of the collection")
@@ -378,6 +671,71 @@ def stream_entities(ctx, outfile, schema, foreign_id, publisher):
         raise click.Abort()
 
 
+@cli.command("match")
+@click.option("-i", "--infile", type=click.File("r"), default="-")  # noqa
+@click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+@click.option(
+    "-f",
+    "--foreign-id",
+    "foreign_ids",
+    multiple=True,
+    help="foreign_id of a collection to match in (repeatable)",
+)
+@click.option(
+    "--parallel",
+    default=8,
+    show_default=True,
+    type=click.IntRange(1),
+    help="number of queries sent at the same time",
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    type=click.Path(dir_okay=False),
+    help="keep results in this SQLite file, for later runs",
+)
+@click.option(
+    "--cache-size",
+    default=10000,
+    show_default=True,
+    type=click.IntRange(1),
+    help="number of results kept in memory",
+)
+@click.option(
+    "-p",
+    "--publisher",
+    is_flag=True,
+    default=False,
+    help="Add publisher info from collection context",
+)
+@click.pass_context
+def match(
+    ctx, infile, outfile, foreign_ids, parallel, cache_path, cache_size, publisher
+):
+    """Match entities read as NDJSON, and write each with its results."""
+    api = ctx.obj["api"]
+    collection_ids = [_get_id_from_foreign_key(api, f) for f in foreign_ids]
+    path = Path(cache_path) if cache_path else None
+    cache = MatchCache(size=cache_size, path=path)
+    try:
+        api.resize_pool(parallel)
+        results = api.match_many(
+            _read_json(infile),
+            collection_ids=collection_ids or None,
+            publisher=publisher,
+            parallel=parallel,
+            cache=cache,
+        )
+        _write_result(outfile, results)
+        log.info("Match cache: %d hits, %d misses", cache.hits, cache.misses)
+    except AlephException as exc:
+        raise click.ClickException(exc.message)
+    except BrokenPipeError:
+        raise click.Abort()
+    finally:
+        cache.close()
+
+
 @cli.command("entitysets")
 @click.option("-o", "--outfile", type=click.File("w"), default="-")
 @click.option("-f", "--foreign-id", default=None, help="foreign_id of the collection")
@@ -414,6 +772,56 @@ def entitysetitems(ctx, outfile, entityset_id):
         raise click.Abort()
 
 
+@cli.command("dump-entitysets")
+@click.option("-f", "--foreign-id", default=None, help="foreign_id of the collection")
+@click.option(
+    "-t", "--type", "types", multiple=True, help="entity set type (repeatable)"
+)
+@click.option("-o", "--outfile", type=click.File("w"), default="-")
+@click.option(
+    "-d",
+    "--directory",
+    type=click.Path(file_okay=False, writable=True),
+    help="write one file of items per entity set here, instead of one stream",
+)
+@click.option(
+    "--parallel",
+    default=4,
+    show_default=True,
+    type=click.IntRange(1),
+    help="number of entity sets whose items are fetched at the same time",
+)
+@click.option(
+    "-p",
+    "--publisher",
+    is_flag=True,
+    default=False,
+    help="Add publisher info from collection context",
+)
+@click.pass_context
+def dump_entitysets_(ctx, foreign_id, types, outfile, directory, parallel, publisher):
+    """Dump all entity sets with their items."""
+    api = ctx.obj["api"]
+    try:
+        collection_id = None
+        if foreign_id is not None:
+            collection_id = _get_id_from_foreign_key(api, foreign_id)
+        api.resize_pool(parallel + 1)
+        dump_entitysets(
+            api,
+            collection_id=collection_id,
+            set_types=list(types) or None,
+            directory=directory,
+            stream=None if directory else outfile,
+            parallel=parallel,
+            publisher=publisher,
+        )
+    except AlephException as exc:
+        raise click.ClickException(exc.message)
+    except BrokenPipeError:
+        raise click.Abort()
+
+
 @cli.command("make-list")
 @click.option("-f", "--foreign-id", required=True, help="foreign_id of the collection")
 @click.option("-o", "--outfile", type=click.File("w"), default="-")
@@ -433,6 +841,191 @@ def make_list(ctx, foreign_id, outfile, label, summary):
         raise click.Abort()
 
 
+@cli.command("add-to-list")
+@click.option("-e", "--entityset", "entityset_id", required=True, help="id of the list")
+@click.option(
+    "-i",
+    "--infile",
+    type=click.File("r"),
+    default="-",
+    help="NDJSON of entities, or of entity ids",
+)
+@click.option(
+    "-c",
+    "--chunksize",
+    default=1000,
+    show_default=True,
+    type=click.IntRange(1),
+    help="chunk size when sending batches of entities",
+)
+@click.option(
+    "--parallel",
+    default=4,
+    show_default=True,
+    type=click.IntRange(1),
+    help="number of chunks sent at the same time",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="continue after server errors",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="show entities written and rate",
+)
+@click.pass_context
+def add_to_list(ctx, entityset_id, infile, chunksize, parallel, force, progress):
+    """Add entities, or entities by id, to an existing list."""
+    api = ctx.obj["api"]
+    tracker = Progress("list", unit="entities") if progress else None
+
+    def items():
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None
+            # Bare ids may parse as numbers, or not at all.
+            yield item if isinstance(item, (str, dict)) else line
+
+    try:
+        api.resize_pool(parallel)
+        stats = api.add_to_entityset(
+            entityset_id,
+            items(),
+            chunk_size=chunksize,
+            parallel=parallel,
+            force=force,
+            callback=lambda n: tracker.update(files=n) if tracker else None,
+        )
+        if tracker is not None:
+            tracker.close()
+        click.echo(", ".join("%d %s" % (v, k) for k, v in stats.items()), err=True)
+    except AlephException as exc:
+        raise click.ClickException(exc.message)
+    except BrokenPipeError:
+        raise click.Abort()
+
+
+@cli.group()
+@click.pass_context
+def cache(ctx):
+    """Manage local caches."""
+    pass
+
+
+@cache.command("clear")
+@click.option("-f", "--foreign-id", help="only forget this collection")
+@click.option(
+    "--all",
+    "all_hosts",
+    is_flag=True,
+    default=False,
+    help="clear the cache for every host and API key",
+)
+@click.pass_context
+def cache_clear(ctx, foreign_id=None, all_hosts=False):
+    """Forget collections cached by foreign_id."""
+    api = ctx.obj["api"]
+    path = Path(settings.CACHE_DIR, CollectionCache.FILE_NAME)
+    collections = CollectionCache(path, settings.COLLECTION_CACHE_TTL)
+    scope = None if all_hosts else CollectionCache.scope(api.base_url, api.api_key)
+    dropped = collections.invalidate(scope, foreign_id=foreign_id)
+    click.echo(f"Removed {dropped} cached collections")
+
+
+@cli.group()
+@click.pass_context
+def mirror(ctx):
+    """Query collections from a local copy."""
+    pass
+
+
+@mirror.command("sync")
+@click.option("-f", "--foreign-id", required=True, help="foreign_id of the collection")
+@click.option("--db", type=click.Path(dir_okay=False), help="SQLite file to use")
+@click.option(
+    "-p",
+    "--property",
+    "properties",
+    multiple=True,
+    help="property to index the values of (repeatable)",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="stream the collection even if it has not been updated",
+)
+@click.pass_context
+def mirror_sync(ctx, foreign_id, db=None, properties=(), force=False):
+    """Create or refresh the local copy of a collection."""
+    api = ctx.obj["api"]
+    try:
+        stats = mirror_collection(
+            api, foreign_id, db, properties=list(properties) or None, force=force
+        )
+        click.echo(", ".join("%d %s" % (v, k) for k, v in stats.items()))
+    except AlephException as exc:
+        raise click.ClickException(str(exc))
+
+
+@mirror.command("query")
+@click.option("-f", "--foreign-id", required=True, help="foreign_id of the collection")
+@click.option("--db", type=click.Path(dir_okay=False, exists=True))
+@click.option("-i", "--id", "entity_id", help="id of an entity")
+@click.option("-s", "--schema", help="schema of the entities")
+@click.option(
+    "-p",
+    "--property",
+    "properties",
+    multiple=True,
+    help="property value to match, as name=value (repeatable)",
+)
+@click.option("-l", "--limit", type=click.IntRange(1))
+@click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+@click.pass_context
+def mirror_query(
+    ctx,
+    foreign_id,
+    outfile,
+    db=None,
+    entity_id=None,
+    schema=None,
+    properties=(),
+    limit=None,
+):
+    """Find entities in the local copy of a collection."""
+    path = db or mirror_path(foreign_id)
+    if not Path(path).exists():
+        raise click.ClickException("No mirror, run: alephclient mirror sync")
+    filters = {}
+    for item in properties:
+        prop, sep, value = item.partition("=")
+        if not sep:
+            raise click.BadParameter("Expected name=value: %s" % item)
+        filters[prop] = value
+    local = EntityMirror(Path(path))
+    try:
+        if entity_id is not None:
+            entity = local.get(entity_id)
+            results = [entity] if entity is not None else []
+        else:
+            results = local.query(schema=schema, properties=filters, limit=limit)
+        _write_result(outfile, results)
+    except BrokenPipeError:
+        raise click.Abort()
+    finally:
+        local.close()
+
+
 @cli.group()
 @click.pass_context
 def export(ctx):
@@ -455,16 +1048,79 @@ def export_list(ctx):
 @export.command("download")
 @click.argument("export_id", required=True)
 @click.argument("destination", required=True, type=click.Path())
+@click.option(
+    "-p",
+    "--parallel",
+    default=4,
+    show_default=True,
+    type=click.IntRange(1),
+    help="number of connections downloading segments of the file",
+)
+@click.option(
+    "--wait",
+    is_flag=True,
+    default=False,
+    help="wait for the export to be complete before downloading it",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(0),
+    help="give up waiting after this many seconds",
+)
+@click.option(
+    "--extract",
+    is_flag=True,
+    default=False,
+    help="unpack the archive into the destination directory as it downloads",
+)
 @click.pass_context
-def export_download(ctx, export_id, destination):
+def export_download(
+    ctx, export_id, destination, parallel=4, wait=False, timeout=None, extract=False
+):
     """Download an export by ID to a destination path."""
     api = ctx.obj["api"]
     try:
-        path = download_export(api, export_id, destination)
+        if extract:
+            paths = extract_export(
+                api, export_id, destination, wait=wait, timeout=timeout
+            )
+            click.echo(f"Extracted {len(paths)} files to {destination}")
+            return
+        api.resize_pool(parallel)
+        path = download_export(
+            api, export_id, destination, parallel=parallel, wait=wait, timeout=timeout
+        )
         click.echo(f"Export downloaded to {path}")
     except AlephException as exc:
         raise click.ClickException(str(exc))
 
 
+@export.command("entities")
+@click.argument("export_id", required=True)
+@click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+@click.option(
+    "--wait",
+    is_flag=True,
+    default=False,
+    help="wait for the export to be complete before reading it",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(0),
+    help="give up waiting after this many seconds",
+)
+@click.pass_context
+def export_entities(ctx, export_id, outfile, wait=False, timeout=None):
+    """Stream the entities in an export archive, without storing it."""
+    api = ctx.obj["api"]
+    try:
+        entities = stream_export_entities(api, export_id, wait=wait, timeout=timeout)
+        _write_result(outfile, entities)
+    except AlephException as exc:
+        raise click.ClickException(str(exc))
+    except BrokenPipeError:
+        raise click.Abort()
+
+
 if __name__ == "__main__":
     cli()
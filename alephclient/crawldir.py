@@ -1,18 +1,141 @@
+import json
 import logging
 import threading
 import re
 import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
 from os import PathLike
 from queue import Queue
 from pathlib import Path
-from typing import cast, Optional, Dict
+from functools import partial
+from typing import cast, Callable, Optional, Dict, List, Tuple, Union
 
 from alephclient.api import AlephAPI
 from alephclient.errors import AlephException
-from alephclient.util import backoff
+from alephclient.progress import Progress
+from alephclient.util import backoff, RateLimiter
+from alephclient.watchdir import make_watcher, watch_dir
 
 log = logging.getLogger(__name__)
 
+# Files and directories skipped by --nojunk, matched against the full name.
+JUNK_FILES = re.compile(r"\..*|thumbs\.db|desktop\.ini", re.I)
+JUNK_DIRS = re.compile(r"\..*|\$recycle\.bin|system volume information", re.I)
+
+# The id of an uploaded document, a future of it when the signed URL pipeline
+# creates the document in the background, or None if the upload failed.
+Uploaded = Union[str, Future, None]
+
+
+class SignedUrlPipeline(object):
+    """Run the three steps of the signed URL workflow in separate stages, so
+    that the threads sending file content never wait on metadata calls:
+    upload URLs are requested ahead of time by a small pool, and documents
+    are created in the background once their content has been sent."""
+
+    def __init__(
+        self,
+        api: AlephAPI,
+        collection_id: str,
+        index: bool = True,
+        chunk_size: Optional[int] = None,
+        prefetch: int = 2,
+        workers: int = 2,
+    ):
+        self.api = api
+        self.collection_id = collection_id
+        self.index = index
+        self.chunk_size = chunk_size
+        self.url_pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.document_pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.urls: Queue = Queue()
+        for _ in range(max(1, prefetch)):
+            self.urls.put(self.url_pool.submit(self.api.request_upload_url))
+
+    def take_upload_url(self) -> Dict:
+        future: Future = self.urls.get()
+        self.urls.put(self.url_pool.submit(self.api.request_upload_url))
+        return future.result()
+
+    def upload(self, path: Path, metadata: Dict) -> Future:
+        """Send the file content and queue the creation of its document,
+        returning a future of the document id, which is None if the document
+        could not be created. Transient upload errors are retried with the
+        same signed URL, so chunked uploads resume rather than restart."""
+        upload = self.take_upload_url()
+        log.info("Signed URL id [%s]: %s", upload["id"], path.name)
+        resume: Dict = {}
+        for attempt in count(1):
+            try:
+                self.api.put_upload(
+                    upload["url"], path, chunk_size=self.chunk_size, resume=resume
+                )
+                break
+            except AlephException as ae:
+                if not ae.transient or attempt > self.api.retries:
+                    raise
+                backoff(ae, attempt)
+        meta = self.api._document_meta(path, metadata)
+        return self.document_pool.submit(self.create_document, upload["id"], meta)
+
+    def create_document(self, upload_id: str, metadata: Dict) -> Optional[str]:
+        for attempt in count(1):
+            try:
+                result = self.api.create_document(
+                    self.collection_id, upload_id, metadata=metadata, index=self.index
+                )
+                return result.get("id")
+            except AlephException as ae:
+                if not ae.transient or attempt > self.api.retries:
+                    log.error("Failed [%s]: %s", metadata.get("foreign_id"), ae)
+                    return None
+                backoff(ae, attempt)
+            except Exception:
+                log.exception("Failed [%s]: %s", self.collection_id, upload_id)
+                return None
+        return None
+
+    def close(self):
+        """Wait for pending documents and drop the unused upload URLs."""
+        self.document_pool.shutdown(wait=True)
+        while not self.urls.empty():
+            self.urls.get().cancel()
+        self.url_pool.shutdown(wait=True)
+
+
+class FilePack(object):
+    """A run of small files from one directory, uploaded together as a single
+    zip archive which the Aleph ingestors unpack."""
+
+    def __init__(self, directory: Path, number: int):
+        self.directory = directory
+        self.number = number
+        self.members: List[Tuple[Path, int]] = []
+        self.size = 0
+
+    @property
+    def name(self) -> str:
+        return "%s.pack-%d.zip" % (self.directory.name or "root", self.number)
+
+    def add(self, path: Path, size: int):
+        self.members.append((path, size))
+        self.size += size
+
+    def write(self, target: Path):
+        with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zf:
+            for path, _ in self.members:
+                zf.write(path, arcname=path.name)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __repr__(self):
+        return "<FilePack(%r, %d files)>" % (self.name, len(self))
+
 
 class CrawlDirectory(object):
     def __init__(
@@ -23,21 +146,34 @@ class CrawlDirectory(object):
         index: bool = True,
         nojunk: bool = False,
         signed_url: bool = False,
+        chunk_size: Optional[int] = None,
+        pipeline: Optional[SignedUrlPipeline] = None,
+        pack_threshold: Optional[int] = None,
+        pack_size: int = 16 * 1024 * 1024,
+        pack_manifest: Optional[Path] = None,
+        progress: Optional[Progress] = None,
     ):
         self.api = api
         self.index = index
         self.signed_url = signed_url
-        self.exclude = (
-            {
-                "f": re.compile(r"\..*|thumbs\.db|desktop\.ini", re.I),
-                "d": re.compile(r"\..*|\$recycle\.bin|system volume information", re.I),
-            }
-            if nojunk
-            else None
-        )
+        self.chunk_size = chunk_size
+        self.pipeline = pipeline
+        self.pack_threshold = pack_threshold
+        self.pack_size = pack_size
+        self.pack_manifest = pack_manifest
+        self.pack_lock = threading.Lock()
+        self.progress = progress
+        self.track_size = pack_threshold is not None or progress is not None
+        self.exclude = {"f": JUNK_FILES, "d": JUNK_DIRS} if nojunk else None
         self.collection = collection
         self.collection_id = cast(str, collection.get("id"))
         self.root = path
+        # Ids of the folders created so far, by local path.
+        self.folders: Dict[str, Optional[str]] = {}
+        # Folders which could not be created, with their parent id and the
+        # number of attempts made, held back until they can be retried.
+        self.retry_lane: List[Tuple[Path, Optional[str], int]] = []
+        self.failed_folders: List[Path] = []
         self.queue: Queue = Queue()
         self.scan_queue: Queue = Queue()
         if path.is_dir():
@@ -47,14 +183,62 @@ class CrawlDirectory(object):
             self.queue.put((path, None))
 
     def crawl(self):
-        while not self.scan_queue.empty():
-            path, parent_id = self.scan_queue.get()
-            id = None
-            foreign_id = self.get_foreign_id(Path(path))
-            if foreign_id is not None:
-                id = self.backoff_ingest_upload(path, parent_id, foreign_id)
-            self.scandir(path, id, parent_id)
-            self.scan_queue.task_done()
+        while True:
+            while not self.scan_queue.empty():
+                path, parent_id = self.scan_queue.get()
+                self.crawl_folder(path, parent_id)
+                self.scan_queue.task_done()
+            if not self.retry_lane:
+                break
+            self.retry_folders()
+
+    def crawl_folder(self, path: Path, parent_id: Optional[str], attempt: int = 1):
+        id = None
+        foreign_id = self.get_foreign_id(Path(path))
+        if foreign_id is not None:
+            try:
+                # Folders are created right away, never through the pipeline.
+                id = cast(str, self.retry_ingest_upload(path, parent_id, foreign_id))
+            except AlephException as err:
+                if err.transient:
+                    # Hold back the whole subtree rather than uploading it
+                    # without its parent folder, which would flatten it into
+                    # the root.
+                    self.retry_lane.append((path, parent_id, attempt))
+                else:
+                    self.fail_folder(path, err.message)
+                return
+            except Exception as exc:
+                log.exception("Failed [%s]: %s", self.collection_id, path)
+                self.fail_folder(path, str(exc))
+                return
+        self.folders[str(Path(path))] = id
+        self.scandir(path, id, parent_id)
+
+    def fail_folder(self, path: Path, reason: str):
+        """Give up on a folder, and so on its contents."""
+        log.error(
+            "Skipped [%s]: %s and its contents, folder upload failed: %s",
+            self.collection_id,
+            self.get_foreign_id(Path(path)),
+            reason,
+        )
+        self.failed_folders.append(Path(path))
+
+    def retry_folders(self):
+        """Try again to create the folders which failed with transient errors,
+        and crawl their contents once they exist. Folders still failing after
+        the configured number of retries are skipped along with their
+        contents."""
+        held, self.retry_lane = self.retry_lane, []
+        attempt = max(a for _, _, a in held)
+        log.warning("Retrying %d failed folders (round %d)", len(held), attempt)
+        backoff("folder upload failed", attempt)
+        for path, parent_id, attempt in held:
+            if attempt >= self.api.retries:
+                self.fail_folder(path, "no retries left")
+                continue
+            self.crawl_folder(path, parent_id, attempt + 1)
 
     def consume(self):
         while True:
@@ -63,9 +247,33 @@ class CrawlDirectory(object):
             if path is None:
                 self.queue.task_done()
                 break
-            self.backoff_ingest_upload(path, parent_id, self.get_foreign_id(Path(path)))
+            if isinstance(path, FilePack):
+                result = self.upload_pack(path, parent_id)
+                files = len(path)
+            else:
+                foreign_id = self.get_foreign_id(Path(path))
+                result = self.backoff_ingest_upload(path, parent_id, foreign_id)
+                files = 1
+            if self.progress is not None:
+                self.on_uploaded(result, partial(self.count_uploaded, files))
             self.queue.task_done()
 
+    def on_uploaded(self, result: Uploaded, callback: Callable[[Optional[str]], None]):
+        """Call back with the id of an uploaded document, or None if it
+        failed, once it is known: right away, or when the pipeline has
+        created the document."""
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: callback(future.result()))
+        else:
+            callback(result)
+
+    def count_uploaded(self, files: int, id: Optional[str]):
+        assert self.progress is not None
+        if id is None:
+            self.progress.update(failed=files)
+        else:
+            self.progress.update(files=files)
+
     def is_excluded(self, path: PathLike) -> bool:
         # The exclude pattern is constructed bearing in mind that will
         # be called using fullmatch.
@@ -78,19 +286,76 @@ class CrawlDirectory(object):
             return self.exclude["d"].fullmatch(path.name) is not None
         return self.exclude["f"].fullmatch(path.name) is not None
 
-    def scandir(self, path: Path, id: str, parent_id: str):
+    def scandir(self, path: Path, id: Optional[str], parent_id: Optional[str]):
+        pack = FilePack(Path(path), 1)
         with os.scandir(path) as iterator:
             while True:
                 child = next(iterator, None)
                 if child is None:
                     break
-                if self.is_excluded(child):
-                    continue
                 if child.is_dir():
+                    if self.is_excluded(child):
+                        continue
                     # Use a separate scan queue to avoid calling scandir recursively.
                     self.scan_queue.put((child, id))
+                    continue
+                if self.is_excluded(child):
+                    continue
+                size = child.stat().st_size if self.track_size else 0
+                if self.progress is not None:
+                    self.progress.add_total(files=1, bytes=size)
+                if self.pack_threshold is not None:
+                    if size >= self.pack_threshold:
+                        self.queue.put((child, id))
+                        continue
+                    pack.add(Path(child), size)
+                    if pack.size >= self.pack_size:
+                        self.queue.put((pack, id))
+                        pack = FilePack(Path(path), pack.number + 1)
                 else:
                     self.queue.put((child, id))
+        # A single small file is not worth an archive of its own.
+        if len(pack) == 1:
+            self.queue.put((pack.members[0][0], id))
+        elif len(pack):
+            self.queue.put((pack, id))
+
+    def upload_pack(self, pack: FilePack, parent_id: str) -> Uploaded:
+        """Zip the files in a pack, upload the archive and record which
+        archive each file went into."""
+        workdir = tempfile.mkdtemp(prefix="alephclient-")
+        try:
+            archive = Path(workdir).joinpath(pack.name)
+            pack.write(archive)
+            archive_path = pack.directory.joinpath(pack.name)
+            foreign_id = cast(str, self.get_foreign_id(archive_path))
+            result = self.backoff_ingest_upload(archive, parent_id, foreign_id)
+        except OSError:
+            log.exception("Failed [%s]: %r", self.collection_id, pack)
+            return None
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.on_uploaded(result, partial(self.record_pack, pack, foreign_id))
+        return result
+
+    def record_pack(self, pack: FilePack, foreign_id: str, id: Optional[str]):
+        if id is None:
+            log.error("Failed [%s]: %d packed files", foreign_id, len(pack))
+            return
+        for member, size in pack.members:
+            log.info("Packed [%s]: %s", foreign_id, self.get_foreign_id(member))
+        if self.pack_manifest is not None:
+            with self.pack_lock:
+                with open(self.pack_manifest, "a") as fh:
+                    for member, size in pack.members:
+                        record = {
+                            "bundle": foreign_id,
+                            "bundle_id": id,
+                            "foreign_id": self.get_foreign_id(member),
+                            "size": size,
+                        }
+                        fh.write(json.dumps(record))
+                        fh.write("\n")
 
     def get_foreign_id(self, path: Path) -> Optional[str]:
         if path == self.root:
@@ -104,9 +369,11 @@ class CrawlDirectory(object):
         except ValueError:
             return None
 
-    def backoff_ingest_upload(
-        self, path: Path, parent_id: str, foreign_id: str
-    ) -> Optional[str]:
+    def retry_ingest_upload(
+        self, path: Path, parent_id: Optional[str], foreign_id: str
+    ) -> Union[str, Future]:
+        """Upload a file or create a folder, retrying after transient errors.
+        The last error is raised."""
         try_number = 1
         while True:
             try:
@@ -116,13 +383,28 @@ class CrawlDirectory(object):
                     try_number += 1
                     backoff(err, try_number)
                 else:
-                    log.error(err.message)
-                    return None
-            except Exception:
-                log.exception("Failed [%s]: %s", self.collection_id, path)
-                return None
+                    raise
+
+    def backoff_ingest_upload(
+        self, path: Path, parent_id: Optional[str], foreign_id: str
+    ) -> Uploaded:
+        try:
+            return self.retry_ingest_upload(path, parent_id, foreign_id)
+        except AlephException as err:
+            log.error(err.message)
+            return None
+        except Exception:
+            log.exception("Failed [%s]: %s", self.collection_id, path)
+            return None
 
-    def ingest_upload(self, path: Path, parent_id: str, foreign_id: str) -> str:
+    def ingest_upload(
+        self,
+        path: Path,
+        parent_id: Optional[str],
+        foreign_id: str,
+    ) -> Union[str, Future]:
+        """Upload a file or create a folder, returning its id, or a future of
+        the id of a file sent through the pipeline."""
         metadata = {
             "foreign_id": foreign_id,
             "file_name": path.name,
@@ -130,12 +412,15 @@ class CrawlDirectory(object):
         log.info("Upload [%s->%s]: %s", self.collection_id, parent_id, foreign_id)
         if parent_id is not None:
             metadata["parent_id"] = parent_id
+        if self.pipeline is not None and not path.is_dir():
+            return self.pipeline.upload(path, metadata)
         if self.signed_url:
             result = self.api.signed_url_upload(
                 self.collection_id,
                 path,
                 metadata=metadata,
                 index=self.index,
+                chunk_size=self.chunk_size,
             )
         else:
             result = self.api.ingest_upload(
@@ -158,22 +443,86 @@ def crawl_dir(
     nojunk: bool = False,
     parallel: int = 1,
     signed_url: bool = False,
+    thread_sessions: bool = False,
+    chunk_size: Optional[int] = None,
+    pipeline: bool = False,
+    pack_threshold: Optional[int] = None,
+    pack_size: int = 16 * 1024 * 1024,
+    pack_manifest: Optional[str] = None,
+    watch: bool = False,
+    debounce: float = 2.0,
+    poll_interval: float = 5.0,
+    max_rate: Optional[float] = None,
+    progress: bool = False,
 ):
-    """Crawl a directory and upload its content to a collection
+    """Crawl a directory and upload its content to a collection. Raises an
+    AlephException at the end if any folders could not be created.
 
     params
     ------
     path: path of the directory
     foreign_id: foreign_id of the collection to use.
     language: language hint for the documents
+    parallel: number of upload threads; the connection pool is grown to match
+    thread_sessions: give each upload thread its own HTTP session
+    chunk_size: with signed_url, upload files larger than this in parts
+    pipeline: with signed_url, request upload URLs ahead and create documents
+    in the background
+    pack_threshold: zip files smaller than this many bytes together, in
+    archives of up to pack_size bytes per directory
+    pack_manifest: NDJSON file recording the archive each packed file went into
+    watch: after the crawl, keep uploading new and changed files until
+    interrupted. Uses inotify where available and polls every poll_interval
+    seconds otherwise; files are uploaded once unchanged for debounce seconds.
+    max_rate: cap on the bytes per second sent by all upload threads together
+    progress: report files and bytes done, throughput and ETA while crawling
     """
     root = Path(path).resolve()
+    # One connection per consumer, plus one for the producer creating folders.
+    connections = max(1, parallel) + 1
+    if thread_sessions:
+        api.thread_sessions = True
     collection = api.load_collection_by_foreign_id(foreign_id, config)
+    signed_url_pipeline = None
+    if signed_url and pipeline:
+        workers = max(2, parallel // 2)
+        signed_url_pipeline = SignedUrlPipeline(
+            api,
+            cast(str, collection.get("id")),
+            index=index,
+            chunk_size=chunk_size,
+            prefetch=2 * max(1, parallel),
+            workers=workers,
+        )
+        connections += 2 * workers
+    api.resize_pool(connections)
+    if max_rate:
+        api.upload_limiter = RateLimiter(max_rate)
+    crawl_progress = None
+    if progress:
+        crawl_progress = Progress(foreign_id)
+        api.upload_callback = crawl_progress.add_bytes
     crawler = CrawlDirectory(
-        api, collection, root, index=index, nojunk=nojunk, signed_url=signed_url
+        api,
+        collection,
+        root,
+        index=index,
+        nojunk=nojunk,
+        signed_url=signed_url,
+        chunk_size=chunk_size,
+        pipeline=signed_url_pipeline,
+        pack_threshold=pack_threshold,
+        pack_size=pack_size,
+        pack_manifest=Path(pack_manifest) if pack_manifest else None,
+        progress=crawl_progress,
     )
     consumers = []
 
+    # Start watching before the crawl, so no file added during it is missed.
+    watcher = None
+    if watch and root.is_dir():
+        watcher = make_watcher(root, crawler, interval=poll_interval)
+
     # Use one thread to produce using scandir and at least one to consume
     # files for upload.
     producer = threading.Thread(target=crawler.crawl, daemon=True)
@@ -189,6 +538,16 @@ def crawl_dir(
     # Block until the file upload queue is drained.
     crawler.queue.join()
 
+    if watcher is not None:
+        log.info("Watching [%s]: %s", foreign_id, root)
+        try:
+            watch_dir(crawler, watcher, debounce=debounce)
+        except KeyboardInterrupt:
+            log.info("Stopped watching [%s]: %s", foreign_id, root)
+        finally:
+            watcher.close()
+        crawler.queue.join()
+
     # Poison the queue to signal end to each consumer.
     for consumer in consumers:
         crawler.queue.put((None, None))
@@ -196,3 +555,27 @@ def crawl_dir(
     # Block until all file upload queue consumers are done.
     for consumer in consumers:
         consumer.join()
+
+    # Block until the documents for all uploaded files have been created.
+    if signed_url_pipeline is not None:
+        signed_url_pipeline.close()
+
+    if crawl_progress is not None:
+        crawl_progress.close()
+        api.upload_callback = None
+
+    stats = api.connection_stats()
+    log.info(
+        "Connections [%s]: %d requests over %d connections (%d reused)",
+        foreign_id,
+        stats["requests"],
+        stats["connections"],
+        stats["reused"],
+    )
+
+    if crawler.failed_folders:
+        failed = [str(crawler.get_foreign_id(p)) for p in crawler.failed_folders]
+        raise AlephException(
+            "%d folders could not be created, so their contents were not "
+            "uploaded: %s" % (len(failed), ", ".join(sorted(failed)))
+        )
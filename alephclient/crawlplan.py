@@ -0,0 +1,284 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+from alephclient.api import AlephAPI
+from alephclient.crawldir import JUNK_DIRS, JUNK_FILES
+from alephclient.progress import format_bytes, format_duration
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the file size histogram buckets.
+SIZE_BUCKETS = [
+    4 * 1024,
+    64 * 1024,
+    1024**2,
+    16 * 1024**2,
+    256 * 1024**2,
+    4 * 1024**3,
+]
+PARALLEL_STEPS = [1, 2, 4, 8, 16, 32]
+
+
+class CrawlPlan(object):
+    """Statistics on a directory tree which is about to be crawled, collected
+    by a parallel stat pass that walks the tree like `CrawlDirectory.scandir`
+    without uploading anything."""
+
+    def __init__(self, root: Path, nojunk: bool = False, sample: int = 0):
+        self.root = root
+        self.nojunk = nojunk
+        self.lock = threading.Lock()
+        self.files = 0
+        self.folders = 0
+        self.bytes = 0
+        self.junk_files = 0
+        self.junk_folders = 0
+        self.junk_bytes = 0
+        self.errors = 0
+        self.sizes: Counter = Counter()
+        self.extensions: Counter = Counter()
+        self.extension_bytes: Counter = Counter()
+        self.sample_size = sample
+        self.samples: List[Tuple[Path, int]] = []
+        self.duration = 0.0
+        # Seconds per file and per byte, measured by `benchmark`.
+        self.file_cost: Optional[float] = None
+        self.byte_cost: Optional[float] = None
+
+    def _add_file(self, path: str, size: int, junk: bool):
+        with self.lock:
+            if junk:
+                self.junk_files += 1
+                self.junk_bytes += size
+                if self.nojunk:
+                    return
+            self.files += 1
+            self.bytes += size
+            bucket = 0
+            while bucket < len(SIZE_BUCKETS) and size >= SIZE_BUCKETS[bucket]:
+                bucket += 1
+            self.sizes[bucket] += 1
+            ext = os.path.splitext(path)[1].lower() or "(none)"
+            self.extensions[ext] += 1
+            self.extension_bytes[ext] += size
+            # Reservoir sampling, so every file has the same chance.
+            if len(self.samples) < self.sample_size:
+                self.samples.append((Path(path), size))
+            elif self.sample_size:
+                index = random.randrange(self.files)
+                if index < self.sample_size:
+                    self.samples[index] = (Path(path), size)
+
+    def _scan(self, path: str, junk: bool) -> List[Tuple[str, bool]]:
+        """Stat the contents of one directory, returning its sub-directories."""
+        children: List[Tuple[str, bool]] = []
+        try:
+            with os.scandir(path) as iterator:
+                for entry in iterator:
+                    try:
+                        if entry.is_dir(follow_symlinks=True):
+                            is_junk = junk or bool(JUNK_DIRS.fullmatch(entry.name))
+                            children.append((entry.path, is_junk))
+                            continue
+                        size = entry.stat().st_size
+                    except OSError:
+                        with self.lock:
+                            self.errors += 1
+                        continue
+                    is_junk = junk or bool(JUNK_FILES.fullmatch(entry.name))
+                    self._add_file(entry.path, size, is_junk)
+        except OSError as exc:
+            log.warning("Cannot scan %s: %s", path, exc)
+            with self.lock:
+                self.errors += 1
+        return children
+
+    def scan(self, parallel: int = 8):
+        """Walk the tree with `parallel` threads stat-ing directories."""
+        started = time.monotonic()
+        if not self.root.is_dir():
+            self._add_file(str(self.root), self.root.stat().st_size, False)
+            self.duration = time.monotonic() - started
+            return
+        pending: Set[Future] = set()
+        done = threading.Condition()
+
+        def finished(future: Future):
+            with done:
+                pending.discard(future)
+                for child, junk in future.result():
+                    with self.lock:
+                        if junk:
+                            self.junk_folders += 1
+                        if not junk or not self.nojunk:
+                            self.folders += 1
+                    submit(child, junk)
+                done.notify_all()
+
+        def submit(path: str, junk: bool):
+            future = executor.submit(self._scan, path, junk)
+            pending.add(future)
+            future.add_done_callback(finished)
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            with done:
+                submit(str(self.root), False)
+                while pending:
+                    done.wait()
+        self.duration = time.monotonic() - started
+
+    def benchmark(
+        self,
+        api: AlephAPI,
+        foreign_id: str,
+        signed_url: bool = False,
+        chunk_size: Optional[int] = None,
+    ):
+        """Upload the sampled files one by one to a scratch collection, which
+        is deleted afterwards, and fit the time taken per upload as a fixed
+        cost per file plus a cost per byte. Files are sent the way the crawl
+        would send them, directly or through signed URLs."""
+        if not self.samples:
+            return
+        scratch = api.create_collection(
+            {
+                "foreign_id": "%s-crawl-plan-%d" % (foreign_id, time.time()),
+                "label": "alephclient crawl plan benchmark",
+                "category": "other",
+                "casefile": False,
+            }
+        )
+        timings: List[Tuple[int, float]] = []
+        try:
+            for path, size in self.samples:
+                started = time.monotonic()
+                metadata = {"foreign_id": path.name, "file_name": path.name}
+                if signed_url:
+                    api.signed_url_upload(
+                        scratch["id"],
+                        path,
+                        metadata=metadata,
+                        index=False,
+                        chunk_size=chunk_size,
+                    )
+                else:
+                    api.ingest_upload(
+                        scratch["id"], path, metadata=metadata, index=False
+                    )
+                timings.append((size, time.monotonic() - started))
+        finally:
+            api.delete_collection(scratch["id"])
+        self.file_cost, self.byte_cost = fit_costs(timings)
+
+    def estimate(self, parallel: int, max_rate: Optional[float] = None) -> float:
+        """Estimated seconds to upload the tree with `parallel` threads,
+        assuming they scale linearly up to the `max_rate` bandwidth cap."""
+        if self.file_cost is None or self.byte_cost is None:
+            raise ValueError("Run a benchmark first")
+        work = self.files * self.file_cost + self.bytes * self.byte_cost
+        seconds = work / max(1, parallel)
+        if max_rate:
+            seconds = max(seconds, self.bytes / max_rate)
+        return seconds
+
+    def format(self, top: int = 15, max_rate: Optional[float] = None) -> str:
+        lines = [
+            "Plan for %s (scanned in %.1fs)" % (self.root, self.duration),
+            "  Files:   %d (%s)" % (self.files, format_bytes(self.bytes)),
+            "  Folders: %d" % self.folders,
+            "  Junk (--nojunk): %d files, %d folders, %s%s"
+            % (
+                self.junk_files,
+                self.junk_folders,
+                format_bytes(self.junk_bytes),
+                " (excluded)" if self.nojunk else "",
+            ),
+        ]
+        if self.errors:
+            lines.append("  Unreadable: %d" % self.errors)
+        lines.append("")
+        lines.append("File sizes:")
+        labels = ["< %s" % format_bytes(upper) for upper in SIZE_BUCKETS]
+        labels.append(">= %s" % format_bytes(SIZE_BUCKETS[-1]))
+        for bucket, label in enumerate(labels):
+            lines.append(_bar(label, self.sizes[bucket], self.files))
+        lines.append("")
+        lines.append("Extensions:")
+        for ext, count in self.extensions.most_common(top):
+            line = _bar(ext, count, self.files)
+            line = "%s  %s" % (line, format_bytes(self.extension_bytes[ext]))
+            lines.append(line)
+        if self.file_cost is not None and self.byte_cost is not None:
+            lines.append("")
+            lines.append(
+                "Estimates (%d samples: %.3fs per file, %s/s per thread):"
+                % (
+                    len(self.samples),
+                    self.file_cost,
+                    format_bytes(1 / self.byte_cost) if self.byte_cost else "-",
+                )
+            )
+            for parallel in PARALLEL_STEPS:
+                seconds = self.estimate(parallel, max_rate=max_rate)
+                lines.append(
+                    "  --parallel %-3d %s" % (parallel, format_duration(seconds))
+                )
+        return "\n".join(lines)
+
+
+def _bar(label: str, count: int, total: int, width: int = 30) -> str:
+    share = count / total if total else 0.0
+    bar = "#" * int(round(share * width))
+    return "  %-12s %9d %5.1f%% %s" % (label, count, share * 100, bar)
+
+
+def fit_costs(timings: List[Tuple[int, float]]) -> Tuple[float, float]:
+    """Least-squares fit of `seconds = file_cost + size * byte_cost`."""
+    n = len(timings)
+    mean_size = sum(s for s, _ in timings) / n
+    mean_time = sum(t for _, t in timings) / n
+    var = sum((s - mean_size) ** 2 for s, _ in timings)
+    if var == 0:
+        return mean_time, 0.0
+    cov = sum((s - mean_size) * (t - mean_time) for s, t in timings)
+    byte_cost = max(0.0, cov / var)
+    file_cost = max(0.0, mean_time - byte_cost * mean_size)
+    return file_cost, byte_cost
+
+
+def plan_dir(
+    api: Optional[AlephAPI],
+    path: str,
+    foreign_id: str,
+    nojunk: bool = False,
+    sample: int = 0,
+    parallel: int = 8,
+    signed_url: bool = False,
+    chunk_size: Optional[int] = None,
+) -> CrawlPlan:
+    """Scan a directory without uploading it, and optionally benchmark the
+    upload of a sample of its files to estimate how long a crawl would take.
+
+    params
+    ------
+    path: path of the directory
+    foreign_id: foreign_id of the collection the crawl would go to
+    nojunk: exclude junk files from the counts, as crawldir --nojunk would
+    sample: number of files to upload to a scratch collection as a benchmark;
+    nothing is sent to the server if this is 0
+    parallel: number of threads stat-ing directories
+    signed_url: benchmark the signed URL workflow, as crawldir --signed-url
+    chunk_size: with signed_url, upload files larger than this in parts
+    """
+    plan = CrawlPlan(Path(path).resolve(), nojunk=nojunk, sample=sample)
+    plan.scan(parallel=parallel)
+    if api is not None and sample > 0:
+        plan.benchmark(api, foreign_id, signed_url=signed_url, chunk_size=chunk_size)
+    return plan
@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO
+
+from alephclient.api import AlephAPI
+from alephclient.errors import AlephException
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = "entitysets.json"
+
+
+class EntitySetDump(object):
+    """Writes entity sets and their items, which are fetched by several
+    threads at once: either into a directory, with one NDJSON file of
+    items per set next to an index of the sets, or as a single NDJSON
+    stream of records tagged with their type and set."""
+
+    def __init__(
+        self,
+        api: AlephAPI,
+        directory: Optional[Path] = None,
+        stream: Optional[TextIO] = None,
+        publisher: bool = False,
+    ):
+        if (directory is None) == (stream is None):
+            raise ValueError("Dump to either a directory or a stream")
+        self.api = api
+        self.directory = directory
+        self.stream = stream
+        self.publisher = publisher
+        self.lock = threading.Lock()
+        self.items = 0
+
+    def _write(self, record: Dict):
+        assert self.stream is not None
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.stream.write(line)
+
+    def write_set(self, entityset: Dict):
+        if self.stream is not None:
+            self._write({"type": "entityset", "entityset": entityset})
+
+    def dump_items(self, entityset: Dict) -> int:
+        """Fetch and write all items of a set, returning how many there were."""
+        entityset_id = entityset["id"]
+        items = self.api.entitysetitems(entityset_id, publisher=self.publisher)
+        count = 0
+        if self.directory is not None:
+            path = self.directory.joinpath("%s.items.json" % entityset_id)
+            tmp = path.with_name(path.name + ".tmp")
+            try:
+                with open(tmp, "w") as fh:
+                    for item in items:
+                        fh.write(json.dumps(item) + "\n")
+                        count += 1
+            except BaseException:
+                tmp.unlink()
+                raise
+            os.replace(tmp, path)
+        else:
+            for item in items:
+                record = {"type": "item", "entityset_id": entityset_id, "item": item}
+                self._write(record)
+                count += 1
+        with self.lock:
+            self.items += count
+        log.info("Entity set [%s]: %d items", entityset.get("label"), count)
+        return count
+
+    def write_index(self, entitysets: List[Dict]):
+        if self.directory is None:
+            return
+        path = self.directory.joinpath(INDEX_FILE)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as fh:
+            for entityset in entitysets:
+                fh.write(json.dumps(entityset) + "\n")
+        os.replace(tmp, path)
+
+
+def dump_entitysets(
+    api: AlephAPI,
+    collection_id: Optional[str] = None,
+    set_types: Optional[List[str]] = None,
+    directory: Optional[str] = None,
+    stream: Optional[TextIO] = None,
+    parallel: int = 4,
+    publisher: bool = False,
+) -> List[Dict]:
+    """Dump entity sets with their items, fetching the items of `parallel`
+    sets at a time. Sets are listed while the items of the first ones are
+    already being fetched.
+
+    params
+    ------
+    collection_id: only dump the sets of this collection
+    set_types: only dump sets of these types, e.g. list or diagram
+    directory: write `entitysets.json` and a `<id>.items.json` per set here
+    stream: write one NDJSON stream of `entityset` and `item` records here
+    parallel: number of sets whose items are fetched at the same time
+    publisher: add publisher info to the entities of the items
+    """
+    path = None
+    if directory is not None:
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+    dump = EntitySetDump(api, directory=path, stream=stream, publisher=publisher)
+    entitysets: List[Dict] = []
+    futures: List[Future] = []
+    slots = threading.BoundedSemaphore(max(1, parallel) * 2)
+
+    def dump_items(entityset: Dict) -> int:
+        try:
+            return dump.dump_items(entityset)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        for entityset in api.entitysets(
+            collection_id=collection_id, set_types=set_types
+        ):
+            entitysets.append(entityset)
+            dump.write_set(entityset)
+            slots.acquire()
+            futures.append(executor.submit(dump_items, entityset))
+    failed = 0
+    for entityset, future in zip(entitysets, futures):
+        exc = future.exception()
+        if exc is not None:
+            log.error("Entity set [%s] failed: %s", entityset.get("id"), exc)
+            failed += 1
+    dump.write_index(entitysets)
+    log.info("Dumped %d entity sets, %d items", len(entitysets), dump.items)
+    if failed:
+        raise AlephException("%d of %d entity sets failed" % (failed, len(entitysets)))
+    return entitysets
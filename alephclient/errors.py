@@ -1,4 +1,5 @@
 from requests import ConnectionError, Timeout
+from requests.exceptions import ChunkedEncodingError
 
 
 class AlephException(Exception):
@@ -6,7 +7,10 @@ class AlephException(Exception):
         self.exc = exc
         self.response = None
         self.status = None
-        self.transient = isinstance(exc, (ConnectionError, Timeout))
+        # A connection dropped while reading the body is as transient as one
+        # which could not be established.
+        transient = (ConnectionError, Timeout, ChunkedEncodingError)
+        self.transient = isinstance(exc, transient)
         self.message = str(exc)
         if hasattr(exc, "response") and exc.response is not None:
             self.response = exc.response
@@ -1,17 +1,36 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterable, Iterator, List, Dict, Optional, Set, Tuple
 
 from requests import RequestException
 from requests.exceptions import HTTPError
 
 from alephclient.api import AlephAPI, APIResultSet
 from alephclient.errors import AlephException
+from alephclient.util import backoff
+from alephclient.zipstream import extract_members, iter_entities
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 512 * 1024
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Out-of-order data kept in memory for hashing; beyond this, it is re-read
+# from disk once the hash gets to it.
+HASH_BUFFER = 64 * 1024 * 1024
+DONE_STATUSES = ("successful", "complete")
+FAILED_STATUSES = ("failed",)
 
 
 def list_exports(api: AlephAPI) -> List[Dict]:
     """Fetch all exports from the API, handling pagination."""
-    url = api._make_url("exports")
-    return list(APIResultSet(api, url))
+    return list(iter_exports(api))
 
 
 def format_exports_table(exports: List[Dict]) -> str:
@@ -40,17 +59,334 @@ def format_exports_table(exports: List[Dict]) -> str:
     return "\n".join(lines)
 
 
-def _get_export(api: AlephAPI, export_id: str) -> Dict:
-    """Fetch a single export by ID from the exports list."""
-    for export in list_exports(api):
+def iter_exports(api: AlephAPI) -> Iterator[Dict]:
+    """Iterate over the exports, fetching further pages only as needed."""
+    url = api._make_url("exports")
+    return iter(APIResultSet(api, url))
+
+
+# Hosts without an endpoint for a single export, i.e. an Aleph version which
+# can only list exports.
+_NO_DIRECT_LOOKUP: Set[str] = set()
+
+
+def get_export(api: AlephAPI, export_id: str) -> Dict:
+    """Fetch a single export by ID. If that is not possible, the list is
+    scanned until the ID is found. Servers are remembered as lacking the
+    endpoint when they answer 405, or 404 for an export the list has, since
+    a 404 alone may only mean that the export does not exist."""
+    missing = False
+    if api.base_url not in _NO_DIRECT_LOOKUP:
+        url = api._make_url(f"exports/{export_id}")
+        try:
+            return api._request("GET", url)
+        except AlephException as ae:
+            if ae.status == 405:
+                _NO_DIRECT_LOOKUP.add(api.base_url)
+            elif ae.status == 404:
+                missing = True
+            else:
+                raise
+    for export in iter_exports(api):
         if str(export.get("id")) == str(export_id):
+            if missing:
+                _NO_DIRECT_LOOKUP.add(api.base_url)
             return export
     raise AlephException(f"Export {export_id} not found")
 
 
-def download_export(api: AlephAPI, export_id: str, destination: str) -> Path:
-    """Download an export archive to the given destination path."""
-    export = _get_export(api, export_id)
+def wait_for_export(
+    api: AlephAPI,
+    export_id: str,
+    timeout: Optional[float] = None,
+    interval: float = 1.0,
+    max_interval: float = 60.0,
+) -> Dict:
+    """Poll an export until it is complete and return it. The interval grows
+    by half while the status is unchanged, and starts over when it changes,
+    so short exports are picked up quickly without hammering the server
+    during long ones."""
+    started = time.monotonic()
+    delay = interval
+    status = None
+    while True:
+        export = get_export(api, export_id)
+        if export.get("status") in DONE_STATUSES:
+            return export
+        if export.get("status") in FAILED_STATUSES:
+            raise AlephException(f"Export {export_id} failed")
+        if export.get("status") != status:
+            status = export.get("status")
+            delay = interval
+            log.info("Export %s: %s", export_id, status)
+        if timeout is not None:
+            remaining = timeout - (time.monotonic() - started)
+            if remaining <= 0:
+                raise AlephException(f"Timed out waiting for export {export_id}")
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        delay = min(delay * 1.5, max_interval)
+
+
+def _make_hasher(content_hash: Optional[str]):
+    """Parse a `content_hash` such as `sha1:deadbeef` (a bare digest is taken
+    to be SHA-1) into a hash object and the expected hex digest."""
+    if not content_hash:
+        return None, None
+    algorithm, _, digest = content_hash.rpartition(":")
+    try:
+        return hashlib.new(algorithm or "sha1"), digest.lower()
+    except ValueError:
+        log.warning("Cannot verify unknown hash: %s", content_hash)
+        return None, None
+
+
+class OrderedHasher(object):
+    """Feeds the chunks of a segmented download to a hash in file order, as
+    they arrive from several threads. Chunks ahead of the hash are buffered,
+    up to a limit; anything more is read back from the file when the hash
+    catches up, as are the segments completed before a resume."""
+
+    def __init__(self, hasher, path: Path, limit: int = HASH_BUFFER):
+        self.hasher = hasher
+        self.path = path
+        self.limit = limit
+        self.offset = 0
+        self.buffered = 0
+        self.buffer: Dict[int, bytes] = {}
+        self.spilled: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def update(self, offset: int, data: bytes):
+        """Hash data that has been written to the file at `offset`."""
+        with self.lock:
+            if offset != self.offset:
+                if self.buffered + len(data) > self.limit:
+                    self.spilled[offset] = len(data)
+                else:
+                    self.buffer[offset] = data
+                    self.buffered += len(data)
+                return
+            self.hasher.update(data)
+            self.offset += len(data)
+            self._advance()
+
+    def skip(self, offset: int, length: int):
+        """Hash a range which is already on disk, once the hash reaches it."""
+        with self.lock:
+            self.spilled[offset] = length
+            self._advance()
+
+    def _advance(self):
+        while True:
+            if self.offset in self.buffer:
+                data = self.buffer.pop(self.offset)
+                self.buffered -= len(data)
+            elif self.offset in self.spilled:
+                length = self.spilled.pop(self.offset)
+                data = self._read(self.offset, length)
+            else:
+                return
+            self.hasher.update(data)
+            self.offset += len(data)
+
+    def _read(self, offset: int, length: int) -> bytes:
+        with open(self.path, "rb") as fh:
+            fh.seek(offset)
+            data = fh.read(length)
+        if len(data) != length:
+            raise AlephException("Short read from %s" % self.path)
+        return data
+
+
+class SegmentedDownload(object):
+    """Downloads a file as parallel HTTP Range requests into a preallocated
+    `.part` file. Completed segments are recorded in a `.part.json` state
+    file, so an interrupted download only fetches what is missing."""
+
+    def __init__(
+        self,
+        api: AlephAPI,
+        url: str,
+        dest: Path,
+        size: int,
+        content_hash: Optional[str] = None,
+        parallel: int = 4,
+        segment_size: int = SEGMENT_SIZE,
+    ):
+        self.api = api
+        self.url = url
+        self.dest = dest
+        self.size = size
+        self.parallel = max(1, parallel)
+        self.segment_size = segment_size
+        self.part = dest.with_name(dest.name + ".part")
+        self.state = dest.with_name(dest.name + ".part.json")
+        self.content_hash = content_hash
+        self.lock = threading.Lock()
+        self.done: Set[int] = set()
+        hasher, self.digest = _make_hasher(content_hash)
+        self.hasher = None
+        if hasher is not None:
+            self.hasher = OrderedHasher(hasher, self.part)
+
+    @property
+    def segments(self) -> List[Tuple[int, int]]:
+        return [
+            (start, min(start + self.segment_size, self.size))
+            for start in range(0, self.size, self.segment_size)
+        ]
+
+    def _load_state(self):
+        if not self.part.exists() or not self.state.exists():
+            return
+        try:
+            with open(self.state, "r") as fh:
+                state = json.load(fh)
+        except ValueError:
+            return
+        # The signed URL changes between runs, the file it points to not.
+        for key in ("size", "segment_size", "content_hash"):
+            if state.get(key) != getattr(self, key):
+                return
+        self.done = set(state.get("done", []))
+        log.info("Resume: %s (%d segments done)", self.dest, len(self.done))
+
+    def _save_state(self):
+        state = {
+            "size": self.size,
+            "segment_size": self.segment_size,
+            "content_hash": self.content_hash,
+            "done": sorted(self.done),
+        }
+        tmp = self.state.with_name(self.state.name + ".tmp")
+        with open(tmp, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp, self.state)
+
+    def _preallocate(self):
+        with open(self.part, "wb") as fh:
+            if hasattr(os, "posix_fallocate") and self.size:
+                try:
+                    os.posix_fallocate(fh.fileno(), 0, self.size)
+                    return
+                except OSError:
+                    pass
+            fh.truncate(self.size)
+
+    def fetch_segment(self, index: int, start: int, end: int):
+        position = start
+        for attempt in count(1):
+            headers = {"Range": "bytes=%d-%d" % (position, end - 1)}
+            try:
+                res = self.api.session.get(self.url, headers=headers, stream=True)
+                try:
+                    res.raise_for_status()
+                    if res.status_code != 206:
+                        raise AlephException("Server ignored the range request")
+                    with open(self.part, "r+b") as fh:
+                        fh.seek(position)
+                        for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                            if not chunk:
+                                continue
+                            chunk = chunk[: end - position]
+                            fh.write(chunk)
+                            if self.hasher is not None:
+                                # The hash may read this range back from disk.
+                                fh.flush()
+                                self.hasher.update(position, chunk)
+                            position += len(chunk)
+                finally:
+                    res.close()
+                if position < end:
+                    raise AlephException("Segment %d was cut short" % index)
+                break
+            except (RequestException, HTTPError) as exc:
+                ae = AlephException(exc)
+                if not ae.transient or attempt > self.api.retries:
+                    raise ae from exc
+                backoff(ae, attempt)
+            except AlephException as ae:
+                if position == start or attempt > self.api.retries:
+                    raise
+                backoff(ae, attempt)
+        with self.lock:
+            self.done.add(index)
+            self._save_state()
+
+    def run(self) -> Path:
+        self._load_state()
+        if not self.done:
+            self._preallocate()
+        pending = []
+        for index, (start, end) in enumerate(self.segments):
+            if index in self.done:
+                if self.hasher is not None:
+                    self.hasher.skip(start, end - start)
+            else:
+                pending.append((index, start, end))
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = [executor.submit(self.fetch_segment, *p) for p in pending]
+            for future in futures:
+                future.result()
+        self.verify()
+        os.replace(self.part, self.dest)
+        self.state.unlink()
+        return self.dest
+
+    def verify(self):
+        if self.hasher is None:
+            return
+        if self.hasher.offset != self.size:
+            raise AlephException("Incomplete hash of %s" % self.dest)
+        digest = self.hasher.hasher.hexdigest()
+        if digest != self.digest:
+            self.part.unlink()
+            self.state.unlink()
+            raise AlephException(
+                "Checksum mismatch for %s: %s != %s" % (self.dest, digest, self.digest)
+            )
+
+
+def _stream_download(response, dest: Path, content_hash: Optional[str]) -> Path:
+    """Write a plain (non-ranged) response to `dest`, hashing it on the way."""
+    hasher, digest = _make_hasher(content_hash)
+    part = dest.with_name(dest.name + ".part")
+    with open(part, "wb") as fh:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                fh.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+    if hasher is not None and hasher.hexdigest() != digest:
+        part.unlink()
+        raise AlephException(
+            "Checksum mismatch for %s: %s != %s" % (dest, hasher.hexdigest(), digest)
+        )
+    os.replace(part, dest)
+    return dest
+
+
+def download_export(
+    api: AlephAPI,
+    export_id: str,
+    destination: str,
+    parallel: int = 4,
+    segment_size: int = SEGMENT_SIZE,
+    wait: bool = False,
+    timeout: Optional[float] = None,
+) -> Path:
+    """Download an export archive to the given destination path.
+
+    If the server supports range requests, the file is fetched in segments
+    over `parallel` connections and an interrupted download is resumed. The
+    data is verified against the export's `content_hash` as it arrives. With
+    `wait`, an export which is still being generated is polled until it is
+    complete, for up to `timeout` seconds."""
+    if wait:
+        export = wait_for_export(api, export_id, timeout=timeout)
+    else:
+        export = get_export(api, export_id)
     download_url = export.get("links", {}).get("download")
     if not download_url:
         raise AlephException(f"No download link for export {export_id}")
@@ -60,16 +396,124 @@ def download_export(api: AlephAPI, export_id: str, destination: str) -> Path:
     if dest.is_dir():
         dest = dest / file_name
     dest.parent.mkdir(parents=True, exist_ok=True)
+    content_hash = export.get("content_hash")
+
+    # Probe for range support with the first byte; servers without it send
+    # the whole file, which is then simply streamed.
+    try:
+        response = api.session.get(
+            download_url, headers={"Range": "bytes=0-0"}, stream=True
+        )
+        response.raise_for_status()
+    except (RequestException, HTTPError) as exc:
+        raise AlephException(exc) from exc
+
+    try:
+        if response.status_code != 206:
+            return _stream_download(response, dest, content_hash)
+        content_range = response.headers.get("Content-Range", "")
+        size = content_range.rsplit("/", 1)[-1]
+    finally:
+        response.close()
+    if not size.isdigit():
+        raise AlephException(f"Unknown size of export {export_id}")
+    download = SegmentedDownload(
+        api,
+        download_url,
+        dest,
+        int(size),
+        content_hash=content_hash,
+        parallel=parallel,
+        segment_size=segment_size,
+    )
+    return download.run()
+
+
+class HashingChunks(object):
+    """Passes the chunks of a download through while hashing them, so it
+    can be checked against the export's `content_hash` once consumed."""
+
+    def __init__(self, chunks: Iterable[bytes], content_hash: Optional[str]):
+        self.chunks = iter(chunks)
+        self.hasher, self.digest = _make_hasher(content_hash)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = next(self.chunks)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        return chunk
 
+    def verify(self):
+        """Consume the rest of the stream and compare the hashes."""
+        for _ in self:
+            pass
+        if self.hasher is not None and self.hasher.hexdigest() != self.digest:
+            raise AlephException(
+                "Checksum mismatch: %s != %s" % (self.hasher.hexdigest(), self.digest)
+            )
+
+
+def _open_export(
+    api: AlephAPI, export_id: str, wait: bool = False, timeout: Optional[float] = None
+):
+    if wait:
+        export = wait_for_export(api, export_id, timeout=timeout)
+    else:
+        export = get_export(api, export_id)
+    download_url = export.get("links", {}).get("download")
+    if not download_url:
+        raise AlephException(f"No download link for export {export_id}")
     try:
         response = api.session.get(download_url, stream=True)
         response.raise_for_status()
     except (RequestException, HTTPError) as exc:
         raise AlephException(exc) from exc
+    return export, response
 
-    with open(dest, "wb") as fh:
-        for chunk in response.iter_content(chunk_size=512 * 1024):
-            if chunk:
-                fh.write(chunk)
 
-    return dest
+def extract_export(
+    api: AlephAPI,
+    export_id: str,
+    target: str,
+    wait: bool = False,
+    timeout: Optional[float] = None,
+) -> List[Path]:
+    """Extract an export archive into the `target` directory while it is
+    downloaded, without storing the archive itself."""
+    export, response = _open_export(api, export_id, wait=wait, timeout=timeout)
+    try:
+        chunks = HashingChunks(
+            response.iter_content(chunk_size=CHUNK_SIZE), export.get("content_hash")
+        )
+        paths = extract_members(chunks, Path(target))
+        chunks.verify()
+    except (RequestException, HTTPError) as exc:
+        raise AlephException(exc) from exc
+    finally:
+        response.close()
+    return paths
+
+
+def stream_export_entities(
+    api: AlephAPI,
+    export_id: str,
+    wait: bool = False,
+    timeout: Optional[float] = None,
+) -> Iterator[Dict]:
+    """Yield the entities in an export archive while it is downloaded. The
+    checksum can only be verified at the end, so a mismatch is raised after
+    the last entity."""
+    export, response = _open_export(api, export_id, wait=wait, timeout=timeout)
+    try:
+        chunks = HashingChunks(
+            response.iter_content(chunk_size=CHUNK_SIZE), export.get("content_hash")
+        )
+        yield from iter_entities(chunks)
+        chunks.verify()
+    except (RequestException, HTTPError) as exc:
+        raise AlephException(exc) from exc
+    finally:
+        response.close()
@@ -1,11 +1,23 @@
+import os
+import json
+import hashlib
 import logging
-import requests
+import threading
+from fnmatch import fnmatch
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
 from pathlib import Path
 from pprint import pprint  # noqa
-from typing import Optional, Dict
+from typing import Optional, Dict, Iterable, List, Set, Tuple, Union
 from urllib.parse import urlparse, urljoin
+from requests import RequestException
+from requests.exceptions import HTTPError
 
-from alephclient.api import AlephAPI
+from alephclient.api import AlephAPI, EntityResultSet
+from alephclient.errors import AlephException
+from alephclient.progress import Progress
+from alephclient.util import backoff
 
 log = logging.getLogger(__name__)
 
@@ -23,58 +35,604 @@ def _get_filename(entity):
     return entity.get("id")
 
 
-def fetch_archive(url: str, path: Path):
-    with open(path, "wb") as fh:
-        res = requests.get(url)
-        for chunk in res.iter_content(chunk_size=512 * 1024):
-            if chunk:  # filter out keep-alive new chunks
-                fh.write(chunk)
+def _get_file_size(entity) -> int:
+    for file_size in entity.get("properties", {}).get("fileSize", []):
+        try:
+            return int(file_size)
+        except (TypeError, ValueError):
+            continue
+    return 0
 
 
-def fetch_object(api: AlephAPI, path: Path, entity: Dict, overwrite: bool = False):
-    file_name = _get_filename(entity)
-    path.mkdir(exist_ok=True, parents=True)
-    object_path = path.joinpath(file_name)
-    url = entity.get("links", {}).get("file")
-    if url is not None:
+def _get_parent(entity) -> Optional[str]:
+    for parent in entity.get("properties", {}).get("parent", []):
+        if isinstance(parent, dict):
+            parent = parent.get("id")
+        return parent
+    return None
+
+
+def _is_file(entity) -> bool:
+    if entity.get("links", {}).get("file") is not None:
+        return True
+    # Streamed entities come without links, but files have a content hash.
+    return "contentHash" in entity.get("properties", {})
+
+
+class EntityTree(object):
+    """An in-memory index from folder id to the documents in it, built from
+    a single stream of a collection's entities instead of one search per
+    folder. Only the properties needed to rebuild the tree are kept."""
+
+    PROPERTIES = ("fileName", "fileSize", "contentHash", "mimeType", "parent")
+
+    def __init__(self):
+        self.children: Dict[Optional[str], List[Dict]] = defaultdict(list)
+        self.count = 0
+
+    def add(self, entity: Dict):
+        properties = entity.get("properties", {})
+        compact = {
+            "id": entity.get("id"),
+            "schema": entity.get("schema"),
+            "properties": {k: v for k, v in properties.items() if k in self.PROPERTIES},
+        }
+        self.children[_get_parent(entity)].append(compact)
+        self.count += 1
+
+    @classmethod
+    def from_collection(cls, api: AlephAPI, collection: Dict) -> "EntityTree":
+        tree = cls()
+        include = ["id", "schema", "properties"]
+        entities = api.stream_entities(
+            collection=collection, include=include, schema="Document"
+        )
+        for entity in entities:
+            tree.add(entity)
+        log.info(
+            "Index [%s]: %d documents, %d folders",
+            collection.get("label"),
+            tree.count,
+            len(tree.children) - 1,
+        )
+        return tree
+
+    def roots(self) -> List[Dict]:
+        return self.children.get(None, [])
+
+
+class FetchFilter(object):
+    """A selection of the files to download. Schema and MIME type filters are
+    sent along with the folder listings, so the server only returns matching
+    files; sizes and path globs are checked locally, before a download."""
+
+    def __init__(
+        self,
+        schemata: Iterable[str] = (),
+        mime_types: Iterable[str] = (),
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        globs: Iterable[str] = (),
+    ):
+        self.schemata = set(schemata)
+        self.mime_types = set(m.lower() for m in mime_types)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.globs = list(globs)
+
+    @property
+    def search_filters(self) -> List[Tuple[str, str]]:
+        """Filters for `AlephAPI.search`. Wildcard MIME types such as
+        `image/*` have no search equivalent and are only matched locally."""
+        filters = [("schema", schema) for schema in sorted(self.schemata)]
+        if not any("*" in mime for mime in self.mime_types):
+            for mime in sorted(self.mime_types):
+                filters.append(("properties.mimeType", mime))
+        return filters
+
+    def matches(self, entity: Dict, path: str) -> bool:
+        """Check a file entity, which would be stored at the relative `path`."""
+        if self.schemata and entity.get("schema") not in self.schemata:
+            return False
+        if self.mime_types:
+            mimes = entity.get("properties", {}).get("mimeType", [])
+            mimes = [m.lower() for m in mimes]
+            if not any(fnmatch(m, p) for m in mimes for p in self.mime_types):
+                return False
+        size = _get_file_size(entity)
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.globs and not any(fnmatch(path, g) for g in self.globs):
+            return False
+        return True
+
+
+def fetch_archive(api: AlephAPI, url: str, path: Path):
+    """Download a file through the API session, with its connection pool, auth
+    headers and retry policy. Data goes to a `.part` file which is renamed
+    once complete; after an interruption, the download is resumed from the
+    end of the `.part` file with an HTTP Range request.
+
+    The API key is only sent to the Aleph host itself: archives kept in
+    object storage are linked with presigned URLs, which must not carry it."""
+    part = path.with_name(path.name + ".part")
+    target, base = urlparse(url), urlparse(api.base_url)
+    foreign = (target.scheme, target.netloc) != (base.scheme, base.netloc)
+    for attempt in count(1):
+        offset = part.stat().st_size if part.exists() else 0
+        headers: Dict[str, Optional[str]] = {}
+        if foreign:
+            headers["Authorization"] = None
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+        try:
+            with api.session.get(url, headers=headers, stream=True) as res:
+                if res.status_code == 416:
+                    # Nothing left to fetch if the part is already complete.
+                    length = res.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+                    if length == str(offset):
+                        break
+                    part.unlink()
+                    continue
+                res.raise_for_status()
+                # The server may ignore the range and send the whole file.
+                mode = "ab" if offset and res.status_code == 206 else "wb"
+                with open(part, mode) as fh:
+                    for chunk in res.iter_content(chunk_size=512 * 1024):
+                        if chunk:  # filter out keep-alive new chunks
+                            fh.write(chunk)
+            break
+        except (RequestException, HTTPError) as exc:
+            ae = AlephException(exc)
+            if not ae.transient or attempt > api.retries:
+                raise ae from exc
+            backoff(ae, attempt)
+    os.replace(part, path)
+
+
+class FetchManifest(object):
+    """Cache of the SHA-1 checksums of downloaded files, keyed by their path
+    relative to the download root and invalidated by size and mtime, so that
+    a sync only hashes files which changed locally."""
+
+    FILE_NAME = ".alephclient-manifest.json"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.path = root.joinpath(self.FILE_NAME)
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict] = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r") as fh:
+                    self.entries = json.load(fh)
+            except ValueError:
+                log.warning("Ignoring invalid manifest: %s", self.path)
+
+    def _key(self, path: Path) -> str:
+        return str(path.relative_to(self.root))
+
+    def checksum(self, path: Path) -> str:
+        key = self._key(path)
+        stat = path.stat()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                return entry["sha1"]
+        digest = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b""):
+                digest.update(block)
+        self.record(path, digest.hexdigest())
+        return digest.hexdigest()
+
+    def record(self, path: Path, checksum: str):
+        stat = path.stat()
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": checksum}
+        with self.lock:
+            self.entries[self._key(path)] = entry
+
+    def discard(self, path: Path):
+        with self.lock:
+            self.entries.pop(self._key(path), None)
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with self.lock:
+            with open(tmp, "w") as fh:
+                json.dump(self.entries, fh)
+        os.replace(tmp, self.path)
+
+
+class FetchDirectory(object):
+    """Download a tree of documents, listing folders and fetching files in
+    thread pools. Listings run in a small pool of their own and block when
+    too many downloads are waiting, so memory use stays bounded."""
+
+    # Files whose download links are looked up with one search request.
+    LINK_BATCH = 50
+
+    def __init__(
+        self,
+        api: AlephAPI,
+        overwrite: bool = False,
+        parallel: int = 1,
+        progress: Optional[Progress] = None,
+        tree: Optional[EntityTree] = None,
+        manifest: Optional[FetchManifest] = None,
+        selection: Optional[FetchFilter] = None,
+        root: Optional[Path] = None,
+    ):
+        self.api = api
+        self.tree = tree
+        self.manifest = manifest
+        self.selection = selection
+        self.root = root
+        # Every local path that belongs to the tree, for pruning.
+        self.expected: Set[Path] = set()
+        self.overwrite = overwrite
+        self.parallel = max(1, parallel)
+        self.progress = progress
+        self.downloads = ThreadPoolExecutor(max_workers=self.parallel)
+        self.listings = ThreadPoolExecutor(max_workers=min(self.parallel, 4))
+        self.slots = threading.BoundedSemaphore(self.parallel * 2)
+        self.pending = 0
+        self.done = threading.Condition()
+        self.errors = 0
+        # Folder listings which ended before their reported total.
+        self.truncated = 0
+        # Files without a download link, waiting for a batch lookup.
+        self.unlinked: List[Tuple[Path, Dict]] = []
+        # Entities in one folder may share a file name, so downloads to the
+        # same path take turns; one of a fixed set of locks is picked by path.
+        self.path_locks = [threading.Lock() for _ in range(64)]
+
+    def _submit(self, executor: ThreadPoolExecutor, fn, *args):
+        with self.done:
+            self.pending += 1
+        future = executor.submit(fn, *args)
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future: Future):
+        exc = future.exception()
+        with self.done:
+            if exc is not None:
+                self.errors += 1
+            self.pending -= 1
+            self.done.notify_all()
+        if exc is not None:
+            log.error("Fetch failed: %s", exc)
+
+    def fetch(self, path: Path, entity: Dict):
+        """Queue an entity for download into `path`, recursing into folders."""
+        if not _is_file(entity):
+            if self.tree is not None:
+                self.fetch_folder(path, entity)
+            else:
+                self._submit(self.listings, self.fetch_folder, path, entity)
+            return
+        if self.selection is not None:
+            object_path = path.joinpath(_get_filename(entity))
+            if self.root is not None:
+                object_path = object_path.relative_to(self.root)
+            if not self.selection.matches(entity, object_path.as_posix()):
+                return
+        if self.progress is not None:
+            self.progress.add_total(files=1, bytes=_get_file_size(entity))
+        if entity.get("links", {}).get("file") is None:
+            # Download links are signed, so streamed entities need them looked
+            # up; that is done in batches.
+            with self.done:
+                self.unlinked.append((path, entity))
+                batch = None
+                if len(self.unlinked) >= self.LINK_BATCH:
+                    batch, self.unlinked = self.unlinked, []
+            if batch is not None:
+                self._submit(self.listings, self.fetch_linked, batch)
+            return
+        self.download(path, entity)
+
+    def download(self, path: Path, entity: Dict):
+        self.slots.acquire()
+        try:
+            self._submit(self.downloads, self.fetch_file, path, entity)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def fetch_linked(self, batch: List[Tuple[Path, Dict]]):
+        """Look up the download links of a batch of files, then fetch them."""
+        ids = [entity["id"] for _, entity in batch]
+        found = self.api.get_entities(ids, parallel=1)
+        for (path, entity), linked in zip(batch, found):
+            if linked is not None:
+                entity = dict(entity, links=linked.get("links", {}))
+            self.download(path, entity)
+
+    def is_current(self, object_path: Path, entity: Dict) -> bool:
+        """Check if a file was already downloaded. With a manifest, the local
+        checksum must match the content hash, otherwise the file size."""
+        if self.overwrite or not object_path.exists():
+            return False
+        properties = entity.get("properties", {})
+        hashes = properties.get("contentHash", [])
+        if self.manifest is not None and len(hashes):
+            return self.manifest.checksum(object_path) in hashes
+        for file_size in properties.get("fileSize", []):
+            if int(file_size) == object_path.stat().st_size:
+                return True
+        return False
+
+    def fetch_file(self, path: Path, entity: Dict):
+        try:
+            file_name = _get_filename(entity)
+            path.mkdir(exist_ok=True, parents=True)
+            object_path = path.joinpath(file_name)
+            with self.done:
+                self.expected.add(object_path)
+            lock = self.path_locks[hash(object_path) % len(self.path_locks)]
+            with lock:
+                self.fetch_path(object_path, entity)
+        except Exception:
+            if self.progress is not None:
+                self.progress.update(failed=1)
+            raise
+        finally:
+            self.slots.release()
+
+    def fetch_path(self, object_path: Path, entity: Dict):
+        """Download a file to `object_path`, unless it is already there."""
+        path, file_name = object_path.parent, object_path.name
+        if self.is_current(object_path, entity):
+            log.info("Skip [%s]: %s", path, file_name)
+            self._done(entity)
+            return
+        url = entity.get("links", {}).get("file")
+        if url is None:
+            raise AlephException("No file link for %s" % entity["id"])
         # Aleph Pro may return relative URLs (e.g. /api/2/archive?token=...)
         if not urlparse(url).scheme:
-            url = urljoin(api.base_url, url)
-        # Skip existing files after checking file size:
-        if not overwrite and object_path.exists():
-            for file_size in entity.get("properties", {}).get("fileSize", []):
-                if int(file_size) == object_path.stat().st_size:
-                    log.info("Skip [%s]: %s", path, file_name)
-                    return
+            url = urljoin(self.api.base_url, url)
 
         log.info("Fetch [%s]: %s", path, file_name)
-        return fetch_archive(url, object_path)
+        fetch_archive(self.api, url, object_path)
+        if self.manifest is not None:
+            self.manifest.discard(object_path)
+            hashes = entity.get("properties", {}).get("contentHash", [])
+            checksum = self.manifest.checksum(object_path)
+            if len(hashes) and checksum not in hashes:
+                self.manifest.discard(object_path)
+                object_path.unlink()
+                msg = "Checksum mismatch [%s]: %s" % (path, file_name)
+                raise AlephException(msg)
+        self._done(entity)
+
+    def _done(self, entity: Dict):
+        if self.progress is not None:
+            self.progress.update(files=1, bytes=_get_file_size(entity))
+
+    def fetch_folder(self, path: Path, entity: Dict):
+        file_name = _get_filename(entity)
+        path.mkdir(exist_ok=True, parents=True)
+        object_path = path.joinpath(file_name)
+        with self.done:
+            self.expected.add(object_path)
+        if self.tree is not None:
+            results: Union[List[Dict], EntityResultSet] = self.tree.children.get(
+                entity.get("id"), []
+            )
+        else:
+            filters = [("properties.parent", entity.get("id"))]
+            results = self.list(filters)
+        log.info("Directory [%s]: %s (%d children)", path, file_name, len(results))
+        self.fetch_listing(object_path, results)
 
-    filters = [("properties.parent", entity.get("id"))]
-    results = api.search("", filters=filters, schemata="Document")
-    log.info("Directory [%s]: %s (%d children)", path, file_name, len(results))
-    for entity in results:
-        fetch_object(api, object_path, entity, overwrite=overwrite)
+    def fetch_listing(self, path: Path, results: Union[List[Dict], EntityResultSet]):
+        """Queue all entities of a folder listing for download into `path`."""
+        seen = 0
+        for entity in results:
+            seen += 1
+            self.fetch(path, entity)
+        self._check_listing(path, results, seen)
+
+    def _check_listing(self, where, results, seen: int):
+        # Aleph caps how far a search can be paged, after which a listing
+        # ends quietly; the folder is then incomplete and must not be pruned.
+        if seen < len(results):
+            log.warning("Listing [%s]: %d of %d seen", where, seen, len(results))
+            with self.done:
+                self.truncated += 1
+
+    def list(
+        self, filters: List, params: Optional[Dict] = None
+    ) -> Union[List[Dict], EntityResultSet]:
+        """Search the documents in a folder. When the selection has search
+        filters, sub-folders are listed separately so they are not dropped."""
+        if self.selection is None or not self.selection.search_filters:
+            return self.api.search(
+                "", filters=filters, schemata="Document", params=params
+            )
+        folders = self.api.search("", filters=filters, schemata="Folder", params=params)
+        files_filters = filters + self.selection.search_filters
+        files = self.api.search(
+            "", filters=files_filters, schemata="Document", params=params
+        )
+        results: Dict[str, Dict] = {}
+        for listing in (folders, files):
+            entities = list(listing)
+            self._check_listing(filters, listing, len(entities))
+            for entity in entities:
+                results.setdefault(entity.get("id"), entity)
+        return list(results.values())
+
+    def wait(self):
+        """Block until everything queued so far has been downloaded."""
+        while True:
+            with self.done:
+                self.done.wait_for(lambda: self.pending == 0)
+                batch, self.unlinked = self.unlinked, []
+            if not batch:
+                return
+            self._submit(self.listings, self.fetch_linked, batch)
+
+    def close(self):
+        """Wait for all downloads and stop the pools. Raises if any listing
+        or download failed, after the others have completed."""
+        self.wait()
+        self.listings.shutdown(wait=True)
+        self.downloads.shutdown(wait=True)
+        if self.progress is not None:
+            self.progress.close()
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.errors:
+            raise AlephException("%d fetches failed, see log" % self.errors)
+
+    def prune(self, root: Path):
+        """Delete the files and folders under `root` which are not part of
+        the tree that was fetched. Must only be called after a complete fetch,
+        since anything not seen is considered deleted upstream. Nothing is
+        deleted if a folder listing was cut short."""
+        if self.truncated:
+            log.warning("Not pruning, %d listings were incomplete", self.truncated)
+            return
+        keep = {p for p in self.expected}
+        if self.manifest is not None:
+            keep.add(self.manifest.path)
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            for name in filenames:
+                path = Path(dirpath, name)
+                if path in keep:
+                    continue
+                log.info("Prune: %s", path)
+                path.unlink()
+                if self.manifest is not None:
+                    self.manifest.discard(path)
+            directory = Path(dirpath)
+            if directory == root or directory in keep:
+                continue
+            if not any(directory.iterdir()):
+                log.info("Prune: %s", directory)
+                directory.rmdir()
+        if self.manifest is not None:
+            self.manifest.save()
+
+
+def _fetcher(
+    api: AlephAPI,
+    root: Path,
+    overwrite: bool,
+    parallel: int,
+    progress: bool,
+    tree: Optional[EntityTree] = None,
+    manifest: Optional[FetchManifest] = None,
+    selection: Optional[FetchFilter] = None,
+):
+    return FetchDirectory(
+        api,
+        overwrite=overwrite,
+        parallel=parallel,
+        progress=Progress("fetch") if progress else None,
+        tree=tree,
+        manifest=manifest,
+        selection=selection,
+        root=root,
+    )
+
+
+def fetch_object(api: AlephAPI, path: Path, entity: Dict, overwrite: bool = False):
+    fetcher = FetchDirectory(api, overwrite=overwrite)
+    try:
+        fetcher.fetch(path, entity)
+    finally:
+        fetcher.close()
 
 
 def fetch_entity(
-    api: AlephAPI, prefix: Optional[str], entity_id: str, overwrite: bool = False
+    api: AlephAPI,
+    prefix: Optional[str],
+    entity_id: str,
+    overwrite: bool = False,
+    parallel: int = 1,
+    progress: bool = False,
+    tree: bool = False,
+    sync: bool = False,
+    selection: Optional[FetchFilter] = None,
 ):
+    path = _fix_path(prefix)
     entity = api.get_entity(entity_id)
-    return fetch_object(api, _fix_path(prefix), entity, overwrite=overwrite)
+    index = None
+    if tree and entity.get("collection"):
+        index = EntityTree.from_collection(api, entity["collection"])
+    manifest = FetchManifest(path) if sync else None
+    fetcher = _fetcher(
+        api, path, overwrite, parallel, progress, index, manifest, selection
+    )
+    try:
+        fetcher.fetch(path, entity)
+    finally:
+        fetcher.close()
 
 
 def fetch_collection(
-    api: AlephAPI, prefix: Optional[str], foreign_id: str, overwrite: bool = False
+    api: AlephAPI,
+    prefix: Optional[str],
+    foreign_id: str,
+    overwrite: bool = False,
+    parallel: int = 1,
+    progress: bool = False,
+    tree: bool = False,
+    sync: bool = False,
+    prune: bool = False,
+    selection: Optional[FetchFilter] = None,
 ):
+    """Download all documents of a collection into a folder tree.
+
+    params
+    ------
+    prefix: local directory to download into, the working directory if None
+    foreign_id: foreign_id of the collection
+    overwrite: download files again even if they exist with the right size
+    parallel: number of files to download at the same time
+    progress: report files and bytes downloaded, throughput and ETA
+    tree: index the whole collection with one entity stream, rather than
+    searching for the contents of each folder. Streamed entities have no
+    download links, so these are then looked up with one search request
+    per 50 files.
+    sync: compare existing files by content hash rather than size, keeping
+    local checksums in a manifest file in the prefix directory
+    prune: after a complete download, delete everything in the prefix
+    directory which is not in the collection (or not selected). Needs an
+    explicit prefix, and is skipped if a folder listing was cut short.
+    selection: only download the files matching this filter
+    """
+    if prune and prefix is None:
+        raise AlephException("Pruning needs an explicit prefix directory")
     path = _fix_path(prefix)
     collection = api.get_collection_by_foreign_id(foreign_id)
     if collection is None:
         return
-    filters = [("collection_id", collection.get("id"))]
-    params = {"empty:properties.parent": "true"}
-    results = api.search("", filters=filters, schemata="Document", params=params)
     label = collection.get("label")
-    log.info("Dataset [%s]: %s (%d children)", path, label, len(results))
-    for entity in results:
-        fetch_object(api, path, entity, overwrite=overwrite)
+    index = None
+    manifest = FetchManifest(path) if sync or prune else None
+    if tree:
+        index = EntityTree.from_collection(api, collection)
+    fetcher = _fetcher(
+        api, path, overwrite, parallel, progress, index, manifest, selection
+    )
+    try:
+        if index is not None:
+            results: Union[List[Dict], EntityResultSet] = index.roots()
+        else:
+            filters = [("collection_id", collection.get("id"))]
+            params = {"empty:properties.parent": "true"}
+            results = fetcher.list(filters, params=params)
+        log.info("Dataset [%s]: %s (%d children)", path, label, len(results))
+        fetcher.fetch_listing(path, results)
+    finally:
+        fetcher.close()
+    if prune:
+        fetcher.prune(path)
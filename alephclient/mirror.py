@@ -0,0 +1,249 @@
+import json
+import time
+import sqlite3
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional
+
+from alephclient import settings
+from alephclient.api import AlephAPI
+from alephclient.errors import AlephException
+
+log = logging.getLogger(__name__)
+
+# Properties with a value index unless others are chosen; the rest can be
+# queried too, but by scanning the stored entities.
+INDEX_PROPERTIES = ["name", "email", "phone", "registrationNumber", "fileName"]
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    id TEXT PRIMARY KEY,
+    schema TEXT,
+    updated_at TEXT,
+    generation INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS entities_schema ON entities (schema);
+CREATE INDEX IF NOT EXISTS entities_generation ON entities (generation);
+CREATE TABLE IF NOT EXISTS props (
+    entity_id TEXT,
+    prop TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS props_value ON props (prop, value);
+CREATE INDEX IF NOT EXISTS props_entity ON props (entity_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class EntityMirror(object):
+    """A copy of a collection's entities in a SQLite file, indexed by id,
+    schema and the values of selected properties.
+
+    Aleph cannot stream only what changed, so a sync streams the whole
+    collection, unless its data has not been updated since the last sync
+    at all. Only entities which are new or have a different `updated_at`
+    are written, and the ones which are no longer streamed are deleted."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript(SCHEMA)
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        result = row.fetchone()
+        return result[0] if result else None
+
+    def _set_meta(self, key: str, value: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    @property
+    def collection(self) -> Optional[Dict]:
+        data = self._meta("collection")
+        return json.loads(data) if data else None
+
+    @property
+    def properties(self) -> List[str]:
+        data = self._meta("properties")
+        return json.loads(data) if data else list(INDEX_PROPERTIES)
+
+    def _write(self, entity: Dict, generation: int, properties: Iterable[str]):
+        entity_id = entity.get("id")
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entities "
+            "(id, schema, updated_at, generation, data) VALUES (?, ?, ?, ?, ?)",
+            (
+                entity_id,
+                entity.get("schema"),
+                entity.get("updated_at"),
+                generation,
+                json.dumps(entity),
+            ),
+        )
+        self.conn.execute("DELETE FROM props WHERE entity_id = ?", (entity_id,))
+        values = entity.get("properties", {})
+        rows = [
+            (entity_id, prop, str(value))
+            for prop in properties
+            for value in values.get(prop, [])
+        ]
+        self.conn.executemany(
+            "INSERT INTO props (entity_id, prop, value) VALUES (?, ?, ?)", rows
+        )
+
+    def sync(
+        self,
+        api: AlephAPI,
+        collection: Dict,
+        properties: Optional[List[str]] = None,
+        force: bool = False,
+    ) -> Dict[str, int]:
+        """Bring the mirror up to date with the collection.
+
+        params
+        ------
+        collection: the collection to mirror, as returned by the API
+        properties: names of the properties to index the values of
+        force: stream the collection even if it has not been updated
+        """
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        previous = self.collection
+        if previous is not None and previous.get("id") != collection.get("id"):
+            raise AlephException(
+                "%s mirrors another collection: %s" % (self.path, previous.get("id"))
+            )
+        properties = sorted(properties or self.properties)
+        reindex = properties != sorted(self.properties)
+        stamp = collection.get("data_updated_at") or collection.get("updated_at")
+        if not force and not reindex and stamp and stamp == self._meta("stamp"):
+            log.info("Mirror [%s]: up to date", collection.get("label"))
+            return stats
+        generation = int(self._meta("generation") or 0) + 1
+        started = time.monotonic()
+        for index, entity in enumerate(api.stream_entities(collection=collection)):
+            row = self.conn.execute(
+                "SELECT updated_at FROM entities WHERE id = ?", (entity.get("id"),)
+            ).fetchone()
+            updated_at = entity.get("updated_at")
+            if row is not None and not reindex and updated_at and row[0] == updated_at:
+                self.conn.execute(
+                    "UPDATE entities SET generation = ? WHERE id = ?",
+                    (generation, entity.get("id")),
+                )
+                stats["unchanged"] += 1
+            else:
+                self._write(entity, generation, properties)
+                stats["updated" if row is not None else "added"] += 1
+            if index % BATCH_SIZE == BATCH_SIZE - 1:
+                self.conn.commit()
+        self.conn.execute(
+            "DELETE FROM props WHERE entity_id IN "
+            "(SELECT id FROM entities WHERE generation < ?)",
+            (generation,),
+        )
+        cursor = self.conn.execute(
+            "DELETE FROM entities WHERE generation < ?", (generation,)
+        )
+        stats["deleted"] = cursor.rowcount
+        self._set_meta("generation", str(generation))
+        self._set_meta("stamp", stamp or "")
+        self._set_meta("properties", json.dumps(properties))
+        self._set_meta("collection", json.dumps(collection))
+        self.conn.commit()
+        log.info(
+            "Mirror [%s]: %s in %.1fs",
+            collection.get("label"),
+            ", ".join("%d %s" % (v, k) for k, v in stats.items()),
+            time.monotonic() - started,
+        )
+        return stats
+
+    def get(self, entity_id: str) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT data FROM entities WHERE id = ?", (entity_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def query(
+        self,
+        schema: Optional[str] = None,
+        properties: Optional[Mapping[str, str]] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[Dict]:
+        """Find the entities with the given schema and property values, which
+        must all match. Values of indexed properties are looked up in the
+        index, others by scanning the entities."""
+        clauses: List[str] = []
+        params: List = []
+        if schema is not None:
+            clauses.append("schema = ?")
+            params.append(schema)
+        indexed = self.properties
+        for prop, value in (properties or {}).items():
+            if prop in indexed:
+                clauses.append(
+                    "id IN (SELECT entity_id FROM props WHERE prop = ? AND value = ?)"
+                )
+                params.extend([prop, value])
+            else:
+                clauses.append(
+                    "EXISTS (SELECT 1 FROM json_each(data, ?) WHERE value = ?)"
+                )
+                params.extend(["$.properties.%s" % prop, value])
+        sql = "SELECT data FROM entities"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for (data,) in self.conn.execute(sql, params):
+            yield json.loads(data)
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def mirror_path(foreign_id: str) -> Path:
+    """The default location of the mirror of a collection."""
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in foreign_id)
+    return Path(settings.CACHE_DIR, "mirror", "%s.sqlite" % name)
+
+
+def mirror_collection(
+    api: AlephAPI,
+    foreign_id: str,
+    path: Optional[str] = None,
+    properties: Optional[List[str]] = None,
+    force: bool = False,
+) -> Dict[str, int]:
+    """Create or refresh the local mirror of a collection.
+
+    params
+    ------
+    foreign_id: foreign_id of the collection
+    path: SQLite file of the mirror, by default in the cache directory
+    properties: names of the properties to index the values of
+    force: stream the collection even if it has not been updated
+    """
+    collection = api.get_collection_by_foreign_id(foreign_id)
+    if collection is None:
+        raise AlephException("Collection does not exist: %s" % foreign_id)
+    # Lookups by foreign_id may be cached, but the stamp which decides
+    # whether to sync at all must be current.
+    collection = api.get_collection(collection["id"])
+    mirror = EntityMirror(Path(path) if path else mirror_path(foreign_id))
+    try:
+        return mirror.sync(api, collection, properties=properties, force=force)
+    finally:
+        mirror.close()
@@ -0,0 +1,121 @@
+import sys
+import time
+import logging
+import threading
+from typing import Optional, TextIO
+
+log = logging.getLogger(__name__)
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(size) < 1024 or unit == "TB":
+            break
+        size /= 1024.0
+    return "%.1f %s" % (size, unit)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Progress(object):
+    """Thread-safe counters of files and bytes, both discovered so far and
+    done, periodically reported as a single status line.
+
+    On a terminal the line is redrawn in place, otherwise it is logged."""
+
+    def __init__(
+        self,
+        label: str,
+        stream: Optional[TextIO] = None,
+        interval: float = 1.0,
+        unit: str = "files",
+    ):
+        self.label = label
+        self.unit = unit
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.reported = 0.0
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+
+    def add_total(self, files: int = 0, bytes: int = 0):
+        with self.lock:
+            self.files_total += files
+            self.bytes_total += bytes
+
+    def update(self, files: int = 0, bytes: int = 0, failed: int = 0):
+        with self.lock:
+            self.files += files
+            self.bytes += bytes
+            self.failed += failed
+        self.report()
+
+    def add_bytes(self, bytes: int):
+        """Count bytes done, for use as a callback while data is transferred."""
+        self.update(bytes=bytes)
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+
+    @property
+    def eta(self) -> Optional[float]:
+        rate = self.rate
+        if rate <= 0 or self.bytes_total <= 0:
+            return None
+        return max(0, self.bytes_total - self.bytes) / rate
+
+    def render(self) -> str:
+        files = "%d/%d %s" % (self.files, self.files_total, self.unit)
+        if not self.files_total:
+            files = "%d %s" % (self.files, self.unit)
+        if self.failed:
+            files = "%s (%d failed)" % (files, self.failed)
+        if not self.bytes_total and not self.bytes:
+            # Counting items only, e.g. requests.
+            elapsed = time.monotonic() - self.started
+            rate = self.files / elapsed if elapsed > 0 else 0.0
+            line = "[%s] %s, %.1f/s" % (self.label, files, rate)
+            if rate > 0 and self.files_total:
+                remaining = max(0, self.files_total - self.files) / rate
+                line = "%s, ETA %s" % (line, format_duration(remaining))
+            return line
+        done = format_bytes(self.bytes)
+        total = format_bytes(self.bytes_total)
+        rate = self.rate / (1024 * 1024)
+        line = "[%s] %s, %s/%s, %.2f MB/s" % (self.label, files, done, total, rate)
+        eta = self.eta
+        if eta is not None:
+            line = "%s, ETA %s" % (line, format_duration(eta))
+        return line
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.reported < self.interval:
+                return
+            self.reported = now
+            line = self.render()
+        if self.stream.isatty():
+            self.stream.write("\r\x1b[K" + line)
+            self.stream.flush()
+        else:
+            log.info(line)
+
+    def close(self):
+        self.report(force=True)
+        if self.stream.isatty():
+            self.stream.write("\n")
@@ -11,3 +11,32 @@ API_KEY = os.environ.get("ALEPHCLIENT_API_KEY", API_KEY)
 
 MAX_TRIES = int(os.environ.get("ALEPHCLIENT_MAX_TRIES", 5))
 MEMORIOUS_RATE_LIMIT = int(os.environ.get("ALEPHCLIENT_MEMORIOUS_RATE_LIMIT", 120))
+
+# Maximum number of keep-alive connections kept open per host
+POOL_SIZE = int(os.environ.get("ALEPHCLIENT_POOL_SIZE", 10))
+
+# Local caches, e.g. of collections looked up by foreign_id
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "alephclient"
+)
+CACHE_DIR = os.environ.get("ALEPHCLIENT_CACHE_DIR", CACHE_DIR)
+# Seconds a collection looked up by foreign_id is remembered (0 = off)
+COLLECTION_CACHE_TTL = int(os.environ.get("ALEPHCLIENT_COLLECTION_CACHE_TTL", 0))
+
+# Cache of GET responses: entries kept in memory (0 = off), whether to keep
+# them on disk as well, and TTLs in seconds per endpoint, during which they
+# are used without revalidation, e.g. "entities=300,collections=60".
+HTTP_CACHE_SIZE = int(os.environ.get("ALEPHCLIENT_HTTP_CACHE_SIZE", 0))
+HTTP_CACHE_DISK = os.environ.get("ALEPHCLIENT_HTTP_CACHE_DISK", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+HTTP_CACHE_TTLS = {
+    endpoint.strip(): float(ttl)
+    for endpoint, _, ttl in (
+        item.partition("=")
+        for item in os.environ.get("ALEPHCLIENT_HTTP_CACHE_TTLS", "").split(",")
+    )
+    if endpoint.strip() and ttl
+}
@@ -0,0 +1,233 @@
+from urllib.parse import parse_qsl, urlparse
+
+import pytest
+from click.testing import CliRunner
+
+from requests import Response
+from requests.exceptions import HTTPError
+
+from alephclient.api import AlephAPI
+from alephclient.cli import cli
+from alephclient.errors import AlephException
+
+
+def _error(status):
+    response = Response()
+    response.status_code = status
+    return AlephException(HTTPError(response=response))
+
+
+class TestGetEntities:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _mock(self, mocker, searchable, gettable):
+        calls = []
+
+        def request(method, url):
+            calls.append(url)
+            parsed = urlparse(url)
+            if parsed.path.endswith("/entities"):
+                ids = [v for k, v in parse_qsl(parsed.query) if k == "filter:id"]
+                results = [{"id": i} for i in ids if i in searchable]
+                return {"results": results}
+            entity_id = parsed.path.rsplit("/", 1)[-1]
+            if entity_id not in gettable:
+                raise _error(404)
+            return {"id": entity_id, "schema": "Ownership"}
+
+        mocker.patch.object(self.api, "_request", side_effect=request)
+        return calls
+
+    def test_get_entities(self, mocker):
+        searchable = {str(i) for i in range(10)}
+        calls = self._mock(mocker, searchable, {"own"})
+        ids = ["9", "own", "1", "gone", "1"] + [str(i) for i in range(2, 7)]
+        entities = self.api.get_entities(ids, batch_size=4)
+        assert [e["id"] if e else None for e in entities] == [
+            "9",
+            "own",
+            "1",
+            None,
+            "1",
+        ] + [str(i) for i in range(2, 7)]
+        # Eight unique ids in batches of four, then single lookups.
+        searches = [c for c in calls if urlparse(c).path.endswith("/entities")]
+        assert len(searches) == 3
+        assert len(calls) == 5
+        # Each entity gets its own patched copy.
+        assert entities[2] is not entities[4]
+        assert "alephUrl" in entities[0]["properties"]
+
+    def test_publisher(self, mocker):
+        self._mock(mocker, {"a"}, set())
+        entities = self.api.get_entities(["a"], publisher=True)
+        assert "publisher" in entities[0]["properties"]
+
+    def test_duplicates_with_properties(self, mocker):
+        entity = {"id": "a", "schema": "Person", "properties": {"name": ["A"]}}
+        mocker.patch.object(self.api, "_fetch_entities", return_value={"a": entity})
+        first, second = self.api.get_entities(["a", "a"])
+        url = self.fake_url + "entities/a"
+        assert first["properties"]["alephUrl"] == [url]
+        assert second["properties"]["alephUrl"] == [url]
+        assert first["properties"] is not second["properties"]
+        # The entities as fetched are left alone.
+        assert entity["properties"] == {"name": ["A"]}
+
+    def test_errors(self, mocker):
+        mocker.patch.object(self.api, "_request", side_effect=AlephException("broken"))
+        with pytest.raises(AlephException):
+            self.api.get_entities(["a"])
+
+
+class TestDeleteEntities:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _mock(self, mocker, target):
+        attempts = {}
+
+        def delete(entity_id):
+            attempts[entity_id] = attempts.get(entity_id, 0) + 1
+            if entity_id == "gone":
+                raise _error(404)
+            if entity_id == "locked":
+                raise _error(403)
+            if entity_id == "flaky" and attempts[entity_id] < 3:
+                raise _error(503)
+            if entity_id == "bug":
+                raise KeyError(entity_id)
+            return {}
+
+        mocker.patch("alephclient.api.backoff")
+        return mocker.patch.object(target, "delete_entity", side_effect=delete)
+
+    def test_delete_entities(self, mocker):
+        self._mock(mocker, self.api)
+        done = []
+        ids = ["a", "flaky", "gone", "locked"] + [str(i) for i in range(50)]
+        failed = self.api.delete_entities(
+            iter(ids), parallel=4, callback=lambda i, e: done.append((i, e))
+        )
+        assert [(i, e.status) for i, e in failed] == [("locked", 403)]
+        assert sorted(i for i, _ in done) == sorted(ids)
+        assert self.api.delete_entity.call_count == len(ids) + 2
+
+    def test_unexpected_error(self, mocker):
+        self._mock(mocker, self.api)
+        done = []
+        failed = self.api.delete_entities(
+            ["a", "bug"], callback=lambda i, e: done.append((i, e))
+        )
+        assert [i for i, _ in failed] == ["bug"]
+        assert isinstance(failed[0][1], AlephException)
+        assert sorted(i for i, e in done if e is not None) == ["bug"]
+
+    def test_cli(self, mocker, tmp_path):
+        delete = self._mock(mocker, AlephAPI)
+        failures = tmp_path / "failures.tsv"
+        result = CliRunner().invoke(
+            cli,
+            [
+                "--host",
+                self.fake_url,
+                "delete-entities",
+                "--progress",
+                "--failures",
+                str(failures),
+            ],
+            input="a\nlocked\tsome note\n\na\nb\n",
+        )
+        assert result.exit_code == 1
+        assert "1 of 3 entities" in result.output
+        assert delete.call_count == 3
+        assert failures.read_text().split("\t")[0] == "locked"
+
+
+class TestAddToEntitySet:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _mock(self, mocker, target):
+        mocker.patch.object(
+            target, "get_entityset", return_value={"id": "s1", "collection_id": "2"}
+        )
+
+        def fetch(ids, batch_size=50, parallel=4):
+            found = {}
+            for entity_id in ids:
+                if entity_id.startswith("gone"):
+                    continue
+                owner = "9" if entity_id.startswith("other") else "2"
+                found[entity_id] = {
+                    "id": entity_id,
+                    "schema": "Person",
+                    "properties": {
+                        "name": [entity_id],
+                        # The API nests the entities that others refer to.
+                        "parent": [{"id": "f" + entity_id, "schema": "Folder"}],
+                    },
+                    "collection": {"id": owner},
+                    "links": {},
+                }
+            return found
+
+        mocker.patch.object(target, "_fetch_entities", side_effect=fetch)
+        return mocker.patch.object(target, "_bulk_chunk")
+
+    def test_add_to_entityset(self, mocker):
+        bulk = self._mock(mocker, self.api)
+        items = [str(i) for i in range(25)] + ["gone1", "other1"]
+        items += [{"id": "x", "schema": "Person", "properties": {}}, {"id": "y"}]
+        written = []
+        stats = self.api.add_to_entityset(
+            "s1", items, chunk_size=10, parallel=3, callback=written.append
+        )
+        assert stats == {"written": 27, "failed": 0, "missing": 1, "skipped": 1}
+        chunks = [c.args[1] for c in bulk.call_args_list]
+        assert sorted(len(c) for c in chunks) == [7, 10, 10]
+        assert sum(written) == 27
+        for call in bulk.call_args_list:
+            assert call.args[0] == "2"
+            assert call.kwargs["entityset_id"] == "s1"
+        # Fetched entities are sent without the API's extra fields.
+        sent = {e["id"]: e for c in chunks for e in c}
+        assert sent["3"] == {
+            "id": "3",
+            "schema": "Person",
+            "properties": {"name": ["3"], "parent": ["f3"]},
+        }
+        assert sent["x"]["properties"] == {}
+
+    def test_add_to_entityset_failed(self, mocker):
+        bulk = self._mock(mocker, self.api)
+        bulk.side_effect = lambda collection_id, chunk, **kw: chunk[0]["id"] != "0"
+        written = []
+        stats = self.api.add_to_entityset(
+            "s1", [str(i) for i in range(25)], chunk_size=10, callback=written.append
+        )
+        assert stats["written"] == 15
+        assert stats["failed"] == 10
+        assert sorted(written) == [5, 10]
+
+    def test_cli(self, mocker):
+        bulk = self._mock(mocker, AlephAPI)
+        stdin = (
+            'a\n"b"\n{"id": "c"}\n{"id": "d", "schema": "Person", "properties": {}}\n'
+            "123\n1e5\n"
+        )
+        result = CliRunner().invoke(
+            cli,
+            ["--host", self.fake_url, "add-to-list", "-e", "s1", "--progress"],
+            input=stdin,
+        )
+        assert result.exit_code == 0, result.output
+        sent = sorted(e["id"] for c in bulk.call_args_list for e in c.args[1])
+        assert sent == ["123", "1e5", "a", "b", "c", "d"]
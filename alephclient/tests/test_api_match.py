@@ -0,0 +1,91 @@
+import threading
+
+from click.testing import CliRunner
+
+from alephclient.api import AlephAPI
+from alephclient.cache import MatchCache
+from alephclient.cli import cli
+from alephclient.errors import AlephException
+
+
+def _entity(id_, name):
+    return {"id": id_, "schema": "Person", "properties": {"name": [name]}}
+
+
+class TestMatchMany:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _mock(self, mocker):
+        lock = threading.Lock()
+        sent = []
+
+        def match(entity, collection_ids=None, url=None, publisher=False):
+            with lock:
+                sent.append(entity["properties"]["name"][0])
+            if entity["properties"]["name"][0] == "Bad":
+                raise AlephException("Invalid schema")
+            yield {"id": "m-" + entity["properties"]["name"][0]}
+
+        mocker.patch.object(self.api, "match", side_effect=match)
+        return sent
+
+    def test_match_many(self, mocker):
+        sent = self._mock(mocker)
+        names = ["Alice", "Bob", "Alice", "Bad", "Carol"] * 20
+        queries = [_entity(str(i), name) for i, name in enumerate(names)]
+        results = list(self.api.match_many(queries, parallel=3))
+        assert [r["query"]["id"] for r in results] == [str(i) for i in range(100)]
+        assert results[0]["results"] == [{"id": "m-Alice"}]
+        assert results[2]["results"] == [{"id": "m-Alice"}]
+        assert results[3]["error"] == "Invalid schema"
+        # Identical queries are sent once; failures are not cached.
+        assert sorted(set(sent)) == ["Alice", "Bad", "Bob", "Carol"]
+        assert sent.count("Alice") == 1
+        assert sent.count("Bad") > 1
+
+    def test_disk_cache(self, mocker, tmp_path):
+        sent = self._mock(mocker)
+        path = tmp_path / "match.sqlite"
+        cache = MatchCache(path=path)
+        list(self.api.match_many([_entity("1", "Alice")], cache=cache))
+        cache.close()
+        cache = MatchCache(path=path)
+        results = list(self.api.match_many([_entity("2", "Alice")], cache=cache))
+        assert results[0]["results"] == [{"id": "m-Alice"}]
+        assert sent == ["Alice"]
+        assert cache.hits == 1
+        # Other collections, other results.
+        list(self.api.match_many([_entity("3", "Alice")], ["7"], cache=cache))
+        assert sent == ["Alice", "Alice"]
+        cache.close()
+
+    def test_cache_eviction(self, tmp_path):
+        cache = MatchCache(size=2, path=tmp_path / "match.sqlite", disk_size=2)
+        for key in ("a", "b", "c"):
+            cache.set(key, [{"id": key}])
+        assert list(cache.entries) == ["b", "c"]
+        cache.close()
+        cache = MatchCache(path=tmp_path / "match.sqlite")
+        assert cache.get("a") is None
+        assert cache.get("c") == [{"id": "c"}]
+        cache.close()
+
+    def test_cli(self, mocker):
+        mocker.patch.object(
+            AlephAPI,
+            "match",
+            side_effect=lambda entity, *a, **kw: iter([{"id": "m"}]),
+        )
+        mocker.patch.object(
+            AlephAPI, "get_collection_by_foreign_id", return_value={"id": "7"}
+        )
+        stdin = '{"id": "1", "schema": "Person", "properties": {}}\n\n'
+        result = CliRunner().invoke(
+            cli, ["--host", self.fake_url, "match", "-f", "ref"], input=stdin
+        )
+        assert result.exit_code == 0, result.output
+        assert '"results": [{"id": "m"}]' in result.output
+        assert AlephAPI.match.call_args.args[1] == ["7"]
@@ -0,0 +1,94 @@
+import gc
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from alephclient.api import AlephAPI
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(serve):
+    return serve(KeepAliveHandler).url
+
+
+class TestApiSession:
+    fake_url = "http://aleph.test/api/2/"
+
+    def test_pool_size(self):
+        api = AlephAPI(host=self.fake_url, api_key="fake_key", pool_size=32)
+        adapter = api.session.get_adapter(self.fake_url)
+        assert adapter._pool_maxsize == 32
+        assert api.session.headers["Authorization"] == "ApiKey fake_key"
+
+    def test_resize_pool(self):
+        api = AlephAPI(host=self.fake_url, api_key="fake_key", pool_size=4)
+        api.resize_pool(2)
+        assert api.session.get_adapter(self.fake_url)._pool_maxsize == 4
+        api.resize_pool(17)
+        assert api.pool_size == 17
+        assert api.session.get_adapter(self.fake_url)._pool_maxsize == 17
+
+    def test_shared_session(self):
+        api = AlephAPI(host=self.fake_url, api_key="fake_key")
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(api.session))
+        thread.start()
+        thread.join()
+        assert sessions == [api.session]
+
+    def test_thread_sessions(self):
+        api = AlephAPI(host=self.fake_url, api_key="fake_key", thread_sessions=True)
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(api.session))
+        thread.start()
+        thread.join()
+        assert sessions[0] is not api.session
+        assert sessions[0].headers["X-Aleph-Session"] == api.session_id
+        assert api.connection_stats()["sessions"] == 2
+
+    def test_thread_sessions_closed(self, server):
+        api = AlephAPI(host=server, api_key="fake_key", thread_sessions=True)
+        sessions = []
+
+        def request():
+            sessions.append(api.session)
+            api._request("GET", api._make_url("status"))
+
+        for _ in range(3):
+            thread = threading.Thread(target=request)
+            thread.start()
+            thread.join()
+        gc.collect()
+        # Only the main thread's session is left open.
+        assert api._sessions == [api.session]
+        for session in sessions:
+            adapter = session.get_adapter(server)
+            assert len(adapter.poolmanager.pools) == 0
+        stats = api.connection_stats()
+        assert stats["sessions"] == 4
+        assert stats["requests"] == 3
+
+    def test_connection_reuse(self, server):
+        api = AlephAPI(host=server, api_key="fake_key")
+        for _ in range(5):
+            assert api._request("GET", api._make_url("status")) == {"ok": True}
+        stats = api.connection_stats()
+        assert stats["requests"] == 5
+        assert stats["connections"] == 1
+        assert stats["reused"] == 4
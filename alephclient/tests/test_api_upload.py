@@ -0,0 +1,201 @@
+import re
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from alephclient.api import AlephAPI
+from alephclient.errors import AlephException
+from alephclient.util import RateLimiter
+
+RANGE = re.compile(r"bytes (\*|(\d+)-(\d+))/(\d+)")
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    """A stand-in for an object store: a signed URL takes a whole file with
+    a PUT, or starts a resumable session with a POST. A session takes the
+    parts of a file in order, each a PUT with a `Content-Range`, answering
+    308 with the range it has until the file is complete; a PUT of
+    `bytes */total` asks for that range."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, status: int, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        store = self.server.store
+        if store["refuse"]:
+            return self._respond(store["refuse"])
+        if self.headers.get("x-goog-resumable") != "start":
+            return self._respond(400)
+        with store["lock"]:
+            store["sessions"] += 1
+            store["partial"] = bytearray()
+        self._respond(201, {"Location": store["url"] + "?session=1"})
+
+    def do_PUT(self):
+        store = self.server.store
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with store["lock"]:
+            if "session=" not in self.path:
+                store["requests"].append(0)
+                store["data"] = bytearray(data)
+                return self._respond(200)
+            match = RANGE.fullmatch(self.headers.get("Content-Range", ""))
+            if match is None:
+                return self._respond(400)
+            partial = store["partial"]
+            total = int(match.group(4))
+            if match.group(1) != "*":
+                start = int(match.group(2))
+                store["requests"].append(start)
+                if start in store["fail"]:
+                    # Keep half of the part, as a dropped connection might.
+                    store["fail"].remove(start)
+                    partial.extend(data[: len(data) // 2])
+                    return self._respond(503)
+                if start != len(partial):
+                    return self._respond(400)
+                partial.extend(data)
+            if len(partial) == total:
+                store["data"] = bytearray(partial)
+                return self._respond(200)
+            headers = {"Range": "bytes=0-%d" % (len(partial) - 1)} if partial else {}
+            self._respond(308, headers)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def store(serve):
+    httpd = serve(ObjectStoreHandler)
+    httpd.store = {
+        "lock": threading.Lock(),
+        "data": bytearray(),
+        "partial": bytearray(),
+        "sessions": 0,
+        "requests": [],
+        "fail": set(),
+        "refuse": None,
+        "url": httpd.url + "bucket/upload",
+    }
+    return httpd.store
+
+
+class TestSignedUrlUpload:
+    fake_url = "http://aleph.test/api/2/"
+    content = bytes(range(256)) * 3000
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key", retries=2)
+
+    def _file(self, tmp_path):
+        path = tmp_path / "data.bin"
+        path.write_bytes(self.content)
+        return path
+
+    def test_put_whole_file(self, store, tmp_path):
+        path = self._file(tmp_path)
+        self.api.put_upload(store["url"], path)
+        assert bytes(store["data"]) == self.content
+        assert store["requests"] == [0]
+
+    def test_put_chunked(self, store, tmp_path):
+        path = self._file(tmp_path)
+        resume = {}
+        self.api.put_upload(store["url"], path, chunk_size=4000, resume=resume)
+        assert bytes(store["data"]) == self.content
+        assert store["sessions"] == 1
+        # Parts are sent in order and rounded up to 256 KiB.
+        assert store["requests"] == [0, 256 * 1024, 512 * 1024]
+        assert resume["offset"] == len(self.content)
+
+    def test_put_chunked_resume(self, store, tmp_path):
+        path = self._file(tmp_path)
+        store["fail"].add(256 * 1024)
+        resume = {}
+        with pytest.raises(AlephException) as exc:
+            self.api.put_upload(store["url"], path, chunk_size=1, resume=resume)
+        assert exc.value.transient
+        assert resume["offset"] == 256 * 1024
+        store["requests"].clear()
+        self.api.put_upload(store["url"], path, chunk_size=1, resume=resume)
+        assert bytes(store["data"]) == self.content
+        assert store["sessions"] == 1
+        # The store kept half of the failed part, so only the rest is sent.
+        assert store["requests"] == [384 * 1024, 640 * 1024]
+
+    def test_signed_url_upload_resumes(self, mocker, store, tmp_path):
+        path = self._file(tmp_path)
+        store["fail"].add(512 * 1024)
+        mocker.patch("alephclient.api.backoff")
+        mocker.patch.object(
+            self.api,
+            "request_upload_url",
+            return_value={"url": store["url"], "id": "up1"},
+        )
+        mocker.patch.object(self.api, "create_document", return_value={"id": "doc1"})
+        result = self.api.signed_url_upload(
+            "2", path, metadata={"foreign_id": "data.bin"}, chunk_size=1000
+        )
+        assert result == {"id": "doc1"}
+        assert bytes(store["data"]) == self.content
+        assert self.api.request_upload_url.call_count == 1
+        assert store["sessions"] == 1
+        # The last part failed halfway, so only its second half is sent again.
+        rest = (len(self.content) + 512 * 1024) // 2
+        assert store["requests"] == [0, 256 * 1024, 512 * 1024, rest]
+        self.api.create_document.assert_called_once_with(
+            "2",
+            "up1",
+            metadata={
+                "foreign_id": "data.bin",
+                "file_name": "data.bin",
+                "mime_type": "application/octet-stream",
+            },
+            index=True,
+        )
+
+    @pytest.mark.parametrize("status", [403, 405])
+    def test_put_chunked_unsupported(self, store, tmp_path, status):
+        path = self._file(tmp_path)
+        store["refuse"] = status
+        resume = {}
+        self.api.put_upload(store["url"], path, chunk_size=4000, resume=resume)
+        # URLs which cannot start a session get the whole file in one PUT.
+        assert bytes(store["data"]) == self.content
+        assert store["requests"] == [0]
+        assert resume == {}
+
+    def test_put_chunked_unavailable(self, store, tmp_path):
+        path = self._file(tmp_path)
+        store["refuse"] = 503
+        with pytest.raises(AlephException):
+            self.api.put_upload(store["url"], path, chunk_size=4000)
+        assert store["requests"] == []
+
+    def test_put_chunked_no_session(self, mocker, tmp_path):
+        path = self._file(tmp_path)
+        response = mocker.Mock(status_code=200, headers={})
+        mocker.patch.object(self.api.session, "post", return_value=response)
+        put = mocker.patch.object(self.api.session, "put")
+        self.api.put_upload("http://store.test/upload", path, chunk_size=1000)
+        assert put.call_count == 1
+        assert "Content-Range" not in put.call_args.kwargs["headers"]
+
+    def test_put_throttled(self, store, tmp_path):
+        path = self._file(tmp_path)
+        sent = []
+        self.api.upload_limiter = RateLimiter(len(self.content) * 10)
+        self.api.upload_callback = sent.append
+        self.api.put_upload(store["url"], path)
+        self.api.put_upload(store["url"], path, chunk_size=4000)
+        assert store["sessions"] == 1
+        assert bytes(store["data"]) == self.content
+        assert sum(sent) == 2 * len(self.content)
@@ -0,0 +1,173 @@
+import json
+
+from requests import Response
+
+from alephclient import settings
+from alephclient.api import AlephAPI
+from alephclient.cache import CollectionCache, ResponseCache
+
+COLLECTION = {"id": "8", "foreign_id": "test", "label": "Test"}
+
+
+class TestCollectionCache:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _api(self, mocker, tmp_path, api_key="fake_key"):
+        mocker.patch.object(settings, "CACHE_DIR", str(tmp_path))
+        return AlephAPI(host=self.fake_url, api_key=api_key, collection_cache_ttl=60)
+
+    def test_disabled(self):
+        assert self.api.collection_cache is None
+        assert self.api.invalidate_collection_cache("test") == 0
+
+    def test_lookup(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path)
+        search = mocker.patch.object(
+            AlephAPI, "filter_collections", return_value=[COLLECTION]
+        )
+        assert api.get_collection_by_foreign_id("test") == COLLECTION
+        # Another process, sharing the cache file.
+        other = self._api(mocker, tmp_path)
+        assert other.get_collection_by_foreign_id("test") == COLLECTION
+        assert search.call_count == 1
+        # Another user has a cache of their own.
+        stranger = self._api(mocker, tmp_path, api_key="other_key")
+        stranger.get_collection_by_foreign_id("test")
+        assert search.call_count == 2
+
+    def test_missing_not_cached(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path)
+        search = mocker.patch.object(api, "filter_collections", return_value=[])
+        assert api.get_collection_by_foreign_id("test") is None
+        assert api.get_collection_by_foreign_id("test") is None
+        assert search.call_count == 2
+
+    def test_expiry(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path)
+        search = mocker.patch.object(
+            api, "filter_collections", return_value=[COLLECTION]
+        )
+        api.get_collection_by_foreign_id("test")
+        now = mocker.patch("alephclient.cache.time.time")
+        now.return_value = 10**10
+        api.get_collection_by_foreign_id("test")
+        assert search.call_count == 2
+
+    def test_invalidation(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path)
+        search = mocker.patch.object(
+            api, "filter_collections", return_value=[COLLECTION]
+        )
+        request = mocker.patch.object(api, "_request", return_value=COLLECTION)
+        api.create_collection({"foreign_id": "test"})
+        assert api.get_collection_by_foreign_id("test") == COLLECTION
+        assert search.call_count == 0
+        api.delete_collection("8")
+        api.get_collection_by_foreign_id("test")
+        assert search.call_count == 1
+        api.update_collection("8", {"label": "New"})
+        api.get_collection_by_foreign_id("test")
+        assert search.call_count == 2
+        assert api.invalidate_collection_cache(foreign_id="test") == 1
+        assert request.call_count == 3
+
+    def test_scopes(self, tmp_path):
+        cache = CollectionCache(tmp_path / "collections.json", 60)
+        cache.set("a", "test", COLLECTION)
+        cache.set("b", "test", COLLECTION)
+        cache.set("b", "other", {"id": "9"})
+        assert cache.invalidate("b", collection_id="9") == 1
+        assert cache.get("b", "other") is None
+        assert cache.invalidate() == 2
+        assert cache.get("a", "test") is None
+
+
+def _response(status=200, body=None, headers=None):
+    response = Response()
+    response.status_code = status
+    response._content = json.dumps(body).encode("utf-8") if body else b""
+    response.headers.update(headers or {})
+    return response
+
+
+class TestResponseCache:
+    fake_url = "http://aleph.test/api/2/"
+
+    def _api(self, mocker, tmp_path, size=16, disk=False, ttls=None):
+        mocker.patch.object(settings, "CACHE_DIR", str(tmp_path))
+        mocker.patch.object(settings, "HTTP_CACHE_SIZE", size)
+        mocker.patch.object(settings, "HTTP_CACHE_DISK", disk)
+        mocker.patch.object(settings, "HTTP_CACHE_TTLS", ttls or {})
+        return AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def test_ttl(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path, ttls={"entities": 60, "entities/x": 0})
+        request = mocker.patch.object(
+            api.session, "request", return_value=_response(body={"id": "1"})
+        )
+        assert api.get_entity("1")["id"] == "1"
+        assert api.get_entity("1")["id"] == "1"
+        assert request.call_count == 1
+        assert api.response_cache.stats() == {
+            "hits": 1,
+            "revalidated": 0,
+            "misses": 1,
+            "entries": 1,
+        }
+        # The longest matching prefix wins, and without a TTL or validators
+        # there is nothing to keep.
+        api.get_entity("x")
+        api.get_entity("x")
+        assert request.call_count == 3
+
+    def test_revalidation(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path)
+        headers = {"ETag": '"v1"', "Last-Modified": "Mon, 19 Oct 2026 10:00:00 GMT"}
+        request = mocker.patch.object(
+            api.session,
+            "request",
+            side_effect=[_response(body={"id": "8"}, headers=headers), _response(304)],
+        )
+        assert api.get_collection("8") == {"id": "8"}
+        assert api.get_collection("8") == {"id": "8"}
+        sent = request.call_args_list[1].kwargs["headers"]
+        assert sent == {
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": "Mon, 19 Oct 2026 10:00:00 GMT",
+        }
+        assert api.response_cache.revalidated == 1
+
+    def test_disk(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path, disk=True, ttls={"collections": 60})
+        mocker.patch.object(
+            api.session, "request", return_value=_response(body={"id": "8"})
+        )
+        api.get_collection("8")
+        other = self._api(mocker, tmp_path, disk=True, ttls={"collections": 60})
+        request = mocker.patch.object(other.session, "request")
+        assert other.get_collection("8") == {"id": "8"}
+        assert request.call_count == 0
+
+    def test_invalidation(self, mocker, tmp_path):
+        api = self._api(mocker, tmp_path, disk=True, ttls={"collections": 60})
+        request = mocker.patch.object(
+            api.session, "request", return_value=_response(body={"id": "8"})
+        )
+        api.get_collection("8")
+        api.update_collection("8", {"label": "New"})
+        api.get_collection("8")
+        assert request.call_count == 3
+        assert api.response_cache.misses == 2
+
+    def test_lru(self, mocker, tmp_path):
+        cache = ResponseCache(size=2)
+        for url in ("a", "b", "c"):
+            cache.put(url, "{}", {}, 60)
+        cache.get("b")
+        cache.put("d", "{}", {}, 60)
+        assert list(cache.entries) == ["b", "d"]
+        cache.put("e", "{}", {"Cache-Control": "no-store"}, 60)
+        assert "e" not in cache.entries
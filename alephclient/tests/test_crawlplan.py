@@ -0,0 +1,89 @@
+import pytest
+from click.testing import CliRunner
+
+from alephclient.api import AlephAPI
+from alephclient.cli import cli
+from alephclient.crawlplan import CrawlPlan, fit_costs, plan_dir
+
+
+@pytest.fixture
+def tree(tmp_path):
+    tmp_path.joinpath("a.pdf").write_bytes(b"x" * 100)
+    tmp_path.joinpath("b.PDF").write_bytes(b"x" * 5000)
+    tmp_path.joinpath("Thumbs.db").write_bytes(b"x" * 10)
+    sub = tmp_path.joinpath("sub", "deeper")
+    sub.mkdir(parents=True)
+    sub.joinpath("c.txt").write_bytes(b"x" * 70000)
+    junk = tmp_path.joinpath(".git")
+    junk.mkdir()
+    junk.joinpath("config").write_bytes(b"x" * 20)
+    return tmp_path
+
+
+class TestCrawlPlan:
+    def test_scan(self, tree):
+        plan = CrawlPlan(tree)
+        plan.scan(parallel=3)
+        assert plan.files == 5
+        assert plan.folders == 3
+        assert plan.bytes == 75130
+        assert plan.junk_files == 2
+        assert plan.junk_folders == 1
+        assert plan.junk_bytes == 30
+        assert plan.extensions[".pdf"] == 2
+        assert plan.sizes[0] == 3
+        assert plan.sizes[1] == 1
+        assert plan.sizes[2] == 1
+
+    def test_scan_nojunk(self, tree):
+        plan = CrawlPlan(tree, nojunk=True, sample=2)
+        plan.scan()
+        assert plan.files == 3
+        assert plan.folders == 2
+        assert plan.bytes == 75100
+        assert len(plan.samples) == 2
+        text = plan.format()
+        assert "Files:   3" in text
+        assert "(excluded)" in text
+        assert ".pdf" in text
+
+    def test_fit_costs(self):
+        file_cost, byte_cost = fit_costs([(0, 0.5), (1000, 1.5), (2000, 2.5)])
+        assert file_cost == pytest.approx(0.5)
+        assert byte_cost == pytest.approx(0.001)
+        assert fit_costs([(10, 1.0), (10, 3.0)]) == (2.0, 0.0)
+
+    def test_benchmark(self, mocker, tree):
+        api = AlephAPI(host="http://aleph.test/api/2/", api_key="fake_key")
+        mocker.patch.object(api, "create_collection", return_value={"id": "9"})
+        mocker.patch.object(api, "ingest_upload", return_value={"id": "1"})
+        mocker.patch.object(api, "delete_collection")
+        plan = plan_dir(api, str(tree), "test", nojunk=True, sample=3)
+        assert api.ingest_upload.call_count == 3
+        api.delete_collection.assert_called_once_with("9")
+        assert plan.file_cost is not None
+        assert plan.estimate(4) == pytest.approx(plan.estimate(1) / 4)
+        assert plan.estimate(4, max_rate=1) == plan.bytes
+        assert "--parallel 8" in plan.format()
+
+    def test_benchmark_signed_url(self, mocker, tree):
+        api = AlephAPI(host="http://aleph.test/api/2/", api_key="fake_key")
+        mocker.patch.object(api, "create_collection", return_value={"id": "9"})
+        mocker.patch.object(api, "signed_url_upload", return_value={"id": "1"})
+        mocker.patch.object(api, "ingest_upload")
+        mocker.patch.object(api, "delete_collection")
+        plan_dir(api, str(tree), "test", sample=2, signed_url=True, chunk_size=1024)
+        assert api.signed_url_upload.call_count == 2
+        assert api.signed_url_upload.call_args.kwargs["chunk_size"] == 1024
+        assert api.ingest_upload.call_count == 0
+
+    def test_plan_dry_run(self, mocker, tree):
+        mocker.patch.object(AlephAPI, "create_collection")
+        mocker.patch.object(AlephAPI, "ingest_upload")
+        args = ["--host", "http://aleph.test/api/2/", "crawldir", "-f", "test"]
+        result = CliRunner().invoke(cli, args + ["--plan", str(tree)])
+        assert result.exit_code == 0, result.output
+        assert "Files:   5" in result.output
+        # Without --plan-sample, nothing is sent to the server.
+        assert AlephAPI.create_collection.call_count == 0
+        assert AlephAPI.ingest_upload.call_count == 0
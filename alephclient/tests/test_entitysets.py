@@ -0,0 +1,90 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from alephclient.api import AlephAPI
+from alephclient.cli import cli
+from alephclient.entitysets import dump_entitysets
+from alephclient.errors import AlephException
+
+ENTITYSETS = [{"id": str(i), "label": "Set %d" % i, "type": "list"} for i in range(6)]
+
+
+class TestDumpEntitySets:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _mock(self, mocker, target, broken=None):
+        lock = threading.Lock()
+        state = {"active": 0, "peak": 0}
+
+        def items(entityset_id, publisher=False):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            try:
+                time.sleep(0.02)
+                if entityset_id == broken:
+                    raise AlephException("broken")
+                count = int(entityset_id) + 1
+                return [
+                    {"entity": {"id": "%s-%d" % (entityset_id, n)}}
+                    for n in range(count)
+                ]
+            finally:
+                with lock:
+                    state["active"] -= 1
+
+        mocker.patch.object(target, "entitysets", return_value=iter(ENTITYSETS))
+        mocker.patch.object(target, "entitysetitems", side_effect=items)
+        return state
+
+    def test_directory(self, mocker, tmp_path):
+        state = self._mock(mocker, self.api)
+        dump_entitysets(self.api, directory=str(tmp_path), parallel=3)
+        assert 1 < state["peak"] <= 3
+        index = tmp_path.joinpath("entitysets.json").read_text().splitlines()
+        assert [json.loads(line)["id"] for line in index] == [
+            e["id"] for e in ENTITYSETS
+        ]
+        lines = tmp_path.joinpath("5.items.json").read_text().splitlines()
+        assert len(lines) == 6
+        assert json.loads(lines[0])["entity"]["id"] == "5-0"
+
+    def test_stream(self, mocker):
+        self._mock(mocker, self.api)
+        stream = io.StringIO()
+        dump_entitysets(self.api, stream=stream, parallel=4)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        sets = [r for r in records if r["type"] == "entityset"]
+        items = [r for r in records if r["type"] == "item"]
+        assert len(sets) == 6
+        assert len(items) == sum(range(1, 7))
+        assert all(
+            r["item"]["entity"]["id"].startswith(r["entityset_id"]) for r in items
+        )
+
+    def test_failure(self, mocker, tmp_path):
+        self._mock(mocker, self.api, broken="2")
+        with pytest.raises(AlephException):
+            dump_entitysets(self.api, directory=str(tmp_path), parallel=2)
+        # The other sets are still dumped, and no partial files are left.
+        names = sorted(p.name for p in tmp_path.iterdir())
+        assert "2.items.json" not in names
+        assert "2.items.json.tmp" not in names
+        assert "5.items.json" in names
+        assert "entitysets.json" in names
+
+    def test_cli(self, mocker, tmp_path):
+        self._mock(mocker, AlephAPI)
+        args = ["--host", self.fake_url, "dump-entitysets", "-t", "list", "-d"]
+        result = CliRunner().invoke(cli, args + [str(tmp_path)])
+        assert result.exit_code == 0, result.output
+        assert AlephAPI.entitysets.call_args.kwargs["set_types"] == ["list"]
+        assert tmp_path.joinpath("0.items.json").exists()
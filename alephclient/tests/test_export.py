@@ -1,7 +1,27 @@
+import io
+import re
+import json
+import hashlib
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler
 from unittest.mock import MagicMock
 
+import pytest
+from requests.exceptions import HTTPError
+
 from alephclient.api import AlephAPI
-from alephclient.exports import list_exports, format_exports_table, download_export
+from alephclient.errors import AlephException
+from alephclient.exports import (
+    OrderedHasher,
+    get_export,
+    wait_for_export,
+    list_exports,
+    format_exports_table,
+    download_export,
+    extract_export,
+    stream_export_entities,
+)
 
 
 FAKE_EXPORT = {
@@ -62,6 +82,89 @@ class TestListExports:
         assert result == []
 
 
+class TestGetExport:
+    def setup_method(self):
+        self.api = AlephAPI(host="http://aleph%d.test/api/2/" % id(self), api_key="k")
+
+    def test_direct(self, mocker):
+        request = mocker.patch.object(self.api, "_request", return_value=FAKE_EXPORT)
+        assert get_export(self.api, "123") == FAKE_EXPORT
+        request.assert_called_once_with("GET", self.api.base_url + "exports/123")
+
+    def test_scan_fallback(self, mocker):
+        response = MagicMock(status_code=404)
+        not_found = AlephException(HTTPError(response=response))
+        page = {
+            "results": [{"id": "1"}, FAKE_EXPORT],
+            "next": self.api.base_url + "exports?page=2",
+            "offset": 0,
+            "limit": 2,
+        }
+        request = mocker.patch.object(
+            self.api, "_request", side_effect=[not_found, page, page]
+        )
+        assert get_export(self.api, "123") == FAKE_EXPORT
+        # The second page is never requested, nor the direct lookup again.
+        assert get_export(self.api, "123") == FAKE_EXPORT
+        assert request.call_count == 3
+
+    def test_not_found(self, mocker):
+        response = MagicMock(status_code=404)
+        not_found = AlephException(HTTPError(response=response))
+        page = {"results": [FAKE_EXPORT], "next": None, "offset": 0, "limit": 1}
+        request = mocker.patch.object(
+            self.api, "_request", side_effect=[not_found, page, FAKE_EXPORT]
+        )
+        with pytest.raises(AlephException):
+            get_export(self.api, "404")
+        # A missing export says nothing about the endpoint, which is used again.
+        assert get_export(self.api, "123") == FAKE_EXPORT
+        assert request.call_args.args[1] == self.api.base_url + "exports/123"
+
+    def test_not_allowed(self, mocker):
+        response = MagicMock(status_code=405)
+        not_allowed = AlephException(HTTPError(response=response))
+        page = {"results": [FAKE_EXPORT], "next": None, "offset": 0, "limit": 1}
+        request = mocker.patch.object(
+            self.api, "_request", side_effect=[not_allowed, page, page]
+        )
+        with pytest.raises(AlephException):
+            get_export(self.api, "404")
+        assert get_export(self.api, "123") == FAKE_EXPORT
+        assert request.call_count == 3
+
+    def test_wait(self, mocker):
+        sleep = mocker.patch("alephclient.exports.time.sleep")
+        statuses = ["pending"] * 4 + ["successful"]
+        mocker.patch(
+            "alephclient.exports.get_export",
+            side_effect=[dict(FAKE_EXPORT, status=s) for s in statuses],
+        )
+        export = wait_for_export(self.api, "123", interval=1.0)
+        assert export["status"] == "successful"
+        delays = [c.args[0] for c in sleep.call_args_list]
+        assert delays == [1.0, 1.5, 2.25, 3.375]
+
+    def test_wait_failed(self, mocker):
+        mocker.patch("alephclient.exports.time.sleep")
+        mocker.patch(
+            "alephclient.exports.get_export",
+            return_value=dict(FAKE_EXPORT, status="failed"),
+        )
+        with pytest.raises(AlephException):
+            wait_for_export(self.api, "123")
+
+    def test_wait_timeout(self, mocker):
+        mocker.patch("alephclient.exports.time.sleep")
+        mocker.patch("alephclient.exports.time.monotonic", side_effect=[0, 5, 11])
+        mocker.patch(
+            "alephclient.exports.get_export",
+            return_value=dict(FAKE_EXPORT, status="pending"),
+        )
+        with pytest.raises(AlephException):
+            wait_for_export(self.api, "123", timeout=10)
+
+
 class TestFormatExportsTable:
     def test_empty_list(self):
         assert format_exports_table([]) == "No exports found."
@@ -103,8 +206,8 @@ class TestDownloadExport:
             return_value=mock_response,
         )
         mocker.patch(
-            "alephclient.exports.list_exports",
-            return_value=[FAKE_EXPORT],
+            "alephclient.exports.get_export",
+            return_value=FAKE_EXPORT,
         )
 
     def test_download_to_file(self, mocker, tmp_path):
@@ -120,3 +223,135 @@ class TestDownloadExport:
         expected = tmp_path / "export.zip"
         assert result == expected
         assert expected.read_bytes() == b"data"
+
+    def test_extract(self, mocker, tmp_path):
+        fh = io.BytesIO()
+        with zipfile.ZipFile(fh, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("a/b.txt", b"data")
+            zf.writestr("entities.json", b'{"id": "1"}\n{"id": "2"}\n')
+        archive = fh.getvalue()
+        export = dict(FAKE_EXPORT, content_hash=hashlib.sha1(archive).hexdigest())
+        self._mock_download(mocker, content=archive)
+        mocker.patch("alephclient.exports.get_export", return_value=export)
+        paths = extract_export(self.api, "123", str(tmp_path))
+        assert len(paths) == 2
+        assert tmp_path.joinpath("a", "b.txt").read_bytes() == b"data"
+        assert not tmp_path.joinpath("export.zip").exists()
+        entities = list(stream_export_entities(self.api, "123"))
+        assert entities == [{"id": "1"}, {"id": "2"}]
+
+    def test_extract_checksum(self, mocker, tmp_path):
+        fh = io.BytesIO()
+        with zipfile.ZipFile(fh, "w") as zf:
+            zf.writestr("a.txt", b"data")
+        self._mock_download(mocker, content=fh.getvalue())
+        export = dict(FAKE_EXPORT, content_hash="sha1:" + "0" * 40)
+        mocker.patch("alephclient.exports.get_export", return_value=export)
+        with pytest.raises(AlephException):
+            extract_export(self.api, "123", str(tmp_path))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    content = bytes(range(256)) * 4096
+    # Seconds to stall after the first bytes of all but the first segment.
+    pause = 0.0
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        total = len(self.content)
+        start, end = int(match.group(1)), int(match.group(2))
+        body = self.content[start : end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.pause and start > 0:
+            self.wfile.write(body[:2048])
+            self.wfile.flush()
+            time.sleep(self.pause)
+            body = body[2048:]
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestSegmentedDownload:
+    segment = 128 * 1024
+
+    @pytest.fixture(autouse=True)
+    def server(self, serve):
+        self.httpd = serve(RangeHandler)
+        self.httpd.ranges = []
+        host = self.httpd.url
+        self.api = AlephAPI(host=host, api_key="fake_key")
+        self.export = {
+            "id": "123",
+            "file_name": "export.zip",
+            "content_hash": "sha1:" + hashlib.sha1(RangeHandler.content).hexdigest(),
+            "links": {"download": host + "api/2/archive?token=abc"},
+        }
+
+    def _download(self, mocker, tmp_path):
+        mocker.patch("alephclient.exports.get_export", return_value=self.export)
+        return download_export(
+            self.api, "123", str(tmp_path), parallel=4, segment_size=self.segment
+        )
+
+    def test_parallel(self, mocker, tmp_path):
+        dest = self._download(mocker, tmp_path)
+        assert dest.read_bytes() == RangeHandler.content
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["export.zip"]
+        # A one byte probe, then the eight segments.
+        assert self.httpd.ranges[0] == "bytes=0-0"
+        assert len(self.httpd.ranges) == 9
+        assert "bytes=131072-262143" in self.httpd.ranges
+
+    def test_spilled_chunks(self, mocker, tmp_path):
+        # Small chunks stay in the write buffer of the file unless flushed,
+        # and with no hash buffer, every chunk ahead is read back from disk.
+        mocker.patch("alephclient.exports.CHUNK_SIZE", 1024)
+        mocker.patch.object(OrderedHasher.__init__, "__defaults__", (0,))
+        mocker.patch.object(RangeHandler, "pause", 0.2)
+        dest = self._download(mocker, tmp_path)
+        assert dest.read_bytes() == RangeHandler.content
+
+    def test_checksum_mismatch(self, mocker, tmp_path):
+        self.export["content_hash"] = "sha1:" + "0" * 40
+        with pytest.raises(AlephException):
+            self._download(mocker, tmp_path)
+        assert list(tmp_path.iterdir()) == []
+
+    def test_resume(self, mocker, tmp_path):
+        content = RangeHandler.content
+        part = tmp_path / "export.zip.part"
+        part.write_bytes(content[: 3 * self.segment] + b"\0" * 5 * self.segment)
+        state = {
+            "size": len(content),
+            "segment_size": self.segment,
+            "content_hash": self.export["content_hash"],
+            "done": [0, 2],
+        }
+        tmp_path.joinpath("export.zip.part.json").write_text(json.dumps(state))
+        dest = self._download(mocker, tmp_path)
+        assert dest.read_bytes() == content
+        # Segment 1 was in the part file, but not recorded as done.
+        assert len(self.httpd.ranges) == 7
+        assert "bytes=0-131071" not in self.httpd.ranges
+        assert "bytes=131072-262143" in self.httpd.ranges
+
+
+class TestOrderedHasher:
+    def test_out_of_order(self, tmp_path):
+        data = bytes(range(256)) * 16
+        path = tmp_path / "data"
+        path.write_bytes(data)
+        chunks = [(i, data[i : i + 512]) for i in range(0, len(data), 512)]
+        ordered = OrderedHasher(hashlib.sha1(), path, limit=1024)
+        for offset, chunk in reversed(chunks):
+            ordered.update(offset, chunk)
+        # Only two chunks fit the buffer, the rest were re-read from disk.
+        assert ordered.offset == len(data)
+        assert ordered.hasher.hexdigest() == hashlib.sha1(data).hexdigest()
@@ -0,0 +1,371 @@
+import re
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+from click.testing import CliRunner
+
+from alephclient.api import AlephAPI
+from alephclient.cli import cli
+from alephclient.errors import AlephException
+from alephclient.fetchdir import (
+    FetchDirectory,
+    FetchFilter,
+    FetchManifest,
+    fetch_archive,
+    fetch_collection,
+    fetch_entity,
+)
+
+ENTITIES = {
+    None: [
+        {"id": "f1", "properties": {"fileName": ["docs"]}},
+        {
+            "id": "a",
+            "properties": {"fileName": ["a.txt"], "fileSize": ["1"]},
+            "links": {"file": "http://aleph.test/api/2/archive?a"},
+        },
+    ],
+    "f1": [
+        {"id": "f2", "properties": {"fileName": ["sub"]}},
+        {
+            "id": "b",
+            "properties": {"fileName": ["b.txt"], "fileSize": ["1"]},
+            "links": {"file": "/api/2/archive?b"},
+        },
+    ],
+    "f2": [
+        {
+            "id": "c",
+            "properties": {"fileName": ["c.txt"], "fileSize": ["1"]},
+            "links": {"file": "http://aleph.test/api/2/archive?c"},
+        }
+    ],
+}
+
+
+class TestFetchDir:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _mock(self, mocker):
+        def search(query, filters=None, schemata=None, params=None):
+            parent = dict(filters).get("properties.parent")
+            return list(ENTITIES.get(parent, []))
+
+        def fetch_archive(api, url, path):
+            path.write_text(url.rsplit("?", 1)[-1])
+
+        mocker.patch.object(self.api, "search", side_effect=search)
+        mocker.patch.object(
+            self.api,
+            "get_collection_by_foreign_id",
+            return_value={"id": "2", "label": "Test"},
+        )
+        return mocker.patch(
+            "alephclient.fetchdir.fetch_archive", side_effect=fetch_archive
+        )
+
+    @pytest.mark.parametrize("parallel", [1, 4])
+    def test_fetch_collection(self, mocker, tmp_path, parallel):
+        fetch = self._mock(mocker)
+        fetch_collection(self.api, str(tmp_path), "test", parallel=parallel)
+        assert tmp_path.joinpath("a.txt").read_text() == "a"
+        assert tmp_path.joinpath("docs", "b.txt").read_text() == "b"
+        assert tmp_path.joinpath("docs", "sub", "c.txt").read_text() == "c"
+        urls = sorted(c.args[1] for c in fetch.mock_calls)
+        assert urls[1] == "http://aleph.test/api/2/archive?b"
+        # Existing files of the expected size are skipped.
+        fetch.reset_mock()
+        fetch_collection(self.api, str(tmp_path), "test", parallel=parallel)
+        assert fetch.call_count == 0
+
+    def test_fetch_entity(self, mocker, tmp_path):
+        self._mock(mocker)
+        mocker.patch.object(self.api, "get_entity", return_value=ENTITIES[None][0])
+        fetch_entity(self.api, str(tmp_path), "f1", parallel=2, progress=True)
+        assert tmp_path.joinpath("docs", "sub", "c.txt").exists()
+        assert not tmp_path.joinpath("a.txt").exists()
+
+    def test_fetch_failure(self, mocker, tmp_path):
+        fetch = self._mock(mocker)
+        fetch.side_effect = AlephException("broken")
+        with pytest.raises(AlephException):
+            fetch_collection(self.api, str(tmp_path), "test", parallel=2)
+
+    def test_fetch_collection_tree(self, mocker, tmp_path):
+        fetch = self._mock(mocker)
+        streamed = []
+        for parent, entities in ENTITIES.items():
+            for entity in entities:
+                properties = dict(entity["properties"])
+                if entity["id"] in "abc":
+                    properties["contentHash"] = ["sha1" + entity["id"]]
+                if parent is not None:
+                    properties["parent"] = [parent]
+                streamed.append({"id": entity["id"], "properties": properties})
+        mocker.patch.object(self.api, "stream_entities", return_value=streamed)
+        links = {e["id"]: e for es in ENTITIES.values() for e in es}
+        mocker.patch.object(
+            self.api,
+            "get_entities",
+            side_effect=lambda ids, parallel: [dict(links[i]) for i in ids],
+        )
+        fetch_collection(self.api, str(tmp_path), "test", parallel=3, tree=True)
+        assert tmp_path.joinpath("docs", "sub", "c.txt").read_text() == "c"
+        assert fetch.call_count == 3
+        # One stream, no folder searches; the links of the files are looked
+        # up together.
+        assert self.api.search.call_count == 0
+        self.api.get_entities.assert_called_once()
+        assert sorted(self.api.get_entities.call_args.args[0]) == ["a", "b", "c"]
+        self.api.stream_entities.assert_called_once_with(
+            collection={"id": "2", "label": "Test"},
+            include=["id", "schema", "properties"],
+            schema="Document",
+        )
+        # Lookups are sent as soon as a batch is full.
+        mocker.patch.object(FetchDirectory, "LINK_BATCH", 2)
+        self.api.get_entities.reset_mock()
+        fetch_collection(self.api, str(tmp_path), "test", tree=True, overwrite=True)
+        batches = [c.args[0] for c in self.api.get_entities.call_args_list]
+        assert sorted(len(b) for b in batches) == [1, 2]
+
+    def test_fetch_collection_sync(self, mocker, tmp_path):
+        fetch = self._mock(mocker)
+        hashes = {
+            "a": hashlib.sha1(b"a").hexdigest(),
+            "b": hashlib.sha1(b"b").hexdigest(),
+        }
+        mocker.patch.dict(ENTITIES[None][1]["properties"], contentHash=[hashes["a"]])
+        mocker.patch.dict(ENTITIES["f1"][1]["properties"], contentHash=[hashes["b"]])
+        fetch_collection(self.api, str(tmp_path), "test", sync=True)
+        assert fetch.call_count == 3
+        manifest = FetchManifest(tmp_path)
+        assert manifest.entries["a.txt"]["sha1"] == hashes["a"]
+        # Same size, but different content: only a sync notices.
+        tmp_path.joinpath("a.txt").write_text("x")
+        fetch.reset_mock()
+        fetch_collection(self.api, str(tmp_path), "test")
+        assert fetch.call_count == 0
+        fetch_collection(self.api, str(tmp_path), "test", sync=True)
+        urls = [c.args[1] for c in fetch.mock_calls]
+        assert urls == ["http://aleph.test/api/2/archive?a"]
+        assert tmp_path.joinpath("a.txt").read_text() == "a"
+
+    def test_checksum_mismatch(self, mocker, tmp_path):
+        self._mock(mocker)
+        mocker.patch.dict(ENTITIES["f1"][1]["properties"], contentHash=["0" * 40])
+        with pytest.raises(AlephException):
+            fetch_collection(self.api, str(tmp_path), "test", sync=True)
+        # A download which does not match its hash is not kept.
+        assert not tmp_path.joinpath("docs", "b.txt").exists()
+        assert "docs/b.txt" not in FetchManifest(tmp_path).entries
+        assert tmp_path.joinpath("docs", "sub", "c.txt").exists()
+
+    def test_fetch_collection_prune(self, mocker, tmp_path):
+        self._mock(mocker)
+        tmp_path.joinpath("stale.txt").write_text("stale")
+        tmp_path.joinpath("gone", "deeper").mkdir(parents=True)
+        tmp_path.joinpath("gone", "deeper", "x.txt").write_text("x")
+        tmp_path.joinpath("docs").mkdir()
+        tmp_path.joinpath("docs", "old.txt").write_text("old")
+        fetch_collection(self.api, str(tmp_path), "test", prune=True)
+        found = sorted(str(p.relative_to(tmp_path)) for p in tmp_path.rglob("*"))
+        assert found == [
+            FetchManifest.FILE_NAME,
+            "a.txt",
+            "docs",
+            "docs/b.txt",
+            "docs/sub",
+            "docs/sub/c.txt",
+        ]
+
+    def test_prune_truncated_listing(self, mocker, tmp_path):
+        self._mock(mocker)
+
+        class CappedListing(list):
+            """A search listing which ends before its reported total."""
+
+            def __len__(self):
+                return super().__len__() + 1
+
+        search = self.api.search.side_effect
+
+        def capped(query, filters=None, schemata=None, params=None):
+            results = search(query, filters, schemata, params)
+            if dict(filters).get("properties.parent") == "f2":
+                return CappedListing(results)
+            return results
+
+        self.api.search.side_effect = capped
+        tmp_path.joinpath("docs", "sub").mkdir(parents=True)
+        tmp_path.joinpath("docs", "sub", "unlisted.txt").write_text("x")
+        fetch_collection(self.api, str(tmp_path), "test", prune=True)
+        assert tmp_path.joinpath("docs", "sub", "c.txt").exists()
+        assert tmp_path.joinpath("docs", "sub", "unlisted.txt").exists()
+
+    def test_prune_needs_prefix(self, mocker, monkeypatch, tmp_path):
+        self._mock(mocker)
+        monkeypatch.chdir(tmp_path)
+        tmp_path.joinpath("keep.txt").write_text("keep")
+        with pytest.raises(AlephException):
+            fetch_collection(self.api, None, "test", prune=True)
+        mocker.patch.object(AlephAPI, "get_collection_by_foreign_id")
+        args = ["--host", self.fake_url, "fetchdir", "-f", "test", "--prune"]
+        result = CliRunner().invoke(cli, args)
+        assert result.exit_code == 2
+        assert "--prefix" in result.output
+        assert AlephAPI.get_collection_by_foreign_id.call_count == 0
+        assert tmp_path.joinpath("keep.txt").exists()
+
+    def test_prune_after_failure(self, mocker, tmp_path):
+        fetch = self._mock(mocker)
+        fetch.side_effect = AlephException("broken")
+        tmp_path.joinpath("stale.txt").write_text("stale")
+        with pytest.raises(AlephException):
+            fetch_collection(self.api, str(tmp_path), "test", prune=True)
+        assert tmp_path.joinpath("stale.txt").exists()
+
+    def test_fetch_same_name(self, mocker, tmp_path):
+        self._mock(mocker)
+        entities = [
+            {
+                "id": "att%d" % i,
+                "properties": {"fileName": ["image.png"], "fileSize": [str(i)]},
+                "links": {"file": "http://aleph.test/api/2/archive?%d" % i},
+            }
+            for i in range(1, 5)
+        ]
+        mocker.patch.dict(ENTITIES, {None: entities})
+        lock = threading.Lock()
+        active = {"paths": set(), "overlaps": 0}
+
+        def fetch_archive(api, url, path):
+            with lock:
+                if path in active["paths"]:
+                    active["overlaps"] += 1
+                active["paths"].add(path)
+            time.sleep(0.02)
+            path.write_text(url.rsplit("?", 1)[-1])
+            with lock:
+                active["paths"].discard(path)
+
+        fetch = mocker.patch(
+            "alephclient.fetchdir.fetch_archive", side_effect=fetch_archive
+        )
+        fetch_collection(self.api, str(tmp_path), "test", parallel=4)
+        # Downloads to one path take turns; the sizes differ, so each is made.
+        assert fetch.call_count == 4
+        assert active["overlaps"] == 0
+
+    def test_fetch_filter(self):
+        pdf = {
+            "schema": "Pdf",
+            "properties": {"mimeType": ["application/pdf"], "fileSize": ["2048"]},
+        }
+        assert FetchFilter().matches(pdf, "a.pdf")
+        assert FetchFilter(schemata=["Pdf"]).matches(pdf, "a.pdf")
+        assert not FetchFilter(schemata=["Image"]).matches(pdf, "a.pdf")
+        assert FetchFilter(mime_types=["Application/*"]).matches(pdf, "a.pdf")
+        assert not FetchFilter(mime_types=["image/png"]).matches(pdf, "a.pdf")
+        assert FetchFilter(min_size=2048, max_size=2048).matches(pdf, "a.pdf")
+        assert not FetchFilter(max_size=1024).matches(pdf, "a.pdf")
+        assert not FetchFilter(min_size=4096).matches(pdf, "a.pdf")
+        assert FetchFilter(globs=["docs/*.pdf"]).matches(pdf, "docs/sub/a.pdf")
+        assert not FetchFilter(globs=["*.txt"]).matches(pdf, "a.pdf")
+        selection = FetchFilter(schemata=["Pdf"], mime_types=["image/*", "text/csv"])
+        assert selection.search_filters == [("schema", "Pdf")]
+
+    def test_fetch_collection_selection(self, mocker, tmp_path):
+        fetch = self._mock(mocker)
+        for entity in (ENTITIES[None][1], ENTITIES["f1"][1], ENTITIES["f2"][0]):
+            mocker.patch.dict(entity["properties"], mimeType=["text/plain"])
+        selection = FetchFilter(mime_types=["text/plain"], globs=["docs/*"])
+        fetch_collection(self.api, str(tmp_path), "test", selection=selection)
+        # Folders are listed without the filters, files with them.
+        calls = self.api.search.call_args_list
+        assert len(calls) == 6
+        schemata = sorted(c.kwargs["schemata"] for c in calls)
+        assert schemata == ["Document"] * 3 + ["Folder"] * 3
+        for call in calls:
+            filters = call.kwargs["filters"]
+            has_mime = ("properties.mimeType", "text/plain") in filters
+            assert has_mime == (call.kwargs["schemata"] == "Document")
+        # The glob is matched locally, against the relative path.
+        urls = sorted(c.args[1] for c in fetch.mock_calls)
+        assert urls == [
+            "http://aleph.test/api/2/archive?b",
+            "http://aleph.test/api/2/archive?c",
+        ]
+        assert not tmp_path.joinpath("a.txt").exists()
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Serves one file, supporting ranges; the first response is cut off."""
+
+    protocol_version = "HTTP/1.1"
+    content = bytes(range(256)) * 8192
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            self.send_response(206)
+            total = len(self.content)
+            self.send_header("Content-Range", f"bytes {start}-{total - 1}/{total}")
+        else:
+            self.send_response(200)
+        body = self.content[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if len(server.requests) == 1:
+            self.wfile.write(body[: len(body) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetchArchive:
+    def test_resume(self, mocker, tmp_path, serve):
+        httpd = serve(ArchiveHandler)
+        httpd.requests = []
+        api = AlephAPI(host=httpd.url, api_key="fake_key")
+        mocker.patch("alephclient.fetchdir.backoff")
+        path = tmp_path / "file.bin"
+        fetch_archive(api, httpd.url + "api/2/archive?token=x", path)
+        assert path.read_bytes() == ArchiveHandler.content
+        assert not tmp_path.joinpath("file.bin.part").exists()
+        assert len(httpd.requests) == 2
+        assert "Range" not in httpd.requests[0]
+        # Only the data missing from the first, cut off response is fetched.
+        assert httpd.requests[1]["Range"] == "bytes=%d-" % (512 * 1024)
+        assert httpd.requests[1]["Authorization"] == "ApiKey fake_key"
+
+    def test_foreign_storage(self, mocker, tmp_path, serve):
+        aleph = serve(ArchiveHandler)
+        aleph.requests = []
+        storage = serve(ArchiveHandler)
+        storage.requests = []
+        api = AlephAPI(host=aleph.url, api_key="fake_key")
+        mocker.patch("alephclient.fetchdir.backoff")
+        path = tmp_path / "file.bin"
+        fetch_archive(api, storage.url + "bucket/file.bin?X-Amz-Signature=x", path)
+        assert path.read_bytes() == ArchiveHandler.content
+        assert aleph.requests == []
+        # Presigned storage URLs get the download without the API key.
+        assert len(storage.requests) == 2
+        for headers in storage.requests:
+            assert "Authorization" not in headers
+        assert storage.requests[1]["Range"] == "bytes=%d-" % (512 * 1024)
@@ -0,0 +1,106 @@
+from click.testing import CliRunner
+
+from alephclient import settings
+from alephclient.api import AlephAPI
+from alephclient.cli import cli
+from alephclient.mirror import EntityMirror, mirror_collection
+
+COLLECTION = {"id": "2", "label": "Test", "data_updated_at": "2026-10-01"}
+
+
+def _entity(id_, name, updated="2026-10-01", schema="Person", **props):
+    properties = {"name": [name]}
+    properties.update({k: [v] for k, v in props.items()})
+    return {
+        "id": id_,
+        "schema": schema,
+        "updated_at": updated,
+        "properties": properties,
+    }
+
+
+class TestMirror:
+    fake_url = "http://aleph.test/api/2/"
+
+    def setup_method(self):
+        self.api = AlephAPI(host=self.fake_url, api_key="fake_key")
+
+    def _sync(self, mocker, tmp_path, entities, collection=COLLECTION, **kwargs):
+        # The lookup by foreign_id is cached, and stays the same.
+        mocker.patch.object(
+            self.api, "get_collection_by_foreign_id", return_value=COLLECTION
+        )
+        mocker.patch.object(self.api, "get_collection", return_value=collection)
+        stream = mocker.patch.object(
+            self.api, "stream_entities", return_value=iter(entities)
+        )
+        path = str(tmp_path / "test.sqlite")
+        stats = mirror_collection(self.api, "test", path, **kwargs)
+        return stats, stream
+
+    def test_sync(self, mocker, tmp_path):
+        entities = [
+            _entity("a", "Alice", nationality="de"),
+            _entity("b", "Bob"),
+            _entity("c", "ACME", schema="Company"),
+        ]
+        stats, _ = self._sync(mocker, tmp_path, entities)
+        assert stats["added"] == 3
+        # Nothing has been updated since, so nothing is streamed.
+        stats, stream = self._sync(mocker, tmp_path, entities)
+        assert stream.call_count == 0
+        assert stats["added"] == 0
+        # Once the collection changed, only changed entities are written.
+        collection = dict(COLLECTION, data_updated_at="2026-10-02")
+        changed = [
+            _entity("a", "Alice", nationality="de"),
+            _entity("b", "Robert", updated="2026-10-02"),
+            _entity("d", "Dave"),
+        ]
+        stats, _ = self._sync(mocker, tmp_path, changed, collection=collection)
+        assert stats == {"added": 1, "updated": 1, "unchanged": 1, "deleted": 1}
+
+        mirror = EntityMirror(tmp_path / "test.sqlite")
+        assert mirror.count() == 3
+        assert mirror.get("b")["properties"]["name"] == ["Robert"]
+        assert mirror.get("c") is None
+        names = [e["id"] for e in mirror.query(properties={"name": "Dave"})]
+        assert names == ["d"]
+        # Not indexed, so found by a scan of the entities.
+        found = list(mirror.query(schema="Person", properties={"nationality": "de"}))
+        assert [e["id"] for e in found] == ["a"]
+        assert len(list(mirror.query(schema="Person", limit=2))) == 2
+        mirror.close()
+
+    def test_reindex(self, mocker, tmp_path):
+        entities = [_entity("a", "Alice", nationality="de")]
+        self._sync(mocker, tmp_path, entities)
+        stats, stream = self._sync(
+            mocker, tmp_path, entities, properties=["nationality"]
+        )
+        assert stats["updated"] == 1
+        mirror = EntityMirror(tmp_path / "test.sqlite")
+        rows = mirror.conn.execute("SELECT prop, value FROM props").fetchall()
+        assert rows == [("nationality", "de")]
+        mirror.close()
+
+    def test_cli(self, mocker, tmp_path):
+        mocker.patch.object(settings, "CACHE_DIR", str(tmp_path))
+        mocker.patch.object(
+            AlephAPI, "get_collection_by_foreign_id", return_value=COLLECTION
+        )
+        mocker.patch.object(AlephAPI, "get_collection", return_value=COLLECTION)
+        mocker.patch.object(
+            AlephAPI,
+            "stream_entities",
+            return_value=iter([_entity("a", "Alice"), _entity("b", "Bob")]),
+        )
+        runner = CliRunner()
+        args = ["--host", self.fake_url, "mirror"]
+        result = runner.invoke(cli, args + ["sync", "-f", "test"])
+        assert result.exit_code == 0, result.output
+        assert tmp_path.joinpath("mirror", "test.sqlite").exists()
+        result = runner.invoke(cli, args + ["query", "-f", "test", "-p", "name=Bob"])
+        assert result.exit_code == 0, result.output
+        assert '"id": "b"' in result.output
+        assert '"id": "a"' not in result.output
@@ -0,0 +1,42 @@
+import io
+import time
+
+from alephclient.progress import Progress, format_bytes, format_duration
+from alephclient.util import RateLimiter, ThrottledFile
+
+
+class TestRateLimiter:
+    def test_rate(self):
+        limiter = RateLimiter(1000)
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.consume(500)
+        # The first 1000 bytes are the burst, the rest takes a second.
+        assert time.monotonic() - start >= 0.95
+
+    def test_throttled_file(self):
+        counted = []
+        fh = ThrottledFile(io.BytesIO(b"x" * 100), callback=counted.append)
+        assert fh.read(60) == b"x" * 60
+        assert fh.read() == b"x" * 40
+        assert counted == [60, 40]
+        assert fh.tell() == 100
+
+
+class TestProgress:
+    def test_format(self):
+        assert format_bytes(512) == "512.0 B"
+        assert format_bytes(3 * 1024 * 1024) == "3.0 MB"
+        assert format_duration(3725) == "1:02:05"
+
+    def test_render(self):
+        stream = io.StringIO()
+        progress = Progress("test", stream=stream)
+        progress.add_total(files=4, bytes=4 * 1024 * 1024)
+        progress.update(files=1, bytes=1024 * 1024)
+        progress.update(failed=1)
+        progress.started -= 1
+        line = progress.render()
+        assert line.startswith("[test] 1/4 files (1 failed), 1.0 MB/4.0 MB")
+        assert "MB/s" in line
+        assert "ETA 0:00:0" in line
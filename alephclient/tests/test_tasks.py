@@ -1,8 +1,15 @@
+import json
 import os
+import zipfile
 from pathlib import Path
 
+import pytest
+from requests import Response
+from requests.exceptions import HTTPError
+
 from alephclient.crawldir import crawl_dir
 from alephclient.api import AlephAPI
+from alephclient.errors import AlephException
 
 
 class TestTasks(object):
@@ -137,3 +144,208 @@ class TestTasks(object):
             signed_url=True,
         )
         assert self.api.signed_url_upload.call_count == 6
+
+    def test_ingest_signed_url_pipeline(self, mocker):
+        urls = iter(range(100))
+        mocker.patch.object(
+            self.api,
+            "request_upload_url",
+            side_effect=lambda: {"url": "http://store.test/", "id": next(urls)},
+        )
+        mocker.patch.object(self.api, "put_upload")
+        mocker.patch.object(self.api, "create_document", return_value={"id": 7})
+        mocker.patch.object(self.api, "ingest_upload", return_value={"id": 42})
+        mocker.patch.object(
+            self.api, "load_collection_by_foreign_id", return_value={"id": 2}
+        )
+        crawl_dir(
+            self.api,
+            "alephclient/tests/testdata",
+            "test153",
+            {},
+            True,
+            True,
+            signed_url=True,
+            pipeline=True,
+        )
+        # Folders are still created synchronously, files go through the stages.
+        assert self.api.ingest_upload.call_count == 4
+        assert self.api.put_upload.call_count == 2
+        assert self.api.create_document.call_count == 2
+        metadata = [c.kwargs["metadata"] for c in self.api.create_document.mock_calls]
+        names = sorted(m["foreign_id"] for m in metadata)
+        assert names == ["feb/2.txt", "jan/week1/1.txt"]
+        assert all(m["parent_id"] == 42 for m in metadata)
+        assert all(m["mime_type"] == "text/plain" for m in metadata)
+
+    def test_ingest_signed_url_pipeline_resume(self, mocker):
+        urls = iter(range(100))
+        mocker.patch.object(
+            self.api,
+            "request_upload_url",
+            side_effect=lambda: dict.fromkeys(["url", "id"], "%d" % next(urls)),
+        )
+        puts = []
+
+        def put_upload(url, path, chunk_size=None, resume=None):
+            puts.append((path.name, url, dict(resume)))
+            if not resume:
+                resume.update(url=url + "/session", offset=512)
+                response = Response()
+                response.status_code = 503
+                raise AlephException(HTTPError(response=response))
+
+        mocker.patch.object(self.api, "put_upload", side_effect=put_upload)
+        mocker.patch("alephclient.crawldir.backoff")
+        mocker.patch.object(self.api, "create_document", return_value={"id": 7})
+        mocker.patch.object(self.api, "ingest_upload", return_value={"id": 42})
+        mocker.patch.object(
+            self.api, "load_collection_by_foreign_id", return_value={"id": 2}
+        )
+        crawl_dir(
+            self.api,
+            "alephclient/tests/testdata",
+            "test153",
+            {},
+            True,
+            True,
+            signed_url=True,
+            pipeline=True,
+            chunk_size=256,
+        )
+        assert self.api.create_document.call_count == 2
+        for name in ("1.txt", "2.txt"):
+            first, retry = [p for p in puts if p[0] == name]
+            # The retry keeps the signed URL and resumes the upload session.
+            assert retry[1] == first[1]
+            assert retry[2] == {"url": first[1] + "/session", "offset": 512}
+
+    def test_ingest_pack_small_files(self, mocker, tmp_path):
+        root = tmp_path / "docs"
+        root.mkdir()
+        for i in range(5):
+            root.joinpath("%d.txt" % i).write_bytes(b"x" * 10)
+        root.joinpath("big.bin").write_bytes(b"y" * 4096)
+        archives = {}
+
+        def upload(collection_id, path, metadata=None, index=True):
+            if path.suffix == ".zip":
+                with zipfile.ZipFile(path) as zf:
+                    archives[metadata["foreign_id"]] = sorted(zf.namelist())
+            return {"id": metadata["foreign_id"]}
+
+        mocker.patch.object(self.api, "ingest_upload", side_effect=upload)
+        mocker.patch.object(
+            self.api, "load_collection_by_foreign_id", return_value={"id": 2}
+        )
+        manifest = tmp_path / "manifest.ndjson"
+        crawl_dir(
+            self.api,
+            str(root),
+            "test153",
+            {},
+            pack_threshold=1024,
+            pack_size=30,
+            pack_manifest=str(manifest),
+        )
+        names = [
+            c.kwargs["metadata"]["foreign_id"]
+            for c in self.api.ingest_upload.mock_calls
+        ]
+        assert "big.bin" in names
+        assert sorted(archives) == ["docs.pack-1.zip", "docs.pack-2.zip"]
+        assert len(archives["docs.pack-1.zip"]) == 3
+        assert len(archives["docs.pack-2.zip"]) == 2
+        packed = [json.loads(line) for line in manifest.read_text().splitlines()]
+        assert sorted(r["foreign_id"] for r in packed) == [
+            "%d.txt" % i for i in range(5)
+        ]
+        assert {r["bundle_id"] for r in packed} == set(archives)
+
+    def test_ingest_pack_pipeline(self, mocker, tmp_path):
+        root = tmp_path / "docs"
+        root.mkdir()
+        for i in range(4):
+            root.joinpath("%d.txt" % i).write_bytes(b"x" * 10)
+        urls = iter(range(100))
+        mocker.patch.object(
+            self.api,
+            "request_upload_url",
+            side_effect=lambda: {"url": "http://store.test/", "id": next(urls)},
+        )
+        mocker.patch.object(self.api, "put_upload")
+
+        def create(collection_id, upload_id, metadata=None, index=True):
+            if metadata["foreign_id"] == "docs.pack-2.zip":
+                raise AlephException("Invalid archive")
+            return {"id": "doc-" + metadata["foreign_id"]}
+
+        mocker.patch.object(self.api, "create_document", side_effect=create)
+        mocker.patch.object(
+            self.api, "load_collection_by_foreign_id", return_value={"id": 2}
+        )
+        progress = mocker.patch("alephclient.crawldir.Progress").return_value
+        manifest = tmp_path / "manifest.ndjson"
+        crawl_dir(
+            self.api,
+            str(root),
+            "test153",
+            {},
+            signed_url=True,
+            pipeline=True,
+            pack_threshold=1024,
+            pack_size=20,
+            pack_manifest=str(manifest),
+            progress=True,
+        )
+        packed = [json.loads(line) for line in manifest.read_text().splitlines()]
+        # Only the pack whose document was created is recorded, by its id.
+        assert len(packed) == 2
+        assert {r["bundle_id"] for r in packed} == {"doc-docs.pack-1.zip"}
+        updates = sorted(list(c.kwargs.items()) for c in progress.update.mock_calls)
+        assert updates == [[("failed", 2)], [("files", 2)]]
+
+    def _failing_folders(self, mocker, failures, status=503):
+        def upload(collection_id, path, metadata=None, index=True):
+            foreign_id = metadata["foreign_id"]
+            if failures.get(foreign_id, 0) > 0:
+                failures[foreign_id] -= 1
+                response = Response()
+                response.status_code = status
+                raise AlephException(HTTPError(response=response))
+            return {"id": "id-" + foreign_id}
+
+        mocker.patch("alephclient.crawldir.backoff")
+        mocker.patch.object(self.api, "ingest_upload", side_effect=upload)
+        mocker.patch.object(
+            self.api, "load_collection_by_foreign_id", return_value={"id": 2}
+        )
+
+    def test_ingest_folder_retry(self, mocker):
+        self._failing_folders(mocker, {"jan": 1, "feb": 100})
+        with pytest.raises(AlephException) as exc:
+            crawl_dir(self.api, "alephclient/tests/testdata", "test153", {}, True, True)
+        assert "1 folders" in str(exc.value)
+        assert "feb" in str(exc.value)
+        parents = {
+            c.kwargs["metadata"]["foreign_id"]: c.kwargs["metadata"].get("parent_id")
+            for c in self.api.ingest_upload.mock_calls
+        }
+        # jan failed once, then its subtree was uploaded under it.
+        assert parents["jan/week1"] == "id-jan"
+        assert parents["jan/week1/1.txt"] == "id-jan/week1"
+        # feb never succeeded, so its contents were held back entirely.
+        assert "feb/2.txt" not in parents
+
+    def test_ingest_folder_not_retried(self, mocker):
+        failures = {"feb": 1}
+        self._failing_folders(mocker, failures, status=400)
+        with pytest.raises(AlephException):
+            crawl_dir(self.api, "alephclient/tests/testdata", "test153", {}, True, True)
+        names = [
+            c.kwargs["metadata"]["foreign_id"]
+            for c in self.api.ingest_upload.mock_calls
+        ]
+        # A client error is not retried, by either the upload or the lane.
+        assert names.count("feb") == 1
+        assert "feb/2.txt" not in names
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import threading
+from pathlib import Path
+
+import pytest
+
+from alephclient.api import AlephAPI
+from alephclient.crawldir import CrawlDirectory
+from alephclient.watchdir import (
+    EVENT,
+    IN_Q_OVERFLOW,
+    Debouncer,
+    InotifyWatcher,
+    PollingWatcher,
+    watch_dir,
+)
+
+
+def _drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get())
+    return items
+
+
+class TestWatchDir:
+    def setup_method(self):
+        self.api = AlephAPI(host="http://aleph.test/api/2/", api_key="fake_key")
+
+    def _crawler(self, root: Path, mocker):
+        mocker.patch.object(self.api, "ingest_upload", return_value={"id": "f1"})
+        crawler = CrawlDirectory(self.api, {"id": "2"}, root, nojunk=True)
+        crawler.crawl()
+        _drain(crawler.queue)
+        return crawler
+
+    def test_debouncer(self):
+        debouncer = Debouncer(0.05)
+        debouncer.add(["a", "b"])
+        assert debouncer.ready() == []
+        time.sleep(0.03)
+        debouncer.add(["b"])
+        time.sleep(0.03)
+        assert debouncer.ready() == ["a"]
+        time.sleep(0.05)
+        assert debouncer.ready() == ["b"]
+        assert debouncer.timeout(1.0) == 1.0
+
+    def test_polling_watcher(self, mocker, tmp_path):
+        tmp_path.joinpath("a.txt").write_text("a")
+        crawler = self._crawler(tmp_path, mocker)
+        watcher = PollingWatcher(tmp_path, crawler, interval=0)
+        tmp_path.joinpath("a.txt").write_text("changed")
+        tmp_path.joinpath("b.txt").write_text("b")
+        tmp_path.joinpath(".hidden").mkdir()
+        tmp_path.joinpath(".hidden", "c.txt").write_text("c")
+        changed = watcher.poll(1.0)
+        assert sorted(Path(p).name for p in changed) == ["a.txt", "b.txt"]
+        assert watcher.poll(1.0) == []
+
+    @pytest.mark.skipif(sys.platform != "linux", reason="inotify is Linux only")
+    def test_inotify_watcher(self, mocker, tmp_path):
+        crawler = self._crawler(tmp_path, mocker)
+        watcher = InotifyWatcher(tmp_path, crawler)
+        try:
+            tmp_path.joinpath("a.txt").write_text("a")
+            tmp_path.joinpath("sub").mkdir()
+            changed = watcher.poll(1.0)
+            assert sorted(Path(p).name for p in changed) == ["a.txt", "sub"]
+        finally:
+            watcher.close()
+
+    @pytest.mark.skipif(sys.platform != "linux", reason="inotify is Linux only")
+    def test_inotify_overflow(self, mocker, tmp_path):
+        for name in ("old.txt", "changed.txt", "seen.txt"):
+            tmp_path.joinpath(name).write_text(name)
+        crawler = self._crawler(tmp_path, mocker)
+        watcher = InotifyWatcher(tmp_path, crawler)
+        try:
+            tmp_path.joinpath("seen.txt").write_text("seen, changed")
+            assert [Path(p).name for p in watcher.poll(1.0)] == ["seen.txt"]
+            read = os.read
+
+            def overflow(fd, size):
+                # Drop the real events, as the kernel does when its queue is full.
+                if fd == watcher.fd:
+                    read(fd, size)
+                    return EVENT.pack(-1, IN_Q_OVERFLOW, 0, 0)
+                return read(fd, size)
+
+            mocker.patch("os.read", side_effect=overflow)
+            tmp_path.joinpath("changed.txt").write_text("changed, again")
+            tmp_path.joinpath("new.txt").write_text("new")
+            changed = watcher.poll(1.0)
+            # Only what differs from the last known state is reported.
+            assert sorted(Path(p).name for p in changed) == ["changed.txt", "new.txt"]
+        finally:
+            watcher.close()
+
+    def test_watch_dir(self, mocker, tmp_path):
+        tmp_path.joinpath("old.txt").write_text("old")
+        crawler = self._crawler(tmp_path, mocker)
+        assert crawler.folders == {str(tmp_path): None}
+        watcher = PollingWatcher(tmp_path, crawler, interval=0.01)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=watch_dir, args=(crawler, watcher, 0.05, stop), daemon=True
+        )
+        thread.start()
+        tmp_path.joinpath("new.txt").write_text("new")
+        tmp_path.joinpath("sub").mkdir()
+        tmp_path.joinpath("sub", "inner.txt").write_text("inner")
+        time.sleep(0.5)
+        stop.set()
+        thread.join()
+        queued = {Path(p).name: parent for p, parent in _drain(crawler.queue)}
+        assert queued == {"new.txt": None, "inner.txt": "f1"}
+        assert crawler.folders[str(tmp_path / "sub")] == "f1"
+        self.api.ingest_upload.assert_called_once()
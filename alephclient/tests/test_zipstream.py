@@ -0,0 +1,84 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from alephclient.errors import AlephException
+from alephclient.zipstream import extract_members, iter_entities, iter_members
+
+ENTITIES = [{"id": str(i), "schema": "Person"} for i in range(100)]
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only stream, which makes zipfile use data descriptors."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data.extend(b)
+        return len(b)
+
+
+def _archive(seekable=True, compression=zipfile.ZIP_DEFLATED):
+    fh = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(fh, "w", compression=compression) as zf:
+        zf.writestr("docs/", b"")
+        zf.writestr("docs/readme.txt", b"hello " * 1000)
+        lines = "\n".join(json.dumps(e) for e in ENTITIES)
+        zf.writestr("entities.ftm.json", lines)
+    return bytes(fh.getvalue() if seekable else fh.data)
+
+
+def _chunks(data, size=7):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+class TestZipStream:
+    @pytest.mark.parametrize("seekable", [True, False])
+    def test_members(self, seekable):
+        data = _archive(seekable=seekable)
+        members = [(m.name, b"".join(d)) for m, d in iter_members(_chunks(data))]
+        assert [name for name, _ in members] == [
+            "docs/",
+            "docs/readme.txt",
+            "entities.ftm.json",
+        ]
+        assert members[1][1] == b"hello " * 1000
+
+    def test_stored(self):
+        data = _archive(compression=zipfile.ZIP_STORED)
+        assert len(list(iter_entities(_chunks(data, 100)))) == len(ENTITIES)
+
+    def test_stored_descriptor(self):
+        data = _archive(seekable=False, compression=zipfile.ZIP_STORED)
+        with pytest.raises(AlephException):
+            list(iter_members(_chunks(data)))
+
+    def test_entities(self):
+        data = _archive(seekable=False)
+        assert list(iter_entities(_chunks(data, 1000))) == ENTITIES
+
+    def test_extract(self, tmp_path):
+        paths = extract_members(_chunks(_archive()), tmp_path)
+        assert len(paths) == 2
+        assert tmp_path.joinpath("docs", "readme.txt").read_bytes() == b"hello " * 1000
+
+    def test_unsafe_path(self, tmp_path):
+        fh = io.BytesIO()
+        with zipfile.ZipFile(fh, "w") as zf:
+            zf.writestr("../evil.txt", b"evil")
+        with pytest.raises(AlephException):
+            extract_members([fh.getvalue()], tmp_path / "target")
+        assert not tmp_path.joinpath("evil.txt").exists()
+
+    def test_corrupt(self):
+        data = bytearray(_archive(compression=zipfile.ZIP_STORED))
+        offset = data.index(b"hello")
+        data[offset] = ord("j")
+        with pytest.raises(AlephException):
+            list(iter_members([bytes(data)]))
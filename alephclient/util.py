@@ -1,7 +1,8 @@
 import time
 import random
 import logging
-from typing import Dict
+import threading
+from typing import BinaryIO, Callable, Dict, Optional
 from banal import ensure_list
 
 log = logging.getLogger(__name__)
@@ -18,3 +19,55 @@ def prop_push(properties: Dict, prop: str, value):
     values = ensure_list(properties.get(prop))
     values.extend(ensure_list(value))
     properties[prop] = values
+
+
+class RateLimiter(object):
+    """A token bucket shared between threads, to cap the rate at which
+    something (e.g. bytes sent) is consumed."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: float):
+        """Take `amount` tokens, sleeping until the bucket can afford them.
+        The bucket may go into debt, which makes later callers wait longer,
+        so the average rate holds across all threads."""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledFile(object):
+    """Wrap a file handle to pass every read through a rate limiter and
+    report the number of bytes read to a callback."""
+
+    def __init__(
+        self,
+        fh: BinaryIO,
+        limiter: Optional[RateLimiter] = None,
+        callback: Optional[Callable[[int], None]] = None,
+    ):
+        self.fh = fh
+        self.limiter = limiter
+        self.callback = callback
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fh.read(size)
+        if self.limiter is not None and len(data):
+            self.limiter.consume(len(data))
+        if self.callback is not None:
+            self.callback(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
@@ -0,0 +1,250 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from alephclient.crawldir import CrawlDirectory
+
+log = logging.getLogger(__name__)
+
+# See inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct("iIII")
+
+# The modification time and size of a file, (0, -1) for directories.
+Stamp = Tuple[int, int]
+
+
+def _stamp(path: str) -> Optional[Stamp]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        return (0, -1)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def scan_tree(root: Path, crawler: "CrawlDirectory") -> Dict[str, Stamp]:
+    """Stamp every file and directory under `root` which the crawler does
+    not exclude."""
+    snapshot: Dict[str, Stamp] = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not crawler.is_excluded(Path(dirpath, d))]
+        for name in dirnames:
+            snapshot[os.path.join(dirpath, name)] = (0, -1)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            stamp = _stamp(path)
+            if stamp is not None:
+                snapshot[path] = stamp
+    return snapshot
+
+
+def changed_since(snapshot: Dict[str, Stamp], current: Dict[str, Stamp]) -> List[str]:
+    """Paths which are new in `current` or were modified since `snapshot`."""
+    return [p for p, s in current.items() if snapshot.get(p) != s]
+
+
+class PollingWatcher(object):
+    """Detect new and changed files by comparing the size and modification
+    time of every file in the tree between two scans."""
+
+    def __init__(self, root: Path, crawler: "CrawlDirectory", interval: float = 5.0):
+        self.root = root
+        self.crawler = crawler
+        self.interval = interval
+        self.snapshot = self.scan()
+        self.last_poll = time.monotonic()
+
+    def scan(self) -> Dict[str, Stamp]:
+        return scan_tree(self.root, self.crawler)
+
+    def add(self, path: Path):
+        pass
+
+    def poll(self, timeout: float) -> List[str]:
+        wait = self.last_poll + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait))
+        self.last_poll = time.monotonic()
+        snapshot = self.scan()
+        changed = changed_since(self.snapshot, snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Receive file system events from the Linux kernel for every directory
+    in the tree. The kernel drops events when too many arrive at once; the
+    tree is then compared with a snapshot kept up to date with the events,
+    so only files that are new or changed are reported."""
+
+    def __init__(self, root: Path, crawler: "CrawlDirectory"):
+        name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.crawler = crawler
+        self.watches: Dict[int, str] = {}
+        self.add(root)
+        self.snapshot = scan_tree(root, crawler)
+
+    def add(self, path: Path):
+        """Watch a directory and all its sub-directories."""
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames[:] = [
+                d for d in dirnames if not self.crawler.is_excluded(Path(dirpath, d))
+            ]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                log.warning("Cannot watch %s: %s", dirpath, os.strerror(err))
+                continue
+            self.watches[wd] = dirpath
+
+    def poll(self, timeout: float) -> List[str]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+        changed: List[str] = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            # Files are picked up once they are closed, directories as soon as
+            # they appear so their contents can be watched.
+            if mask & IN_CREATE and not mask & IN_ISDIR:
+                continue
+            changed.append(os.path.join(directory, os.fsdecode(name)))
+        for path in changed:
+            stamp = _stamp(path)
+            if stamp is not None:
+                self.snapshot[path] = stamp
+        if overflow:
+            log.warning("Too many file system events, rescanning: %s", self.root)
+            snapshot = scan_tree(self.root, self.crawler)
+            changed.extend(changed_since(self.snapshot, snapshot))
+            self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(root: Path, crawler: "CrawlDirectory", interval: float = 5.0):
+    """Use inotify where the platform supports it, polling otherwise."""
+    try:
+        return InotifyWatcher(root, crawler)
+    except (AttributeError, OSError) as exc:
+        log.info("inotify unavailable (%s), polling every %.1fs", exc, interval)
+        return PollingWatcher(root, crawler, interval=interval)
+
+
+class Debouncer(object):
+    """Hold back paths until no event has been seen for them for `delay`
+    seconds, so a file being written is uploaded once, when it's complete."""
+
+    def __init__(self, delay: float = 2.0):
+        self.delay = delay
+        self.pending: Dict[str, float] = {}
+
+    def add(self, paths: Iterable[str]):
+        now = time.monotonic()
+        for path in paths:
+            self.pending[path] = now + self.delay
+
+    def ready(self) -> List[str]:
+        now = time.monotonic()
+        paths = [p for p, due in self.pending.items() if due <= now]
+        for path in paths:
+            self.pending.pop(path)
+        return paths
+
+    def timeout(self, default: float) -> float:
+        if not self.pending:
+            return default
+        return max(0.0, min(min(self.pending.values()) - time.monotonic(), default))
+
+
+def watch_dir(
+    crawler: "CrawlDirectory",
+    watcher,
+    debounce: float = 2.0,
+    stop: Optional[threading.Event] = None,
+):
+    """Queue new and changed files under the crawler's root for upload until
+    `stop` is set. New directories are created in the collection first, using
+    the folder ids the crawler has already collected as their parents."""
+    stop = stop or threading.Event()
+    debouncer = Debouncer(debounce)
+    while not stop.is_set():
+        debouncer.add(watcher.poll(debouncer.timeout(1.0)))
+        # Parents before children, so each folder exists before its contents.
+        seen: Set[str] = set()
+        for path in sorted(debouncer.ready(), key=lambda p: p.count(os.sep)):
+            path_ = Path(path)
+            if path in seen or str(path_.parent) in seen:
+                continue
+            if not path_.exists():
+                continue
+            if crawler.is_excluded(path_):
+                continue
+            parent = str(path_.parent)
+            if parent not in crawler.folders:
+                # The parent was skipped or excluded: leave its contents alone.
+                continue
+            parent_id = crawler.folders[parent]
+            if path_.is_dir():
+                if path in crawler.folders:
+                    continue
+                log.info("Watch [%s]: new folder %s", crawler.collection_id, path)
+                watcher.add(path_)
+                crawler.scan_queue.put((path_, parent_id))
+                crawler.crawl()
+                for dirpath, _, _ in os.walk(path):
+                    seen.add(dirpath)
+            else:
+                log.info("Watch [%s]: %s", crawler.collection_id, path)
+                if crawler.progress is not None:
+                    crawler.progress.add_total(files=1, bytes=path_.stat().st_size)
+                crawler.queue.put((path_, parent_id))
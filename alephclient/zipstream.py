@@ -0,0 +1,230 @@
+import json
+import zlib
+import struct
+import logging
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from alephclient.errors import AlephException
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 512 * 1024
+LOCAL_HEADER = b"PK\x03\x04"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+# Once any of these follows the members, there are no more local headers.
+DIRECTORY_HEADERS = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+ENTITY_SUFFIXES = (".json", ".jsonl", ".ndjson", ".ftm")
+
+STORED = 0
+DEFLATED = 8
+
+
+class ChunkReader(object):
+    """Exact-size reads from an iterator of byte chunks, such as an HTTP
+    response's `iter_content`, with the option to push data back."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size: int) -> bytes:
+        """Read up to `size` bytes; fewer only at the end of the stream."""
+        while len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_exact(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) != size:
+            raise AlephException("Archive is truncated")
+        return data
+
+    def read_some(self, size: int) -> bytes:
+        """Read whatever is at hand, up to `size` bytes, but at least one."""
+        if not self.buffer:
+            self.buffer = next(self.chunks, b"")
+        return self.read(min(size, max(1, len(self.buffer))))
+
+    def unread(self, data: bytes):
+        self.buffer = data + self.buffer
+
+
+class ZipMember(object):
+    def __init__(self, name: str, size: Optional[int], method: int):
+        self.name = name
+        self.size = size
+        self.method = method
+
+    @property
+    def is_dir(self) -> bool:
+        return self.name.endswith("/")
+
+    def __repr__(self):
+        return "<ZipMember(%r, %r)>" % (self.name, self.size)
+
+
+def _zip64_sizes(extra: bytes) -> Optional[Tuple[int, int]]:
+    """Read the sizes from a ZIP64 extra field, if there is one."""
+    offset = 0
+    while offset + 4 <= len(extra):
+        tag, length = struct.unpack("<HH", extra[offset : offset + 4])
+        if tag == 0x0001 and length >= 16:
+            data = extra[offset + 4 : offset + 20]
+            usize, csize = struct.unpack("<QQ", data)
+            return usize, csize
+        offset += 4 + length
+    return None
+
+
+def _read_data(reader: ChunkReader, csize: int, method: int) -> Iterator[bytes]:
+    """Member data of a known compressed size."""
+    inflater = zlib.decompressobj(-15) if method == DEFLATED else None
+    remaining = csize
+    while remaining > 0:
+        data = reader.read_some(min(CHUNK_SIZE, remaining))
+        if not data:
+            raise AlephException("Archive is truncated")
+        remaining -= len(data)
+        if inflater is not None:
+            data = inflater.decompress(data)
+        if data:
+            yield data
+    if inflater is not None:
+        tail = inflater.flush()
+        if tail:
+            yield tail
+
+
+def _read_deflated(reader: ChunkReader) -> Iterator[bytes]:
+    """Member data of unknown size, which ends with the deflate stream."""
+    inflater = zlib.decompressobj(-15)
+    while not inflater.eof:
+        data = reader.read_some(CHUNK_SIZE)
+        if not data:
+            raise AlephException("Archive is truncated")
+        data = inflater.decompress(data)
+        if data:
+            yield data
+    reader.unread(inflater.unused_data)
+
+
+def iter_members(
+    chunks: Iterable[bytes],
+) -> Iterator[Tuple[ZipMember, Iterator[bytes]]]:
+    """Read a zip archive front to back from its local file headers, without
+    the central directory at its end, yielding each member with an iterator
+    of its uncompressed data. Data not consumed by the caller is skipped
+    before the next member. The CRC of every member is checked."""
+    reader = ChunkReader(chunks)
+    while True:
+        signature = reader.read(4)
+        if not signature or signature in DIRECTORY_HEADERS:
+            return
+        if signature != LOCAL_HEADER:
+            raise AlephException("Not a zip archive, or one with gaps")
+        header = reader.read_exact(26)
+        _, flags, method, _, _, crc, csize, usize, name_len, extra_len = struct.unpack(
+            "<HHHHHIIIHH", header
+        )
+        raw_name = reader.read_exact(name_len)
+        extra = reader.read_exact(extra_len)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        if flags & 0x1:
+            raise AlephException("Encrypted member: %s" % name)
+        if method not in (STORED, DEFLATED):
+            raise AlephException("Unsupported compression of %s" % name)
+        zip64 = _zip64_sizes(extra)
+        if zip64 is not None:
+            usize, csize = zip64
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor:
+            if method != DEFLATED:
+                raise AlephException("Cannot stream stored member: %s" % name)
+            member = ZipMember(name, None, method)
+            data = _read_deflated(reader)
+        else:
+            member = ZipMember(name, usize, method)
+            data = _read_data(reader, csize, method)
+        descriptor = None
+        if has_descriptor:
+            descriptor = partial(_read_descriptor, reader, zip64 is not None)
+        checked = _check_crc(data, name, crc, descriptor)
+        yield member, checked
+        # Skip whatever the caller did not read.
+        for _ in checked:
+            pass
+
+
+def _read_descriptor(reader: ChunkReader, zip64: bool) -> int:
+    """Read the data descriptor after a member, returning its CRC."""
+    data = reader.read_exact(4)
+    if data == DATA_DESCRIPTOR:
+        data = reader.read_exact(4)
+    (crc,) = struct.unpack("<I", data)
+    reader.read_exact(16 if zip64 else 8)
+    return crc
+
+
+def _check_crc(
+    data: Iterator[bytes],
+    name: str,
+    crc: int,
+    descriptor: Optional[Callable[[], int]] = None,
+) -> Iterator[bytes]:
+    actual = 0
+    for chunk in data:
+        actual = zlib.crc32(chunk, actual)
+        yield chunk
+    if descriptor is not None:
+        crc = descriptor()
+    if actual != crc:
+        raise AlephException("CRC mismatch in %s" % name)
+
+
+def _target_path(target: Path, name: str) -> Path:
+    path = target.joinpath(name).resolve()
+    if path != target and target not in path.parents:
+        raise AlephException("Unsafe path in archive: %s" % name)
+    return path
+
+
+def extract_members(chunks: Iterable[bytes], target: Path) -> List[Path]:
+    """Extract a zip archive into `target` as it is read."""
+    target = target.resolve()
+    target.mkdir(parents=True, exist_ok=True)
+    paths: List[Path] = []
+    for member, data in iter_members(chunks):
+        path = _target_path(target, member.name)
+        if member.is_dir:
+            path.mkdir(parents=True, exist_ok=True)
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        log.info("Extract: %s", member.name)
+        with open(path, "wb") as fh:
+            for chunk in data:
+                fh.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def iter_entities(chunks: Iterable[bytes]) -> Iterator[Dict]:
+    """Yield the entities in the line-delimited JSON members of a zip archive,
+    as it is read. Other members are skipped."""
+    for member, data in iter_members(chunks):
+        if member.is_dir or not member.name.lower().endswith(ENTITY_SUFFIXES):
+            continue
+        pending = b""
+        for chunk in data:
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if pending.strip():
+            yield json.loads(pending)